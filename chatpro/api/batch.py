@@ -0,0 +1,150 @@
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+from chatpro.profiles.models import Contact, contact_lookups
+from chatpro.rooms.models import Room, room_lookups
+from chatpro.rooms.rosters import record_roster_changes, contact_key
+from chatpro.msgs.models import Message
+
+EVENT_PARAMS = {('message', 'new'): ('contact', 'text', 'group'),
+                ('contact', 'new'): ('contact', 'group'),
+                ('contact', 'del'): ('contact',)}
+
+
+def process_events(org, events):
+    """
+    Processes a batch of webhook events, each a dict with entity, action and the same parameters as the single event
+    handler. Rooms and contacts are resolved with one query each, and new messages are written with a single insert.
+    Returns a result dict for each event.
+    """
+    results = [None] * len(events)
+    valid = []
+
+    for e, event in enumerate(events):
+        error = validate_event(event)
+        if error:
+            results[e] = {'status': 'error', 'error': error}
+        else:
+            valid.append((e, event))
+
+    group_uuids = {event['group'] for e, event in valid if 'group' in event}
+    contact_uuids = {event['contact'] for e, event in valid if event['action'] == 'new'}
+
+    rooms = _get_or_create_rooms(org, group_uuids)
+    contacts = _get_or_create_contacts(org, contact_uuids)
+
+    # find contacts to be deleted which we didn't need to fetch for other events
+    del_uuids = {event['contact'] for e, event in valid if event['action'] == 'del'} - set(contacts.keys())
+    contacts.update({c.uuid: c for c in Contact.objects.filter(org=org, uuid__in=del_uuids)})
+
+    # apply events in order to work out the final state of each contact, and which messages to create
+    contact_states = OrderedDict()
+    new_messages = []
+
+    for e, event in valid:
+        contact = contacts.get(event['contact'])
+        room = rooms.get(event['group']) if 'group' in event else None
+
+        if event['action'] == 'del':
+            if contact:
+                contact_states[contact] = (False, contact.room_id)
+            results[e] = {'status': 'ok'}
+        elif not room:
+            results[e] = {'status': 'error', 'error': "No such group"}
+        elif not contact:
+            results[e] = {'status': 'error', 'error': "No such contact"}
+        else:
+            contact_states[contact] = (True, room.pk)
+
+            if event['entity'] == 'message':
+                new_messages.append((e, contact, event['text'], room))
+            else:
+                results[e] = {'status': 'ok'}
+
+    _update_contacts(contact_states)
+
+    messages = Message.bulk_create_for_contacts(org, [item[1:] for item in new_messages])
+    for item, msg in zip(new_messages, messages):
+        results[item[0]] = {'status': 'ok', 'message': msg.pk}
+
+    return results
+
+
+def validate_event(event):
+    """
+    Validates a single event, returning an error message if it's invalid
+    """
+    if not isinstance(event, dict):
+        return "Event must be an object"
+
+    params = EVENT_PARAMS.get((event.get('entity'), event.get('action')))
+    if not params:
+        return "Unsupported entity or action"
+
+    if not all(event.get(p) for p in params):
+        return "Missing %s parameter" % ", ".join(params)
+
+    return None
+
+
+def _get_or_create_rooms(org, group_uuids):
+    """
+    Gets rooms by group UUID, re-activating inactive rooms and creating missing ones from the Temba instance
+    """
+    rooms = {r.uuid: r for r in Room.objects.filter(org=org, uuid__in=group_uuids)}
+
+    inactive = [r for r in rooms.values() if not r.is_active]
+    if inactive:
+        Room.objects.filter(pk__in=[r.pk for r in inactive]).update(is_active=True)
+        room_lookups.invalidate(org.pk, [r.uuid for r in inactive])
+        Room.invalidate_index(org)
+
+    missing_uuids = group_uuids - set(rooms.keys())
+    if missing_uuids:
+        for temba_group in org.get_temba_client().get_groups(uuids=list(missing_uuids)):
+            rooms[temba_group.uuid] = Room.get_or_create(org, temba_group.name, temba_group.uuid)
+
+    return rooms
+
+
+def _get_or_create_contacts(org, contact_uuids):
+    """
+    Gets contacts by UUID, creating missing ones from the Temba instance
+    """
+    contacts = {c.uuid: c for c in Contact.objects.filter(org=org, uuid__in=contact_uuids)}
+
+    missing_uuids = contact_uuids - set(contacts.keys())
+    if missing_uuids:
+        for temba_contact in org.get_temba_client().get_contacts(uuids=list(missing_uuids)):
+            try:
+                contacts[temba_contact.uuid] = Contact.get_or_create_from_temba(org, temba_contact)
+            except ValueError:  # not in any of this org's rooms
+                pass
+
+    return contacts
+
+
+def _update_contacts(contact_states):
+    """
+    Updates contacts whose active state or room has changed, with one update per distinct state
+    """
+    changed = {}
+    for contact, (is_active, room_id) in contact_states.items():
+        if contact.is_active != is_active or contact.room_id != room_id:
+            changed.setdefault((is_active, room_id), []).append(contact)
+
+    changed_room_ids = set()
+
+    for (is_active, room_id), contacts in changed.items():
+        Contact.objects.filter(pk__in=[c.pk for c in contacts]).update(is_active=is_active, room=room_id)
+        contact_lookups.invalidate(contacts[0].org_id, [c.uuid for c in contacts])
+
+        changed_room_ids.add(room_id)
+        changed_room_ids.update(c.room_id for c in contacts)
+
+        contact_keys = [contact_key(c.pk) for c in contacts]
+        record_roster_changes({room_id} | {c.room_id for c in contacts}, contact_keys)
+
+    if changed_room_ids:
+        Room.update_contact_counts(changed_room_ids)
@@ -0,0 +1,18 @@
+from __future__ import absolute_import, unicode_literals
+
+from chatpro.profiles.models import contact_lookups
+from chatpro.rooms.models import room_lookups
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Displays hit and miss counts for the room and contact lookup caches used by webhook handling"
+
+    def handle(self, *args, **options):
+        for name, lookups in (("Rooms", room_lookups), ("Contacts", contact_lookups)):
+            stats = lookups.get_stats()
+            total = sum(stats.values())
+            hit_rate = 100.0 * (stats['local_hits'] + stats['shared_hits']) / total if total else 0.0
+
+            self.stdout.write("%s: %d local hits, %d shared hits, %d misses (%.1f%% hit rate)"
+                              % (name, stats['local_hits'], stats['shared_hits'], stats['misses'], hit_rate))
@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals
+
+from chatpro.api.queue import requeue_failed_events
+from chatpro.api.tasks import schedule_drain
+from dash.orgs.models import Org
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = "org_id [org_id ...]"
+    help = "Moves webhook events from batches which failed back onto their orgs' queues, and schedules draining them"
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Must provide at least one org id")
+
+        for org_id in args:
+            org = Org.objects.filter(pk=org_id).first()
+            if not org:
+                raise CommandError("No such org #%s" % org_id)
+
+            count = requeue_failed_events(org)
+            if count:
+                schedule_drain(org.pk)
+
+            self.stdout.write("Requeued %d failed webhook events for org #%d" % (count, org.pk))
@@ -0,0 +1,107 @@
+"""
+Per-org queues of webhook events waiting to be processed, kept in Redis as lists. Events are pushed onto the head of
+an org's queue and popped from its tail onto a processing list, so a batch which is interrupted can be recovered.
+Events from batches which fail are kept on a failed list, oldest at its tail, from which they can be requeued.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from chatpro.utils import get_redis_connection
+from dash.utils import datetime_to_ms
+from django.utils import timezone
+
+EVENT_QUEUE_KEY = 'org:%d:webhook_events'
+EVENT_PROCESSING_KEY = 'org:%d:webhook_events:processing'
+EVENT_FAILED_KEY = 'org:%d:webhook_events:failed'
+
+
+def queue_events(org, events):
+    """
+    Appends events to the given org's queue. Returns false if there is no queue, e.g. during testing, in which case
+    events should be processed immediately.
+    """
+    r = get_redis_connection()
+    if not r:
+        return False
+
+    received_on = datetime_to_ms(timezone.now())
+    items = [json.dumps({'event': event, 'received_on': received_on}) for event in events]
+    if items:
+        r.lpush(EVENT_QUEUE_KEY % org.pk, *items)
+
+    return True
+
+
+def pop_events(org, count):
+    """
+    Moves up to count of the oldest events from the given org's queue onto its processing list. Returns the moved
+    events, including any left on the processing list by an earlier interrupted batch, as (event, received_on) tuples.
+    """
+    r = get_redis_connection()
+    queue_key, processing_key = EVENT_QUEUE_KEY % org.pk, EVENT_PROCESSING_KEY % org.pk
+
+    with r.pipeline(transaction=False) as pipe:
+        pipe.lrange(processing_key, 0, -1)
+        for i in range(count):
+            pipe.rpoplpush(queue_key, processing_key)
+        results = pipe.execute()
+
+    # processing list is pushed onto from its head, so any leftover events are read back in reverse
+    leftover, moved = list(reversed(results[0])), [item for item in results[1:] if item is not None]
+
+    items = [json.loads(item) for item in leftover + moved]
+    return [(item['event'], item['received_on']) for item in items]
+
+
+def complete_events(org, failed=False):
+    """
+    Clears the given org's processing list once its events have been processed, keeping them in a separate list if
+    processing failed
+    """
+    r = get_redis_connection()
+    processing_key = EVENT_PROCESSING_KEY % org.pk
+
+    if failed:
+        with r.pipeline() as pipe:
+            pipe.lrange(processing_key, 0, -1)
+            pipe.delete(processing_key)
+            items = pipe.execute()[0]
+
+        # processing list has the oldest event at its tail, so push in reverse to keep that order
+        if items:
+            r.lpush(EVENT_FAILED_KEY % org.pk, *reversed(items))
+    else:
+        r.delete(processing_key)
+
+
+def requeue_failed_events(org):
+    """
+    Moves the given org's failed events back onto its queue, in the order they were received, so that they're
+    processed again. Returns the number of requeued events.
+    """
+    r = get_redis_connection()
+    failed_key, queue_key = EVENT_FAILED_KEY % org.pk, EVENT_QUEUE_KEY % org.pk
+
+    count = 0
+    while r.rpoplpush(failed_key, queue_key) is not None:
+        count += 1
+
+    return count
+
+
+def get_queue_status(org):
+    """
+    Gets the depth of the given org's queue, and the lag in milliseconds of its oldest event
+    """
+    r = get_redis_connection()
+    if not r:
+        return 0, 0
+
+    with r.pipeline(transaction=False) as pipe:
+        pipe.llen(EVENT_QUEUE_KEY % org.pk)
+        pipe.lindex(EVENT_QUEUE_KEY % org.pk, -1)
+        depth, oldest = pipe.execute()
+
+    lag = datetime_to_ms(timezone.now()) - json.loads(oldest)['received_on'] if oldest else 0
+    return depth, lag
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, unicode_literals
+
+from celery.utils.log import get_task_logger
+from dash.orgs.models import Org
+from dash.utils import datetime_to_ms
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from djcelery_transactions import task
+
+logger = get_task_logger(__name__)
+
+DRAIN_SCHEDULED_CACHE_KEY = 'org:%d:webhook_drain_scheduled'
+DRAIN_LOCK_KEY = 'org:%d:webhook_drain_lock'
+DRAIN_LOCK_TTL = 60 * 5  # 5 minutes
+DRAIN_RETRY_DELAY = 10  # seconds
+
+
+def schedule_drain(org_id, countdown=0):
+    """
+    Schedules draining of an org's webhook event queue after the given delay, unless that has already been scheduled
+    """
+    if cache.add(DRAIN_SCHEDULED_CACHE_KEY % org_id, True, DRAIN_LOCK_TTL):
+        drain_org_events.apply_async(args=(org_id,), countdown=countdown)
+
+
+@task
+def drain_org_events(org_id):
+    """
+    Processes an org's queued webhook events in batches until its queue is empty
+    """
+    from chatpro.orgs_ext import TaskType
+    from .batch import process_events
+    from .queue import pop_events, complete_events, get_queue_status
+
+    # allow new events to schedule another drain
+    cache.delete(DRAIN_SCHEDULED_CACHE_KEY % org_id)
+
+    # if a previous drain for this org is still running, try again later
+    if not cache.add(DRAIN_LOCK_KEY % org_id, True, DRAIN_LOCK_TTL):
+        schedule_drain(org_id, countdown=DRAIN_RETRY_DELAY)
+        return
+
+    try:
+        org = Org.objects.get(pk=org_id)
+        batch_size = settings.WEBHOOK_QUEUE_BATCH_SIZE
+        processed, failed, max_lag = 0, 0, 0
+
+        while True:
+            items = pop_events(org, batch_size)
+            if not items:
+                break
+
+            # each batch is applied atomically, so a failed batch can be requeued without its events being applied twice
+            try:
+                with transaction.atomic():
+                    results = process_events(org, [event for event, received_on in items])
+            except Exception:
+                complete_events(org, failed=True)
+                failed += len(items)
+
+                logger.error("Processing batch of %d events for org #%d failed" % (len(items), org.pk), exc_info=1)
+            else:
+                complete_events(org)
+                processed += len(items)
+                failed += len([r for r in results if r['status'] == 'error'])
+
+            now = datetime_to_ms(timezone.now())
+            max_lag = max(max_lag, now - min(received_on for event, received_on in items))
+
+            if len(items) < batch_size:
+                break
+
+        depth = get_queue_status(org)[0]
+
+        task_result = dict(time=datetime_to_ms(timezone.now()),
+                           counts=dict(processed=processed, failed=failed),
+                           max_lag=max_lag)
+        org.set_task_result(TaskType.ingest_events, task_result)
+
+        logger.info("Drained %d webhook events for org #%d (%d failed, max lag %d ms, %d still queued)"
+                    % (processed, org.pk, failed, max_lag, depth))
+    finally:
+        cache.delete(DRAIN_LOCK_KEY % org_id)
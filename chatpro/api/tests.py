@@ -1,10 +1,22 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+
+from chatpro.api.batch import process_events
+from chatpro.api.queue import get_queue_status, EVENT_QUEUE_KEY, EVENT_PROCESSING_KEY, EVENT_FAILED_KEY
+from chatpro.api.tasks import drain_org_events, DRAIN_LOCK_KEY, DRAIN_LOCK_TTL, DRAIN_RETRY_DELAY
 from chatpro.msgs.models import Message
-from chatpro.profiles.models import Contact
-from chatpro.rooms.models import Room
+from chatpro.orgs_ext import TaskType
+from chatpro.profiles.models import Contact, contact_lookups
+from chatpro.rooms.models import Room, room_lookups
 from chatpro.test import ChatProTest
+from chatpro.utils import SINGLE_FLIGHT_LOCK_KEY
+from chatpro.utils.lookups import LRUCache, ModelLookupCache
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from mock import patch
 from temba.types import Contact as TembaContact, Group as TembaGroup
@@ -123,6 +135,33 @@ class TembaHandlerTest(ChatProTest):
         response = self.url_post('unicef', '%s?%s' % (url, 'contact=C-008&group=G-007&token=1234567890'))
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('dash.orgs.models.TembaClient.get_contact')
+    def test_concurrent_new_contact(self, mock_get_contact):
+        url = reverse('api.temba_handler', kwargs=dict(entity='message', action='new'))
+        temba_contact = TembaContact.create(uuid='C-007', name="Ken", urns=['tel:234'], groups=['G-001'],
+                                            fields=dict(chat_name="ken"), language='eng', modified_on=timezone.now())
+
+        # simulate another request fetching the same contact, which creates it whilst we wait
+        cache.add(SINGLE_FLIGHT_LOCK_KEY % ('org:%d:contact:C-007' % self.unicef.pk), True)
+
+        def other_request_finishes(secs):
+            Contact.get_or_create_from_temba(self.unicef, temba_contact)
+
+        with patch('chatpro.utils.time.sleep') as mock_sleep:
+            mock_sleep.side_effect = other_request_finishes
+
+            response = self.url_post('unicef', '%s?%s' % (url, 'contact=C-007&text=Hello&group=G-001&token=1234567890'))
+            self.assertEqual(response.status_code, 200)
+
+        # we didn't fetch the contact ourselves
+        self.assertFalse(mock_get_contact.called)
+        self.assertEqual(Message.objects.get(text="Hello").contact, Contact.objects.get(uuid='C-007'))
+
+        # creating a contact which already exists returns the existing contact
+        self.assertEqual(Contact.get_or_create_from_temba(self.unicef, temba_contact), Contact.objects.get(uuid='C-007'))
+        self.assertEqual(Room.get_or_create(self.unicef, "Cars", 'G-001'), self.room1)
+
     def test_del_contact(self):
         url = reverse('api.temba_handler', kwargs=dict(entity='contact', action='del'))
 
@@ -143,3 +182,239 @@ class TembaHandlerTest(ChatProTest):
 
         contact = Contact.objects.get(pk=self.contact6.pk)
         self.assertTrue(contact.is_active)
+
+
+class TembaBatchHandlerTest(ChatProTest):
+
+    def post_events(self, events, token='1234567890'):
+        url = '%s?token=%s' % (reverse('api.temba_batch_handler'), token)
+        return self.client.post(url, json.dumps(events), content_type='application/json',
+                                HTTP_HOST='unicef.localhost')
+
+    @patch('dash.orgs.models.TembaClient.get_groups')
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_batch(self, mock_get_contacts, mock_get_groups):
+        mock_get_groups.return_value = [TembaGroup.create(uuid='G-007', name="New group", size=2)]
+        mock_get_contacts.return_value = [TembaContact.create(uuid='C-007', name="Ken", urns=['tel:234'],
+                                                              groups=['G-007'], fields=dict(chat_name="ken"),
+                                                              language='eng', modified_on=timezone.now())]
+
+        # forbidden response if you don't include secret token
+        self.assertEqual(self.post_events([], token='').status_code, 403)
+
+        # bad request if body isn't an array of events
+        self.assertEqual(self.post_events({'entity': 'message'}).status_code, 400)
+
+        events = [{'entity': 'message', 'action': 'new', 'contact': 'C-001', 'text': "Hello", 'group': 'G-001'},
+                  {'entity': 'message', 'action': 'new', 'contact': 'C-002', 'text': "Hi", 'group': 'G-001'},
+                  {'entity': 'message', 'action': 'new', 'contact': 'C-007', 'text': "Howdy", 'group': 'G-007'},
+                  {'entity': 'message', 'action': 'new', 'contact': 'C-001'},
+                  {'entity': 'contact', 'action': 'new', 'contact': 'C-003', 'group': 'G-001'},
+                  {'entity': 'contact', 'action': 'del', 'contact': 'C-004'},
+                  {'entity': 'group', 'action': 'new'}]
+
+        response = self.post_events(events)
+        self.assertEqual(response.status_code, 200)
+
+        msg1 = Message.objects.get(text="Hello")
+        msg2 = Message.objects.get(text="Hi")
+        msg3 = Message.objects.get(text="Howdy")
+        new_room = Room.objects.get(uuid='G-007', name="New group")
+        new_contact = Contact.objects.get(uuid='C-007', full_name="Ken", room=new_room)
+
+        self.assertEqual((msg1.contact, msg1.room), (self.contact1, self.room1))
+        self.assertEqual((msg2.contact, msg2.room), (self.contact2, self.room1))
+        self.assertEqual((msg3.contact, msg3.room), (new_contact, new_room))
+
+        self.assertEqual(json.loads(response.content)['results'], [
+            {'status': 'ok', 'message': msg1.pk},
+            {'status': 'ok', 'message': msg2.pk},
+            {'status': 'ok', 'message': msg3.pk},
+            {'status': 'error', 'error': "Missing contact, text, group parameter"},
+            {'status': 'ok'},
+            {'status': 'ok'},
+            {'status': 'error', 'error': "Unsupported entity or action"}
+        ])
+
+        # contact moved to the room of its event, and deleted contact de-activated
+        self.assertEqual(Contact.objects.get(pk=self.contact3.pk).room, self.room1)
+        self.assertFalse(Contact.objects.get(pk=self.contact4.pk).is_active)
+
+        # only missing rooms and contacts are fetched, each with a single call
+        mock_get_groups.assert_called_once_with(uuids=['G-007'])
+        mock_get_contacts.assert_called_once_with(uuids=['C-007'])
+
+        # a repeat batch needs no API calls, and its messages are inserted at once
+        mock_get_groups.reset_mock()
+        mock_get_contacts.reset_mock()
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.post_events(events[:3])
+
+        inserts = [q for q in captured.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual([r['status'] for r in json.loads(response.content)['results']], ['ok', 'ok', 'ok'])
+        self.assertEqual(Message.objects.filter(text__in=["Hello", "Hi", "Howdy"]).count(), 6)
+        self.assertFalse(mock_get_groups.called)
+        self.assertFalse(mock_get_contacts.called)
+
+
+@override_settings(WEBHOOK_QUEUE_EVENTS=True,
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WebhookQueueTest(ChatProTest):
+    def setUp(self):
+        super(WebhookQueueTest, self).setUp()
+
+        self.redis = self.use_redis('chatpro.api.queue', *[key % self.unicef.pk for key in (EVENT_QUEUE_KEY,
+                                                                                              EVENT_PROCESSING_KEY,
+                                                                                              EVENT_FAILED_KEY)])
+
+    @patch('chatpro.api.views.schedule_drain')
+    def test_queue_and_drain(self, mock_schedule_drain):
+        url = reverse('api.temba_handler', kwargs=dict(entity='message', action='new'))
+
+        # invalid events are still rejected immediately
+        response = self.url_post('unicef', '%s?%s' % (url, 'text=Hello&group=G-001&token=1234567890'))
+        self.assertEqual(response.status_code, 400)
+
+        # valid events are queued without being processed
+        response = self.url_post('unicef', '%s?%s' % (url, 'contact=C-001&text=Hello&group=G-001&token=1234567890'))
+        self.assertEqual(response.status_code, 202)
+
+        response = self.client.post('%s?token=1234567890' % reverse('api.temba_batch_handler'),
+                                    json.dumps([{'entity': 'message', 'action': 'new', 'contact': 'C-002',
+                                                 'text': "Hi", 'group': 'G-001'},
+                                                {'entity': 'message', 'action': 'new'}]),
+                                    content_type='application/json', HTTP_HOST='unicef.localhost')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([r['status'] for r in json.loads(response.content)['results']], ['queued', 'error'])
+
+        self.assertFalse(Message.objects.filter(text__in=["Hello", "Hi"]).exists())
+        self.assertEqual(get_queue_status(self.unicef)[0], 2)
+        mock_schedule_drain.assert_called_with(self.unicef.pk)
+
+        # draining processes events in the order they were received
+        drain_org_events(self.unicef.pk)
+
+        self.assertEqual([m.text for m in Message.objects.filter(text__in=["Hello", "Hi"]).order_by('pk')],
+                         ["Hello", "Hi"])
+        self.assertEqual(get_queue_status(self.unicef), (0, 0))
+
+        result = self.unicef.get_task_result(TaskType.ingest_events)
+        self.assertEqual(result['counts'], {'processed': 2, 'failed': 0})
+
+        # events left on the processing list by an interrupted drain are recovered
+        self.redis.lpush(EVENT_PROCESSING_KEY % self.unicef.pk, json.dumps({
+            'event': {'entity': 'contact', 'action': 'del', 'contact': 'C-001'}, 'received_on': 0
+        }))
+
+        drain_org_events(self.unicef.pk)
+
+        self.assertFalse(Contact.objects.get(pk=self.contact1.pk).is_active)
+        self.assertEqual(self.redis.llen(EVENT_PROCESSING_KEY % self.unicef.pk), 0)
+
+        # events from a batch which can't be processed are kept aside
+        self.url_post('unicef', '%s?%s' % (url, 'contact=C-001&text=Oops&group=G-001&token=1234567890'))
+
+        with patch('chatpro.api.batch.process_events') as mock_process_events:
+            mock_process_events.side_effect = ValueError("Boom")
+            drain_org_events(self.unicef.pk)
+
+        self.assertEqual(get_queue_status(self.unicef)[0], 0)
+        self.assertEqual(self.redis.llen(EVENT_FAILED_KEY % self.unicef.pk), 1)
+
+        result = self.unicef.get_task_result(TaskType.ingest_events)
+        self.assertEqual(result['counts'], {'processed': 0, 'failed': 1})
+
+        # batches are applied atomically, so a batch which fails part way through leaves nothing behind
+        def process_then_fail(org, events):
+            process_events(org, events)
+            raise ValueError("Boom")
+
+        self.url_post('unicef', '%s?%s' % (url, 'contact=C-002&text=Partial&group=G-001&token=1234567890'))
+
+        with patch('chatpro.api.batch.process_events') as mock_process_events:
+            mock_process_events.side_effect = process_then_fail
+            drain_org_events(self.unicef.pk)
+
+        self.assertFalse(Message.objects.filter(text="Partial").exists())
+        self.assertEqual(self.redis.llen(EVENT_FAILED_KEY % self.unicef.pk), 2)
+
+        # failed events can be requeued, and are then processed in the order they were received
+        with patch('chatpro.api.management.commands.requeue_events.schedule_drain') as mock_requeue_schedule_drain:
+            call_command('requeue_events', str(self.unicef.pk))
+            mock_requeue_schedule_drain.assert_called_once_with(self.unicef.pk)
+
+        self.assertEqual(self.redis.llen(EVENT_FAILED_KEY % self.unicef.pk), 0)
+
+        drain_org_events(self.unicef.pk)
+
+        self.assertEqual([m.text for m in Message.objects.filter(text__in=["Oops", "Partial"]).order_by('pk')],
+                         ["Oops", "Partial"])
+        self.assertEqual(get_queue_status(self.unicef), (0, 0))
+
+    @patch('chatpro.api.tasks.drain_org_events.apply_async')
+    def test_drain_when_locked(self, mock_apply_async):
+        cache.add(DRAIN_LOCK_KEY % self.unicef.pk, True, DRAIN_LOCK_TTL)
+
+        # drain that finds another drain running tries again after a delay rather than immediately
+        drain_org_events(self.unicef.pk)
+        mock_apply_async.assert_called_once_with(args=(self.unicef.pk,), countdown=DRAIN_RETRY_DELAY)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class LookupCacheTest(ChatProTest):
+
+    def test_lru_cache(self):
+        lru = LRUCache(max_size=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+
+        # least recently used entry is evicted
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+        # expired entries aren't returned
+        with patch('chatpro.utils.lookups.time.time', return_value=0):
+            lru.set('d', 4)
+        self.assertIsNone(lru.get('d'))
+
+    @patch.object(ModelLookupCache, 'STATS_FLUSH_EVERY', 1)
+    def test_lookups(self):
+        stats_before = room_lookups.get_stats()
+
+        room = room_lookups.get(self.unicef, 'G-001')
+        self.assertEqual((room.pk, room.name, room.org), (self.room1.pk, "Cars", self.unicef))
+
+        # repeat lookups are served from the in-process cache, then from the shared cache, without queries
+        with self.assertNumQueries(0):
+            room_lookups.get(self.unicef, 'G-001')
+            room_lookups.local.clear()
+            room_lookups.get(self.unicef, 'G-001')
+
+        stats = room_lookups.get_stats()
+        self.assertEqual({stat: count - stats_before[stat] for stat, count in stats.items()},
+                         {'local_hits': 1, 'shared_hits': 1, 'misses': 1})
+
+        # saving an instance invalidates it
+        self.room1.name = "Trucks"
+        self.room1.save()
+        self.assertEqual(room_lookups.get(self.unicef, 'G-001').name, "Trucks")
+
+        # lookups are scoped by org, and missing instances aren't cached
+        self.assertIsNone(room_lookups.get(self.nyaruka, 'G-001'))
+        self.assertIsNone(contact_lookups.get(self.unicef, 'C-007'))
+        self.create_contact(self.unicef, "Ken", "ken", "tel:234", self.room1, 'C-007')
+        self.assertEqual(contact_lookups.get(self.unicef, 'C-007').chat_name, "ken")
+
+        # bulk updates by the batch handler also invalidate
+        contact = contact_lookups.get(self.unicef, 'C-001')
+        self.assertTrue(contact.is_active)
+
+        response = self.client.post('%s?token=1234567890' % reverse('api.temba_batch_handler'),
+                                    json.dumps([{'entity': 'contact', 'action': 'del', 'contact': 'C-001'}]),
+                                    content_type='application/json', HTTP_HOST='unicef.localhost')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(contact_lookups.get(self.unicef, 'C-001').is_active)
@@ -1,9 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 
 from django.conf.urls import patterns, url
-from .views import TembaHandler
+from .views import TembaHandler, TembaBatchHandler
 
 urlpatterns = patterns('',
                        url(r'^(?P<entity>message|contact)/(?P<action>new|del)/',
                            TembaHandler.as_view(),
-                           name='api.temba_handler'))
\ No newline at end of file
+                           name='api.temba_handler'),
+                       url(r'^batch/$', TembaBatchHandler.as_view(), name='api.temba_batch_handler'))
\ No newline at end of file
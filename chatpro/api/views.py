@@ -1,30 +1,72 @@
 from __future__ import absolute_import, unicode_literals
 
-from chatpro.profiles.models import Contact
-from chatpro.rooms.models import Room
+import json
+
+from chatpro.profiles.models import Contact, contact_lookups
+from chatpro.rooms.models import Room, room_lookups
+from chatpro.utils import single_flight
 from chatpro.msgs.models import Message
+from django.conf import settings
 from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
+from .batch import EVENT_PARAMS, process_events, validate_event
+from .queue import queue_events
+from .tasks import schedule_drain
 
 
-class TembaHandler(View):
+class BaseTembaHandler(View):
+    """
+    Base for views which handle webhook calls from the Temba instance, which are authenticated by the org's secret
+    token
+    """
     @csrf_exempt
     def dispatch(self, *args, **kwargs):
-        return super(TembaHandler, self).dispatch(*args, **kwargs)
+        return super(BaseTembaHandler, self).dispatch(*args, **kwargs)
 
     def get(self, request, *args, **kwargs):
         return HttpResponseNotAllowed(('POST',))
 
     def post(self, request, *args, **kwargs):
-        entity = kwargs['entity'].lower()
-        action = kwargs['action'].lower()
         org = request.org
 
         token = request.REQUEST.get('token', None)
         if org.get_secret_token() != token:
             return HttpResponseForbidden("Secret token not provided or incorrect")
 
+        return self.handle(request, org, *args, **kwargs)
+
+    def handle(self, request, org, *args, **kwargs):  # pragma: no cover
+        raise NotImplementedError()
+
+    @staticmethod
+    def queue_events(org, events):
+        """
+        Queues the given events to be processed in the background, returning false if they should be processed now
+        """
+        if settings.WEBHOOK_QUEUE_EVENTS and queue_events(org, events):
+            schedule_drain(org.pk)
+            return True
+
+        return False
+
+
+class TembaHandler(BaseTembaHandler):
+    def handle(self, request, org, *args, **kwargs):
+        entity = kwargs['entity'].lower()
+        action = kwargs['action'].lower()
+
+        if settings.WEBHOOK_QUEUE_EVENTS:
+            event = dict(entity=entity, action=action)
+            event.update({p: request.REQUEST.get(p, None) for p in EVENT_PARAMS.get((entity, action), ())})
+
+            error = validate_event(event)
+            if error:
+                return HttpResponseBadRequest(error)
+
+            if self.queue_events(org, [event]):
+                return JsonResponse({}, status=202)
+
         if entity == 'message' and action == 'new':
             contact_uuid = request.REQUEST.get('contact', None)
             text = request.REQUEST.get('text', None)
@@ -65,14 +107,18 @@ class TembaHandler(View):
         """
         Gets a room by group UUID, or creates it by fetching from Temba instance
         """
-        room = Room.objects.filter(org=org, uuid=group_uuid).first()
+        room = room_lookups.get(org, group_uuid)
         if room:
             if not room.is_active:
                 room.is_active = True
                 room.save(update_fields=('is_active',))
         else:
-            temba_group = org.get_temba_client().get_group(group_uuid)
-            room = Room.create(org, temba_group.name, temba_group.uuid)
+            def fetch():
+                temba_group = org.get_temba_client().get_group(group_uuid)
+                return Room.get_or_create(org, temba_group.name, temba_group.uuid)
+
+            room = single_flight('org:%d:group:%s' % (org.pk, group_uuid), fetch,
+                                 lambda: Room.objects.filter(org=org, uuid=group_uuid).first())
 
         return room
 
@@ -81,7 +127,7 @@ class TembaHandler(View):
         """
         Gets a contact by UUID, or creates it by fetching from Temba instance
         """
-        contact = Contact.objects.filter(org=org, uuid=contact_uuid).first()
+        contact = contact_lookups.get(org, contact_uuid)
         if contact:
             if not contact.is_active or contact.room_id != room.pk:
                 contact.is_active = True
@@ -90,8 +136,13 @@ class TembaHandler(View):
 
             return contact
         else:
-            temba_contact = org.get_temba_client().get_contact(contact_uuid)
-            return Contact.objects.create(**Contact.kwargs_from_temba(org, temba_contact))
+            # concurrent webhooks for the same new contact share a single fetch from RapidPro
+            def fetch():
+                temba_contact = org.get_temba_client().get_contact(contact_uuid)
+                return Contact.get_or_create_from_temba(org, temba_contact)
+
+            return single_flight('org:%d:contact:%s' % (org.pk, contact_uuid), fetch,
+                                 lambda: Contact.objects.filter(org=org, uuid=contact_uuid).first())
 
     @staticmethod
     def _del_contact(org, contact_uuid):
@@ -102,3 +153,27 @@ class TembaHandler(View):
         if contact:
             contact.is_active = False
             contact.save(update_fields=('is_active',))
+
+
+class TembaBatchHandler(BaseTembaHandler):
+    """
+    Handles a batch of message and contact events posted as a JSON array, responding with a result for each event
+    """
+    def handle(self, request, org, *args, **kwargs):
+        try:
+            events = json.loads(request.body)
+        except ValueError:
+            events = None
+
+        if not isinstance(events, list):
+            return HttpResponseBadRequest("Request body must be a JSON array of events")
+
+        if settings.WEBHOOK_QUEUE_EVENTS:
+            # only queue valid events so that errors can still be reported in the response
+            results = [{'status': 'error', 'error': error} if error else {'status': 'queued'}
+                       for error in [validate_event(event) for event in events]]
+
+            if self.queue_events(org, [e for e, result in zip(events, results) if result['status'] == 'queued']):
+                return JsonResponse({'results': results}, status=202)
+
+        return JsonResponse({'results': process_events(org, events)})
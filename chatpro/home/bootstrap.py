@@ -0,0 +1,114 @@
+"""
+The initial state of the chat page, i.e. the first page of messages and the participants of each of the user's rooms,
+which is embedded in the page so that it can be rendered without the app having to make any requests for each room.
+
+The state is built with a fixed number of queries regardless of the number of rooms, and is cached per user for a
+short while. It records the time it was built, from which the app then fetches changes, so a cached state is never
+missing any messages.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from chatpro.msgs.models import Message, ReadMarker
+from chatpro.msgs.recent import get_recent_pages
+from chatpro.profiles.models import Contact
+from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import get_roster_versions
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from temba.utils import format_iso8601
+
+BOOTSTRAP_CACHE_KEY = 'user:%d:org:%d:chat_bootstrap'
+BOOTSTRAP_CACHE_TTL = 60  # 1 minute
+
+BOOTSTRAP_PAGE_SIZE = 10  # same as the message list view
+
+
+def get_bootstrap(user, org, rooms):
+    """
+    Gets the initial state of the chat page for the given user and their rooms in the given org
+    """
+    room_ids = [room.pk for room in rooms]
+    key = BOOTSTRAP_CACHE_KEY % (user.pk, org.pk)
+
+    bootstrap = cache.get(key)
+    if bootstrap is None or bootstrap['room_ids'] != room_ids:
+        # versions are read first so that participants are at least as new as their versions
+        roster_versions = get_roster_versions(room_ids)
+
+        bootstrap = dict(room_ids=room_ids,
+                         since=format_iso8601(timezone.now()),
+                         messages=get_message_pages(org, room_ids, BOOTSTRAP_PAGE_SIZE),
+                         participants=get_participants(room_ids),
+                         roster_versions=roster_versions)
+        cache.set(key, bootstrap, BOOTSTRAP_CACHE_TTL)
+
+    # unread counts change whenever the user reads a room, so are never cached
+    return dict(bootstrap, unread=ReadMarker.get_unread_counts(user, rooms))
+
+
+def bootstrap_to_json(bootstrap):
+    """
+    Serializes the given initial state for embedding in a script element
+    """
+    encoded = json.dumps(bootstrap, cls=DjangoJSONEncoder)
+    return encoded.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+
+
+def get_message_pages(org, room_ids, limit):
+    """
+    Gets the first page of messages in each of the given rooms, as a map of room ids to dicts of results and has_older.
+    Pages are read from the rooms' recent message buffers where possible, and the rest are fetched with two queries.
+    """
+    pages = get_recent_pages(room_ids, limit)
+
+    unbuffered_ids = [room_id for room_id in room_ids if room_id not in pages]
+    if unbuffered_ids:
+        pages.update(_fetch_message_pages(org, unbuffered_ids, limit))
+
+    return {room_id: dict(results=results, has_older=has_older) for room_id, (results, has_older) in pages.items()}
+
+
+def get_participants(room_ids):
+    """
+    Gets the contacts and users in each of the given rooms, as a map of room ids to lists of participants
+    """
+    participants = {room_id: [] for room_id in room_ids}
+
+    for contact in Contact.objects.filter(room_id__in=room_ids, is_active=True).order_by('full_name'):
+        participants[contact.room_id].append(contact.as_participant_json())
+
+    memberships = Room.users.through.objects.filter(room_id__in=room_ids, user__is_active=True)
+    for membership in memberships.select_related('user__profile').order_by('user__profile__full_name'):
+        participants[membership.room_id].append(membership.user.profile.as_participant_json())
+
+    return participants
+
+
+def _fetch_message_pages(org, room_ids, limit):
+    """
+    Fetches the first page of messages in each of the given rooms from the database, by first finding the id of the
+    message just beyond each room's page, and then fetching every message in the rooms from that id
+    """
+    floors = Room.objects.filter(pk__in=room_ids).extra(
+        select={'page_floor': 'SELECT m.id FROM %s m WHERE m.org_id = %s.org_id AND m.room_id = %s.id '
+                              'ORDER BY m.id DESC LIMIT 1 OFFSET %%s' % (Message._meta.db_table,
+                                                                         Room._meta.db_table,
+                                                                         Room._meta.db_table)},
+        select_params=(limit,)).values_list('pk', 'page_floor')
+
+    page_filter = Q(pk=None)
+    for room_id, floor in floors:
+        page_filter |= Q(room_id=room_id, pk__gte=floor) if floor is not None else Q(room_id=room_id)
+
+    messages = Message.objects.filter(page_filter, org=org).select_related('user__profile', 'contact')
+
+    room_messages = {room_id: [] for room_id in room_ids}
+    for msg in messages.order_by('-pk'):
+        room_messages[msg.room_id].append(msg)
+
+    return {room_id: ([msg.as_json() for msg in msgs[:limit]], len(msgs) > limit)
+            for room_id, msgs in room_messages.items()}
@@ -1,7 +1,13 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+
+from chatpro.msgs.models import Message
 from chatpro.test import ChatProTest
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .bootstrap import get_bootstrap, get_message_pages
 
 
 class HomeViewTest(ChatProTest):
@@ -42,3 +48,42 @@ class HomeViewTest(ChatProTest):
         # try to specify an initial room we don't have access to
         response = self.url_get('unicef', reverse('home.chat_in', args=[self.room3.pk]))
         self.assertEqual(response.status_code, 403)
+
+    def test_chat_bootstrap(self):
+        for m in range(12):
+            Message.create_for_contact(self.unicef, self.contact1, "Hello %d" % m, self.room1)
+        msg = Message.create_for_contact(self.unicef, self.contact3, "Hi", self.room2)
+
+        self.login(self.user1)
+
+        response = self.url_get('unicef', reverse('home.chat'))
+        self.assertEqual(response.status_code, 200)
+
+        bootstrap = response.context['bootstrap']
+        self.assertEqual(bootstrap['room_ids'], [self.room2.pk, self.room1.pk])
+        self.assertEqual([m['text'] for m in bootstrap['messages'][self.room1.pk]['results']],
+                         ["Hello %d" % m for m in range(11, 1, -1)])
+        self.assertTrue(bootstrap['messages'][self.room1.pk]['has_older'])
+        self.assertEqual([m['id'] for m in bootstrap['messages'][self.room2.pk]['results']], [msg.pk])
+        self.assertFalse(bootstrap['messages'][self.room2.pk]['has_older'])
+        self.assertEqual(bootstrap['participants'][self.room1.pk], [self.contact1.as_participant_json(),
+                                                                    self.contact2.as_participant_json(),
+                                                                    self.user1.profile.as_participant_json()])
+        self.assertEqual(bootstrap['unread'], {self.room1.pk: 12, self.room2.pk: 1})
+
+        # page embeds it as JSON
+        self.assertContains(response, 'var chat_bootstrap = ')
+        self.assertEqual(json.loads(response.context['bootstrap_json'])['room_ids'], [self.room2.pk, self.room1.pk])
+
+        # building it takes the same number of queries regardless of the number of rooms
+        with CaptureQueriesContext(connection) as one_room:
+            get_message_pages(self.unicef, [self.room1.pk], 10)
+        with CaptureQueriesContext(connection) as three_rooms:
+            get_message_pages(self.unicef, [self.room1.pk, self.room2.pk, self.room3.pk], 10)
+        self.assertEqual(len(one_room), len(three_rooms))
+
+        # rooms without messages still get an empty page
+        bootstrap = get_bootstrap(self.admin, self.unicef, [self.room3])
+        self.assertEqual(bootstrap['messages'], {self.room3.pk: dict(results=[], has_older=False)})
+        self.assertEqual(bootstrap['participants'], {self.room3.pk: [self.contact5.as_participant_json(),
+                                                                     self.user2.profile.as_participant_json()]})
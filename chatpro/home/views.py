@@ -1,10 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 
 from chatpro.msgs.models import Message, MESSAGE_MAX_LEN
-from chatpro.rooms.models import Room
 from dash.orgs.views import OrgPermsMixin
 from django.core.exceptions import PermissionDenied
 from django.utils.translation import ugettext_lazy as _
+from .bootstrap import get_bootstrap, bootstrap_to_json
 from smartmin.users.views import SmartTemplateView
 
 
@@ -20,19 +20,23 @@ class ChatView(OrgPermsMixin, SmartTemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(ChatView, self).get_context_data(**kwargs)
-        allowed_rooms = self.request.user.get_rooms(self.request.org).order_by('name')
+        allowed_rooms = list(self.request.user.get_rooms(self.request.org).order_by('name'))
 
         if 'room' in self.kwargs:
-            try:
-                initial_room = allowed_rooms.get(pk=self.kwargs['room'])
-            except Room.DoesNotExist:
+            initial_room = next((r for r in allowed_rooms if r.pk == int(self.kwargs['room'])), None)
+            if not initial_room:
                 raise PermissionDenied()
         else:
-            initial_room = allowed_rooms.first()
+            initial_room = allowed_rooms[0] if allowed_rooms else None
 
         msg_text_chars = MESSAGE_MAX_LEN - len(Message.get_user_prefix(self.request.user))
 
         context['rooms'] = allowed_rooms
         context['initial_room'] = initial_room
         context['msg_text_chars'] = msg_text_chars
+
+        # initial state of every room, so the page doesn't need to fetch it room by room
+        if allowed_rooms:
+            context['bootstrap'] = get_bootstrap(self.request.user, self.request.org, allowed_rooms)
+            context['bootstrap_json'] = bootstrap_to_json(context['bootstrap'])
         return context
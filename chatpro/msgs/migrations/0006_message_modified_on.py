@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def populate_modified_on(apps, schema_editor):
+    Message = apps.get_model("msgs", "Message")
+    Message.objects.update(modified_on=models.F('time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0005_auto_20150720_1034'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='modified_on',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When this message was last modified', auto_now=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_modified_on),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('org', 'room', 'id'), ('org', 'time'), ('org', 'modified_on')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rooms', '0003_room_counters'),
+        ('msgs', '0006_message_modified_on'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadMarker',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('read_count', models.IntegerField(default=0, help_text="The room's message count when last read")),
+                ('last_read_id', models.IntegerField(help_text="The room's last message id when last read", null=True)),
+                ('room', models.ForeignKey(related_name='read_markers', to='rooms.Room')),
+                ('user', models.ForeignKey(related_name='read_markers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='readmarker',
+            unique_together=set([('user', 'room')]),
+        ),
+    ]
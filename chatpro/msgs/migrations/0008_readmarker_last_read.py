@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('msgs', '0007_readmarker'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='readmarker',
+            name='last_read_id',
+            field=models.IntegerField(help_text='The id of the last message read in the room', null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='readmarker',
+            name='read_count',
+            field=models.IntegerField(default=0, help_text="The number of the room's messages which have been read"),
+            preserve_default=True,
+        ),
+    ]
@@ -2,12 +2,18 @@ from __future__ import unicode_literals
 
 from chatpro.rooms.models import Room
 from chatpro.profiles.models import Contact
+from chatpro.utils import on_commit
 from dash.orgs.models import Org
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import F
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from .tasks import send_message
+from temba.utils import format_iso8601
+from .recent import buffer_messages
+from .tasks import send_message, schedule_room_send
 
 MESSAGE_MAX_LEN = 140
 
@@ -19,6 +25,10 @@ STATUS_CHOICES = ((STATUS_PENDING, _("Pending")),
                   (STATUS_SENT, _("Sent")),
                   (STATUS_FAILED, _("Failed")))
 
+LAST_MESSAGE_CACHE_KEY = 'room:%d:last_message_id'
+LAST_CHANGE_CACHE_KEY = 'room:%d:last_change'
+LAST_MESSAGE_CACHE_TTL = 60 * 60 * 24  # 1 day
+
 
 class Message(models.Model):
     """
@@ -42,22 +52,147 @@ class Message(models.Model):
     status = models.CharField(max_length=1, verbose_name=_("Status"), choices=STATUS_CHOICES,
                               help_text=_("Current status of this message"))
 
+    modified_on = models.DateTimeField(auto_now=True, help_text=_("When this message was last modified"))
+
+    class Meta:
+        index_together = (('org', 'room', 'id'), ('org', 'time'), ('org', 'modified_on'))
+
     @classmethod
     def create_for_contact(cls, org, contact, text, room):
-        return cls.objects.create(org=org, contact=contact, text=text, room=room,
-                                  time=timezone.now(), status=STATUS_SENT)
+        # the message and its room's counters are committed together, so that read markers see both or neither
+        with transaction.atomic():
+            msg = cls.objects.create(org=org, contact=contact, text=text, room=room,
+                                     time=timezone.now(), status=STATUS_SENT)
+
+            cls.record_in_rooms([msg])
+            msg.announce()
+        return msg
 
     @classmethod
     def create_for_user(cls, org, user, text, room):
         if not user.profile:  # pragma: no cover
             raise ValueError("User does not have a chat profile")
 
-        msg = cls.objects.create(org=org, user=user, text=text, room=room,
-                                 time=timezone.now(), status=STATUS_PENDING)
+        with transaction.atomic():
+            msg = cls.objects.create(org=org, user=user, text=text, room=room,
+                                     time=timezone.now(), status=STATUS_PENDING)
+
+            cls.record_in_rooms([msg])
+            ReadMarker.record_own_message(user, room)
+            msg.announce()
+
+        if settings.MESSAGE_SEND_BATCH_WINDOW:
+            schedule_room_send(room.pk)
+        else:
+            send_message.delay(msg.pk)
 
-        send_message.delay(msg.pk)
         return msg
 
+    @classmethod
+    def get_last_ids(cls, room_ids):
+        """
+        Gets the last announced message id of each of the given rooms, without touching the database
+        """
+        return cls._get_room_markers(LAST_MESSAGE_CACHE_KEY, room_ids)
+
+    @classmethod
+    def get_last_changes(cls, room_ids):
+        """
+        Gets the last announced change (as a change marker) of each of the given rooms, without touching the database
+        """
+        return cls._get_room_markers(LAST_CHANGE_CACHE_KEY, room_ids)
+
+    @staticmethod
+    def get_change_marker(modified_on, message_id):
+        """
+        Gets a string for a change to a message which sorts in the same order as (modified_on, id), so that announced
+        changes can be compared with a changes cursor
+        """
+        return '%s#%012d' % (format_iso8601(modified_on), message_id)
+
+    @staticmethod
+    def _get_room_markers(key_format, room_ids):
+        keys = {key_format % room_id: room_id for room_id in room_ids}
+        markers = cache.get_many(keys.keys())
+        return {keys[key]: marker for key, marker in markers.items()}
+
+    @classmethod
+    def bulk_create_for_contacts(cls, org, items):
+        """
+        Creates messages from a list of (contact, text, room) tuples, with a single insert. Returns the created
+        messages in the same order.
+        """
+        if not items:
+            return []
+
+        now = timezone.now()
+        cls.objects.bulk_create([cls(org=org, contact=contact, text=text, room=room, time=now, status=STATUS_SENT)
+                                 for contact, text, room in items])
+
+        # bulk_create doesn't set primary keys, so fetch the messages back by their shared creation time, and match
+        # them to items by their contact, room and text. Identical items are interchangeable.
+        contact_ids = {contact.pk for contact, text, room in items}
+        created = cls.objects.filter(org=org, contact_id__in=contact_ids, time=now).select_related('contact')
+
+        by_item = {}
+        for msg in created.order_by('pk'):
+            by_item.setdefault((msg.contact_id, msg.room_id, msg.text), []).append(msg)
+
+        messages = []
+        for contact, text, room in items:
+            matches = by_item.get((contact.pk, room.pk, text))
+            if not matches:
+                raise ValueError("Created message for contact #%d in room #%d not found" % (contact.pk, room.pk))
+            messages.append(matches.pop(0))
+
+        if any(by_item.values()):
+            raise ValueError("Found more created messages than were inserted")
+
+        cls.record_in_rooms(messages)
+        cls.announce_all(messages)
+        return messages
+
+    @staticmethod
+    def record_in_rooms(messages):
+        """
+        Updates the message counters of the rooms of the given new messages
+        """
+        by_room = {}
+        for msg in messages:
+            by_room.setdefault(msg.room_id, []).append(msg)
+
+        for room_id, room_messages in by_room.items():
+            Room.record_messages(room_id, len(room_messages), max(room_messages, key=lambda m: m.pk))
+
+    @classmethod
+    def announce_all(cls, messages, is_new=True):
+        """
+        Writes new or changed messages through to their rooms' recent buffers, and updates their rooms' markers so
+        that waiting pollers can be woken. Both happen only once the messages have been committed, so that buffers
+        never hold messages which were rolled back and pollers never wake to find nothing.
+        """
+        markers = {}
+        for msg in messages:
+            change_key = LAST_CHANGE_CACHE_KEY % msg.room_id
+            markers[change_key] = max(markers.get(change_key, ''), cls.get_change_marker(msg.modified_on, msg.pk))
+
+            if is_new:
+                last_id_key = LAST_MESSAGE_CACHE_KEY % msg.room_id
+                markers[last_id_key] = max(markers.get(last_id_key, 0), msg.pk)
+
+        def announce():
+            buffer_messages(messages)
+            if markers:
+                cache.set_many(markers, LAST_MESSAGE_CACHE_TTL)
+
+        on_commit(announce)
+
+    def announce(self, is_new=True):
+        """
+        Writes this new or changed message through to its room's recent buffer, and updates its room's markers
+        """
+        self.announce_all([self], is_new)
+
     def is_user_message(self):
         return bool(self.user_id)
 
@@ -69,4 +204,91 @@ class Message(models.Model):
         participant = self.user.profile if self.is_user_message() else self.contact
 
         return dict(id=self.pk, sender=participant.as_participant_json(), text=self.text, room_id=self.room_id,
-                    time=self.time, status=self.status)
\ No newline at end of file
+                    time=self.time, status=self.status)
+
+
+class ReadMarker(models.Model):
+    """
+    How far a user has read the messages in a room, as the last message id they have read and how many of the room's
+    messages they have read, i.e. those up to that message and their own messages since. Unread counts are then the
+    difference between the room's current message count and the marker's count.
+    """
+    user = models.ForeignKey(User, related_name='read_markers')
+
+    room = models.ForeignKey(Room, related_name='read_markers')
+
+    read_count = models.IntegerField(default=0, help_text=_("The number of the room's messages which have been read"))
+
+    last_read_id = models.IntegerField(null=True, help_text=_("The id of the last message read in the room"))
+
+    class Meta:
+        unique_together = ('user', 'room')
+
+    @classmethod
+    def mark_read(cls, user, rooms, last_read_id=None):
+        """
+        Marks the messages in the given rooms up to the given message id as read by the given user, or all the current
+        messages if no id is given. Markers never move backwards.
+        """
+        existing = {m.room_id: m for m in cls.objects.filter(user=user, room__in=rooms)}
+
+        to_mark, to_create = [], []
+        for room in rooms:
+            read_id = room.last_message_id
+            if read_id is not None and last_read_id is not None:
+                read_id = min(read_id, last_read_id)
+
+            marker = existing.get(room.pk)
+            if read_id is not None and (not marker or marker.last_read_id is None or marker.last_read_id < read_id):
+                to_mark.append((room, read_id))
+                if not marker:
+                    to_create.append(cls(user=user, room=room))
+
+        if to_create:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(to_create)
+            except IntegrityError:  # some were created concurrently
+                for marker in to_create:
+                    cls.objects.get_or_create(user=user, room=marker.room)
+
+        # the room's message count and the messages after the read message are read by one statement, so that a
+        # message which arrives in between can't be included in one but not the other
+        quote = connection.ops.quote_name
+        sql = ('UPDATE %(marker)s SET %(last_read_id)s = %%s, %(read_count)s = '
+               '(SELECT r.%(message_count)s FROM %(room)s r WHERE r.%(id)s = %%s) - '
+               '(SELECT COUNT(*) FROM %(message)s m WHERE m.%(org_id)s = %%s AND m.%(room_id)s = %%s '
+               'AND m.%(id)s > %%s AND (m.%(user_id)s IS NULL OR m.%(user_id)s <> %%s)) '
+               'WHERE %(user_id)s = %%s AND %(room_id)s = %%s AND (%(last_read_id)s IS NULL OR %(last_read_id)s < %%s)'
+               % dict(marker=quote(cls._meta.db_table), room=quote(Room._meta.db_table),
+                      message=quote(Message._meta.db_table), last_read_id=quote('last_read_id'),
+                      read_count=quote('read_count'), message_count=quote('message_count'), id=quote('id'),
+                      org_id=quote('org_id'), room_id=quote('room_id'), user_id=quote('user_id')))
+
+        with connection.cursor() as cursor:
+            for room, read_id in to_mark:
+                cursor.execute(sql, [read_id, room.pk, room.org_id, room.pk, read_id, user.pk,
+                                     user.pk, room.pk, read_id])
+
+    @classmethod
+    def record_own_message(cls, user, room):
+        """
+        Records that the given user has sent a message to the given room, which they have read by definition
+        """
+        if cls.objects.filter(user=user, room=room).update(read_count=F('read_count') + 1):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(user=user, room=room, read_count=1)
+        except IntegrityError:  # created concurrently
+            cls.objects.filter(user=user, room=room).update(read_count=F('read_count') + 1)
+
+    @classmethod
+    def get_unread_counts(cls, user, rooms):
+        """
+        Gets the number of messages in each of the given rooms which the given user hasn't read, without counting
+        messages
+        """
+        read_counts = dict(cls.objects.filter(user=user, room__in=rooms).values_list('room_id', 'read_count'))
+        return {room.pk: max(room.message_count - read_counts.get(room.pk, 0), 0) for room in rooms}
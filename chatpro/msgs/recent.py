@@ -0,0 +1,201 @@
+"""
+Bounded per-room buffers of the most recent serialized messages, kept in Redis as sorted sets scored by message id.
+Buffered messages only reference their senders, which are looked up when messages are read, so that renamed contacts
+and users are never served with their old names.
+
+A buffer is authoritative for every message newer than its floor. The floor is stored as a sentinel member when the
+buffer is primed from the database, and once trimming has dropped the sentinel, the buffer is full and authoritative
+from its oldest message.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from chatpro.utils import get_redis_connection
+from django.core.serializers.json import DjangoJSONEncoder
+
+RECENT_MESSAGES_KEY = 'room:%d:recent_messages'
+RECENT_MESSAGES_SIZE = 50
+RECENT_MESSAGES_TTL = 60 * 60 * 24  # 1 day
+
+FLOOR_SENTINEL = '-'
+
+
+def buffer_message(msg):
+    """
+    Writes a new or updated message through to its room's buffer
+    """
+    buffer_messages([msg])
+
+
+def buffer_messages(messages):
+    """
+    Writes new or updated messages through to their rooms' buffers
+    """
+    r = get_redis_connection()
+    if not r or not messages:
+        return
+
+    keys = set()
+
+    with r.pipeline() as pipe:
+        for msg in messages:
+            key = RECENT_MESSAGES_KEY % msg.room_id
+            pipe.zremrangebyscore(key, msg.pk, msg.pk)
+            pipe.zadd(key, msg.pk, _serialize(msg))
+            keys.add(key)
+
+        for key in keys:
+            pipe.zremrangebyrank(key, 0, -(RECENT_MESSAGES_SIZE + 2))  # +1 for the floor sentinel
+            pipe.expire(key, RECENT_MESSAGES_TTL)
+
+        pipe.execute()
+
+
+def prime_room_buffer(room_id):
+    """
+    Primes the given room's buffer with its newest messages from the database
+    """
+    from .models import Message
+
+    r = get_redis_connection()
+    if not r:
+        return
+
+    messages = Message.objects.filter(room_id=room_id).order_by('-pk')
+    messages = list(messages[:RECENT_MESSAGES_SIZE + 1])
+
+    if len(messages) > RECENT_MESSAGES_SIZE:
+        floor = messages.pop().pk
+    else:
+        floor = 0
+
+    key = RECENT_MESSAGES_KEY % room_id
+    existing = {int(score) for member, score in r.zrange(key, 0, -1, withscores=True) if member != FLOOR_SENTINEL}
+
+    with r.pipeline() as pipe:
+        pipe.zremrangebyscore(key, '-inf', floor)
+        pipe.zadd(key, floor, FLOOR_SENTINEL)
+        for msg in messages:
+            # don't overwrite entries which may have been updated since we read from the database
+            if msg.pk not in existing:
+                pipe.zadd(key, msg.pk, _serialize(msg))
+        pipe.zremrangebyrank(key, 0, -(RECENT_MESSAGES_SIZE + 2))
+        pipe.expire(key, RECENT_MESSAGES_TTL)
+        pipe.execute()
+
+
+def get_recent_messages(room_ids, after_id, limit):
+    """
+    Gets up to limit of the newest messages in the given rooms which are newer than after_id (if provided), as a tuple
+    of (messages, has_older). Returns None if the buffers can't answer that authoritatively.
+    """
+    r = get_redis_connection()
+    if not r or not room_ids:
+        return None
+
+    with r.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.zrevrangebyscore(RECENT_MESSAGES_KEY % room_id, '+inf', '-inf', withscores=True)
+        buffers = pipe.execute()
+
+    lower = after_id or 0
+    candidates = []
+
+    for entries in buffers:
+        room_candidates = _get_candidates(entries, lower, limit)
+        if room_candidates is None:
+            return None
+
+        candidates += room_candidates
+
+    messages = sorted([json.loads(c) for c in candidates], key=lambda m: m['id'], reverse=True)
+
+    return _resolve_senders(messages[:limit]), len(messages) > limit
+
+
+def get_recent_pages(room_ids, limit):
+    """
+    Gets the first page of up to limit of the newest messages in each of the given rooms, with a single round trip, as
+    a map of room ids to tuples of (messages, has_older). Rooms whose buffers can't answer that authoritatively are
+    omitted.
+    """
+    r = get_redis_connection()
+    if not r or not room_ids:
+        return {}
+
+    with r.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.zrevrangebyscore(RECENT_MESSAGES_KEY % room_id, '+inf', '-inf', withscores=True)
+        buffers = pipe.execute()
+
+    pages = {}
+    for room_id, entries in zip(room_ids, buffers):
+        candidates = _get_candidates(entries, 0, limit)
+        if candidates is not None:
+            pages[room_id] = [json.loads(c) for c in candidates[:limit]], len(candidates) > limit
+
+    _resolve_senders([msg for messages, has_older in pages.values() for msg in messages])
+    return pages
+
+
+def _get_candidates(entries, lower, limit):
+    """
+    Gets the serialized messages newer than lower from a room's buffer entries, newest first, or None if the buffer
+    can't answer that authoritatively
+    """
+    if not entries:
+        return None
+
+    floor = None
+    candidates = []
+    for member, score in entries:
+        if member == FLOOR_SENTINEL:
+            floor = int(score)
+        elif score > lower:
+            candidates.append(member)
+
+    if floor is None:
+        if len(entries) < RECENT_MESSAGES_SIZE:  # never primed and not yet full
+            return None
+        floor = int(entries[-1][1]) - 1
+
+    # buffer must either cover everything after our lower bound, or have more than a page above it
+    if floor > lower and len(candidates) <= limit:
+        return None
+
+    return candidates
+
+
+def _serialize(msg):
+    """
+    Serializes a message for a buffer, with a reference to its sender rather than the sender itself
+    """
+    sender = dict(id=msg.user_id, type='U') if msg.is_user_message() else dict(id=msg.contact_id, type='C')
+
+    return json.dumps(dict(id=msg.pk, sender=sender, text=msg.text, room_id=msg.room_id, time=msg.time,
+                           status=msg.status), cls=DjangoJSONEncoder)
+
+
+def _resolve_senders(messages):
+    """
+    Replaces the sender references of the given deserialized messages with their current senders, with at most one
+    query each for contacts and users
+    """
+    from chatpro.profiles.models import Contact, Profile
+
+    contact_ids = {m['sender']['id'] for m in messages if m['sender']['type'] == 'C'}
+    user_ids = {m['sender']['id'] for m in messages if m['sender']['type'] == 'U'}
+
+    senders = {}
+    if contact_ids:
+        senders.update({('C', c.pk): c.as_participant_json() for c in Contact.objects.filter(pk__in=contact_ids)})
+    if user_ids:
+        profiles = Profile.objects.filter(user_id__in=user_ids)
+        senders.update({('U', p.user_id): p.as_participant_json() for p in profiles})
+
+    for msg in messages:
+        sender = msg['sender']
+        msg['sender'] = senders.get((sender['type'], sender['id']), dict(sender, full_name=None, chat_name=None))
+
+    return messages
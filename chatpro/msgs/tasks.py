@@ -1,10 +1,22 @@
 from __future__ import unicode_literals
 
+import time
+
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from djcelery_transactions import task
 
 logger = get_task_logger(__name__)
 
+SEND_BATCH_CACHE_KEY = 'room:%d:send_batch_scheduled'
+SEND_BATCH_LOCK_KEY = 'room:%d:send_batch_lock'
+SEND_BATCH_LOCK_TTL = 60 * 5  # 5 minutes
+SEND_BATCH_CLAIM_KEY = 'room:%d:send_batch_claim'
+SEND_BATCH_CLAIM_TTL = 60 * 60 * 24  # 1 day
+
 
 @task
 def send_message(message_id):
@@ -23,11 +35,104 @@ def send_message(message_id):
         client.create_broadcast(text, groups=[message.room.uuid])
 
         message.status = STATUS_SENT
-        message.save(update_fields=('status',))
+        message.save(update_fields=('status', 'modified_on'))
 
         logger.info("Sent message %d from user #%d" % (message.pk, message.user.pk))
     except Exception:
         message.status = STATUS_FAILED
-        message.save(update_fields=('status',))
+        message.save(update_fields=('status', 'modified_on'))
 
         logger.error("Sending message %d failed" % message.pk, exc_info=1)
+
+    message.announce(is_new=False)
+
+
+def schedule_room_send(room_id):
+    """
+    Schedules sending of a room's pending messages at the end of the current batch window, unless that has already
+    been scheduled
+    """
+    batch_window = settings.MESSAGE_SEND_BATCH_WINDOW
+
+    if cache.add(SEND_BATCH_CACHE_KEY % room_id, True, batch_window):
+        send_room_messages.apply_async(args=(room_id,), countdown=batch_window)
+
+
+@task
+def send_room_messages(room_id):
+    """
+    Sends all pending user messages in a room, in order, as a single batch
+    """
+    from .models import Message, STATUS_PENDING, STATUS_SENT, STATUS_FAILED
+
+    # close this batch window so that new messages schedule the next batch
+    cache.delete(SEND_BATCH_CACHE_KEY % room_id)
+
+    # if a previous batch for this room is still being sent, try again later
+    if not cache.add(SEND_BATCH_LOCK_KEY % room_id, True, SEND_BATCH_LOCK_TTL):
+        schedule_room_send(room_id)
+        return
+
+    try:
+        # messages claimed by a batch which died before finishing were left failed, so let clients know
+        abandoned_ids = cache.get(SEND_BATCH_CLAIM_KEY % room_id)
+        if abandoned_ids:
+            abandoned = list(Message.objects.filter(pk__in=abandoned_ids, status=STATUS_FAILED))
+            Message.announce_all(abandoned, is_new=False)
+            cache.delete(SEND_BATCH_CLAIM_KEY % room_id)
+
+            logger.warning("Announced %d messages abandoned by a previous batch for room #%d"
+                           % (len(abandoned), room_id))
+
+        pending = Message.objects.filter(room_id=room_id, status=STATUS_PENDING, user__isnull=False)
+        pending_ids = list(pending.values_list('pk', flat=True))
+        if not pending_ids:
+            return
+
+        # claim the batch as failed before sending it, so that if this worker dies mid-batch, its messages are left
+        # failed rather than being sent again by the next batch. Messages claimed concurrently by another sender
+        # won't have this claim's modification time.
+        claimed_on = timezone.now()
+        Message.objects.filter(pk__in=pending_ids, status=STATUS_PENDING).update(status=STATUS_FAILED,
+                                                                               modified_on=claimed_on)
+        messages = Message.objects.filter(pk__in=pending_ids, status=STATUS_FAILED, modified_on=claimed_on)
+        messages = list(messages.select_related('org', 'room', 'user__profile').order_by('pk'))
+        if not messages:
+            return
+
+        cache.set(SEND_BATCH_CLAIM_KEY % room_id, [m.pk for m in messages], SEND_BATCH_CLAIM_TTL)
+
+        start = time.time()
+        client = messages[0].org.get_temba_client()
+        sent_ids, failed_ids = [], []
+
+        for message in messages:
+            text = "".join([Message.get_user_prefix(message.user), message.text])
+            try:
+                client.create_broadcast(text, groups=[message.room.uuid])
+                message.status = STATUS_SENT
+                sent_ids.append(message.pk)
+            except Exception:
+                message.status = STATUS_FAILED
+                failed_ids.append(message.pk)
+
+                logger.error("Sending message %d failed" % message.pk, exc_info=1)
+
+        now = timezone.now()
+        with transaction.atomic():
+            if sent_ids:
+                Message.objects.filter(pk__in=sent_ids).update(status=STATUS_SENT, modified_on=now)
+            if failed_ids:
+                Message.objects.filter(pk__in=failed_ids).update(status=STATUS_FAILED, modified_on=now)
+
+            for message in messages:
+                message.modified_on = now
+
+            Message.announce_all(messages, is_new=False)
+
+        cache.delete(SEND_BATCH_CLAIM_KEY % room_id)
+
+        logger.info("Sent batch of %d messages (%d failed) for room #%d in %d ms"
+                    % (len(messages), len(failed_ids), room_id, int((time.time() - start) * 1000)))
+    finally:
+        cache.delete(SEND_BATCH_LOCK_KEY % room_id)
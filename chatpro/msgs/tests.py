@@ -1,15 +1,26 @@
 from __future__ import unicode_literals
 
+import gzip
+import json
 import pytz
 
-from chatpro.msgs.models import Message, STATUS_PENDING, STATUS_SENT
+from chatpro.msgs.models import Message, STATUS_PENDING, STATUS_SENT, STATUS_FAILED
+from chatpro.msgs.recent import get_recent_messages, prime_room_buffer, buffer_message, RECENT_MESSAGES_KEY
+from chatpro.msgs.tasks import SEND_BATCH_CLAIM_KEY, send_room_messages
+from chatpro.msgs.views import MessageCRUDL
+from chatpro.rooms.rosters import ROSTER_VERSION_KEY, get_roster_versions
 from chatpro.test import ChatProTest
-from datetime import datetime
-from django.core.urlresolvers import reverse
-from django.test.utils import override_settings
-from mock import patch
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from mock import patch, call
+from StringIO import StringIO
 from temba.types import Broadcast as TembaBroadcast
-from temba.utils import format_iso8601
+from temba.utils import format_iso8601, parse_iso8601
 
 
 class MessageTest(ChatProTest):
@@ -49,10 +60,223 @@ class MessageTest(ChatProTest):
         # async task will have sent the message
         self.assertEqual(Message.objects.get(pk=msg.pk).status, STATUS_SENT)
 
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('dash.orgs.models.TembaClient.create_broadcast')
+    def test_send_room_messages(self, mock_create_broadcast):
+        def create_pending(user, text):
+            return Message.objects.create(org=self.unicef, user=user, text=text, room=self.room1,
+                                          time=timezone.now(), status=STATUS_PENDING)
+
+        msg1 = create_pending(self.user1, "Hello")
+        msg2 = create_pending(self.admin, "Oops")
+        msg3 = create_pending(self.user1, "Bye")
+
+        mock_create_broadcast.side_effect = [TembaBroadcast.create(groups=[self.room1.uuid]),
+                                             Exception("API error"),
+                                             TembaBroadcast.create(groups=[self.room1.uuid])]
+
+        # batch is claimed with one update, and its statuses are set with one update per status
+        with CaptureQueriesContext(connection) as captured:
+            send_room_messages(self.room1.pk)
+            self.assertEqual(len([q for q in captured.captured_queries if q['sql'].startswith('UPDATE')]), 3)
+
+        # messages sent in order through one client
+        self.assertEqual(mock_create_broadcast.call_args_list, [call("sammy: Hello", groups=[self.room1.uuid]),
+                                                                call("richard: Oops", groups=[self.room1.uuid]),
+                                                                call("sammy: Bye", groups=[self.room1.uuid])])
+
+        self.assertEqual(Message.objects.get(pk=msg1.pk).status, STATUS_SENT)
+        self.assertEqual(Message.objects.get(pk=msg2.pk).status, STATUS_FAILED)
+        self.assertEqual(Message.objects.get(pk=msg3.pk).status, STATUS_SENT)
+
+        # nothing left to send
+        mock_create_broadcast.reset_mock()
+        send_room_messages(self.room1.pk)
+        self.assertFalse(mock_create_broadcast.called)
+
+        # messages are claimed before they're sent, so a batch which dies mid-send never sends them again
+        msg5 = create_pending(self.user1, "Once")
+
+        def check_claimed(text, groups):
+            self.assertEqual(Message.objects.get(pk=msg5.pk).status, STATUS_FAILED)
+            return TembaBroadcast.create(groups=groups)
+
+        mock_create_broadcast.side_effect = check_claimed
+        send_room_messages(self.room1.pk)
+        self.assertEqual(Message.objects.get(pk=msg5.pk).status, STATUS_SENT)
+
+        # check batching mode is used when message is created
+        mock_create_broadcast.side_effect = None
+        mock_create_broadcast.return_value = TembaBroadcast.create(groups=[self.room1.uuid])
+
+        with override_settings(MESSAGE_SEND_BATCH_WINDOW=5):
+            with patch('chatpro.msgs.models.send_message.delay') as mock_send_message:
+                msg4 = Message.create_for_user(self.unicef, self.user1, "Batched", self.room1)
+                self.assertFalse(mock_send_message.called)
+
+        mock_create_broadcast.assert_called_once_with("sammy: Batched", groups=[self.room1.uuid])
+        self.assertEqual(Message.objects.get(pk=msg4.pk).status, STATUS_SENT)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('dash.orgs.models.TembaClient.create_broadcast')
+    def test_send_room_messages_abandoned(self, mock_create_broadcast):
+        # a batch claimed this message and then died before setting its status
+        msg = Message.objects.create(org=self.unicef, user=self.user1, text="Lost", room=self.room1,
+                                     time=timezone.now(), status=STATUS_FAILED)
+        cache.set(SEND_BATCH_CLAIM_KEY % self.room1.pk, [msg.pk])
+
+        # the next batch announces it, so clients stop showing it as pending
+        send_room_messages(self.room1.pk)
+
+        self.assertFalse(mock_create_broadcast.called)
+        self.assertEqual(Message.get_last_changes([self.room1.pk]),
+                         {self.room1.pk: Message.get_change_marker(msg.modified_on, msg.pk)})
+        self.assertIsNone(cache.get(SEND_BATCH_CLAIM_KEY % self.room1.pk))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_announce(self):
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        self.assertEqual(Message.get_last_ids([self.room1.pk, self.room2.pk]), {self.room1.pk: msg1.pk})
+
+        # markers aren't updated until the message is committed
+        with transaction.atomic():
+            msg2 = Message.create_for_contact(self.unicef, self.contact1, "Msg 2", self.room1)
+            self.assertEqual(Message.get_last_ids([self.room1.pk]), {self.room1.pk: msg1.pk})
+
+        self.assertEqual(Message.get_last_ids([self.room1.pk]), {self.room1.pk: msg2.pk})
+
+        # and never if it's rolled back
+        try:
+            with transaction.atomic():
+                Message.create_for_contact(self.unicef, self.contact1, "Msg 3", self.room1)
+                raise ValueError("Rollback")
+        except ValueError:
+            pass
+
+        self.assertEqual(Message.get_last_ids([self.room1.pk]), {self.room1.pk: msg2.pk})
+
     def test_get_user_prefix(self):
         self.assertEqual(Message.get_user_prefix(self.superuser), '')
         self.assertEqual(Message.get_user_prefix(self.user1), 'sammy: ')
 
+    def test_bulk_create_for_contacts(self):
+        items = [(self.contact2, "Hi", self.room1),
+                 (self.contact1, "Hello", self.room1),
+                 (self.contact3, "Hi", self.room2),
+                 (self.contact1, "Hello", self.room1)]
+
+        messages = Message.bulk_create_for_contacts(self.unicef, items)
+
+        # messages are returned in the same order as the items, each only once
+        self.assertEqual([(m.contact, m.text, m.room) for m in messages], items)
+        self.assertEqual(len({m.pk for m in messages}), 4)
+        self.assertEqual(Message.objects.filter(org=self.unicef).count(), 4)
+
+
+class RecentMessagesTest(ChatProTest):
+    def setUp(self):
+        super(RecentMessagesTest, self).setUp()
+
+        self.redis = self.use_redis('chatpro.msgs.recent',
+                                    *[RECENT_MESSAGES_KEY % r.pk for r in (self.room1, self.room2, self.room3)])
+
+    def test_buffering(self):
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact2, "Msg 2", self.room1)
+
+        # buffer hasn't been primed and isn't full, so can't answer
+        self.assertIsNone(get_recent_messages([self.room1.pk], None, 10))
+
+        prime_room_buffer(self.room1.pk)
+        prime_room_buffer(self.room2.pk)
+
+        messages, has_older = get_recent_messages([self.room1.pk], None, 10)
+        self.assertEqual([m['id'] for m in messages], [msg2.pk, msg1.pk])
+        self.assertFalse(has_older)
+
+        messages, has_older = get_recent_messages([self.room1.pk], None, 1)
+        self.assertEqual([m['id'] for m in messages], [msg2.pk])
+        self.assertTrue(has_older)
+
+        # new messages and status changes are written through
+        msg3 = Message.create_for_contact(self.unicef, self.contact3, "Msg 3", self.room2)
+        msg3.status = STATUS_FAILED
+        buffer_message(msg3)
+
+        messages, has_older = get_recent_messages([self.room1.pk, self.room2.pk], msg1.pk, 10)
+        self.assertEqual([(m['id'], m['status']) for m in messages], [(msg3.pk, 'F'), (msg2.pk, 'S')])
+        self.assertFalse(has_older)
+
+        # room #3 was never primed
+        self.assertIsNone(get_recent_messages([self.room1.pk, self.room3.pk], msg1.pk, 10))
+
+    def test_buffering_after_commit(self):
+        prime_room_buffer(self.room1.pk)
+
+        try:
+            with transaction.atomic():
+                Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+                raise ValueError("Rolled back")
+        except ValueError:
+            pass
+
+        # rolled back message was never buffered
+        self.assertEqual(get_recent_messages([self.room1.pk], None, 10), ([], False))
+
+        msg2 = Message.create_for_contact(self.unicef, self.contact1, "Msg 2", self.room1)
+
+        # senders are looked up when reading, so renames are reflected
+        self.contact1.full_name = "Annie Renamed"
+        self.contact1.save()
+
+        messages, has_older = get_recent_messages([self.room1.pk], None, 10)
+        self.assertEqual([m['id'] for m in messages], [msg2.pk])
+        self.assertEqual(messages[0]['sender'], dict(id=self.contact1.pk, type='C', full_name="Annie Renamed",
+                                                     chat_name=self.contact1.chat_name))
+
+    @patch('chatpro.msgs.recent.RECENT_MESSAGES_SIZE', 2)
+    def test_trimming(self):
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact2, "Msg 2", self.room1)
+        msg3 = Message.create_for_contact(self.unicef, self.contact1, "Msg 3", self.room1)
+
+        prime_room_buffer(self.room1.pk)
+
+        # msg1 is older than the buffer holds, so only newer requests can be answered
+        messages, has_older = get_recent_messages([self.room1.pk], msg1.pk, 10)
+        self.assertEqual([m['id'] for m in messages], [msg3.pk, msg2.pk])
+        self.assertIsNone(get_recent_messages([self.room1.pk], msg1.pk - 1, 10))
+
+        msg4 = Message.create_for_contact(self.unicef, self.contact2, "Msg 4", self.room1)
+
+        # msg1 and the floor have now been trimmed
+        messages, has_older = get_recent_messages([self.room1.pk], msg2.pk, 10)
+        self.assertEqual([m['id'] for m in messages], [msg4.pk, msg3.pk])
+        self.assertIsNone(get_recent_messages([self.room1.pk], msg1.pk - 1, 10))
+
+    def test_list_from_buffer(self):
+        for m in range(12):
+            Message.create_for_contact(self.unicef, self.contact1, "Msg %d" % (m + 1), self.room1)
+
+        self.login(self.user1)
+
+        # first page request primes the buffer
+        response = self.url_get('unicef', reverse('msgs.message_list'), {'room': self.room1.pk})
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 10)
+        self.assertEqual(content['results'][0]['text'], "Msg 12")
+        self.assertTrue(content['has_older'])
+        self.assertIsNotNone(get_recent_messages([self.room1.pk], None, 10))
+
+        # subsequent requests are answered from it, with the same results as the database would give
+        with patch('chatpro.msgs.views.prime_room_buffer') as mock_prime:
+            response = self.url_get('unicef', reverse('msgs.message_list'), {'room': self.room1.pk})
+            self.assertEqual(json.loads(response.content), content)
+
+            response = self.url_get('unicef', reverse('msgs.message_list'), {'after_id': content['max_id'] - 2})
+            self.assertEqual([m['text'] for m in json.loads(response.content)['results']], ["Msg 12", "Msg 11"])
+            self.assertFalse(mock_prime.called)
+
 
 class MessageCRUDLTest(ChatProTest):
     @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
@@ -156,3 +380,339 @@ class MessageCRUDLTest(ChatProTest):
         self.assertNotContains(response, "Msg 1", status_code=200)
         self.assertNotContains(response, "Msg 3")
         self.assertNotContains(response, "Msg 2")
+
+    def test_list_bad_params(self):
+        list_url = reverse('msgs.message_list')
+        self.login(self.user1)
+
+        for params in ({'after_id': 'x'}, {'room': '1;'}, {'ids': '1,a'}, {'before_time': 'yesterday'}):
+            response = self.url_get('unicef', list_url, params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_list_pagination(self):
+        list_url = reverse('msgs.message_list')
+
+        for m in range(10):
+            Message.create_for_contact(self.unicef, self.contact1, "Msg %d" % (m + 1), self.room1)
+
+        self.login(self.admin)
+
+        # exactly one page of messages
+        with CaptureQueriesContext(connection) as captured:
+            response = self.url_get('unicef', list_url, {'room': self.room1.pk})
+
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 10)
+        self.assertFalse(content['has_older'])
+        self.assertFalse([q for q in captured.captured_queries if 'COUNT(' in q['sql']])
+
+        # one more message pushes the oldest onto the next page
+        Message.create_for_contact(self.unicef, self.contact1, "Msg 11", self.room1)
+
+        response = self.url_get('unicef', list_url, {'room': self.room1.pk})
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 10)
+        self.assertEqual(content['results'][0]['text'], "Msg 11")
+        self.assertEqual(content['results'][-1]['text'], "Msg 2")
+        self.assertTrue(content['has_older'])
+
+        response = self.url_get('unicef', list_url, {'room': self.room1.pk, 'before_id': content['min_id']})
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 1)
+        self.assertEqual(content['results'][0]['text'], "Msg 1")
+        self.assertFalse(content['has_older'])
+
+    def test_list_query_count(self):
+        list_url = reverse('msgs.message_list')
+
+        def fetch_page():
+            with CaptureQueriesContext(connection) as captured:
+                response = self.url_get('unicef', list_url, {'room': self.room2.pk})
+            return json.loads(response.content), len(captured.captured_queries)
+
+        self.login(self.admin)
+
+        # page with a single message
+        Message.create_for_contact(self.unicef, self.contact3, "Hello", self.room2)
+        content, num_queries = fetch_page()
+        self.assertEqual(content['count'], 1)
+
+        # full page from a mix of contacts and users shouldn't need any more queries
+        senders = [self.contact3, self.contact4, self.user1, self.user2, self.admin]
+        for m in range(10):
+            sender = senders[m % len(senders)]
+            if isinstance(sender, User):
+                Message.objects.create(org=self.unicef, user=sender, text="Hi %d" % m, room=self.room2,
+                                       time=timezone.now(), status=STATUS_SENT)
+            else:
+                Message.create_for_contact(self.unicef, sender, "Hi %d" % m, self.room2)
+
+        content, num_queries_full = fetch_page()
+        self.assertEqual(content['count'], 10)
+        self.assertEqual(len({(r['sender']['type'], r['sender']['id']) for r in content['results']}), 5)
+        self.assertEqual(num_queries_full, num_queries)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_list_conditional(self):
+        self.use_redis('chatpro.rooms.rosters', ROSTER_VERSION_KEY % self.room1.pk)
+
+        list_url = reverse('msgs.message_list')
+
+        def fetch_page(etag=None):
+            extra = dict(HTTP_IF_NONE_MATCH=etag) if etag else {}
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(list_url, {'room': self.room1.pk}, HTTP_HOST='unicef.localhost',
+                                           HTTP_ACCEPT_ENCODING='gzip, deflate', **extra)
+            message_queries = [q for q in captured.captured_queries if 'msgs_message' in q['sql']]
+            return response, message_queries
+
+        for m in range(12):
+            Message.create_for_contact(self.unicef, self.contact1, "Hello there number %d" % m, self.room1)
+
+        self.login(self.user1)
+
+        # large pages are compressed
+        response, message_queries = fetch_page()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.GzipFile(fileobj=StringIO(response.content)).read())['count'], 10)
+        etag = response['ETag']
+
+        # unchanged page is revalidated without touching messages
+        response, message_queries = fetch_page(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(message_queries, [])
+
+        # new message changes the page
+        Message.create_for_contact(self.unicef, self.contact2, "Another", self.room1)
+
+        response, message_queries = fetch_page(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        # as does a change to a sender
+        self.contact1.full_name = "Annie"
+        self.contact1.save()
+
+        response, message_queries = fetch_page(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # validators only change once changes are committed, so an old page can't be cached under a new validator
+        last_ids, roster_versions = Message.get_last_ids([self.room1.pk]), get_roster_versions([self.room1.pk])
+        with transaction.atomic():
+            msg = Message.create_for_contact(self.unicef, self.contact2, "Uncommitted", self.room1)
+            self.contact2.full_name = "Bobby"
+            self.contact2.save()
+
+            self.assertEqual(Message.get_last_ids([self.room1.pk]), last_ids)
+            self.assertEqual(get_roster_versions([self.room1.pk]), roster_versions)
+
+        self.assertEqual(Message.get_last_ids([self.room1.pk]), {self.room1.pk: msg.pk})
+        self.assertEqual(get_roster_versions([self.room1.pk]), {self.room1.pk: roster_versions[self.room1.pk] + 1})
+
+        # malformed rooms are rejected
+        response = self.url_get('unicef', list_url, {'room': "x"})
+        self.assertEqual(response.status_code, 400)
+
+        # rooms which don't exist, or belong to another org, aren't found
+        response = self.url_get('unicef', list_url, {'room': 999999})
+        self.assertEqual(response.status_code, 404)
+        response = self.url_get('unicef', list_url, {'room': self.room4.pk})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_poll(self):
+        poll_url = reverse('msgs.message_poll')
+
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact5, "Msg 2", self.room3)
+
+        # log in as user who only has access to room #1
+        self.login(self.user1)
+
+        # newer message already announced, so poll returns straight away
+        response = self.url_get('unicef', poll_url, {'after_id': msg1.pk - 1})
+        self.assertContains(response, "Msg 1", status_code=200)
+        self.assertNotContains(response, "Msg 2")
+
+        # no newer message in our rooms, so poll waits without querying messages, and returns an empty result
+        with patch.object(MessageCRUDL.Poll, 'poll_timeout', 0):
+            with CaptureQueriesContext(connection) as captured:
+                response = self.url_get('unicef', poll_url, {'after_id': msg2.pk})
+                self.assertFalse([q for q in captured.captured_queries if 'msgs_message' in q['sql']])
+
+            self.assertEqual(json.loads(response.content),
+                             dict(count=0, max_id=None, min_id=None, has_older=False, results=[]))
+
+        # message arrives whilst we're waiting, and is returned in the same shape as the list view
+        def new_message(secs):
+            Message.create_for_contact(self.unicef, self.contact2, "Msg 3", self.room1)
+
+        with patch('chatpro.msgs.views.time.sleep') as mock_sleep:
+            mock_sleep.side_effect = new_message
+
+            response = self.url_get('unicef', poll_url, {'after_id': msg2.pk})
+            content = json.loads(response.content)
+            self.assertEqual([r['text'] for r in content['results']], ["Msg 3"])
+            self.assertEqual(content['max_id'], content['min_id'])
+            self.assertFalse(content['has_older'])
+            self.assertEqual(mock_sleep.call_count, 1)
+
+        # malformed ids are rejected
+        response = self.url_get('unicef', poll_url, {'after_id': "x"})
+        self.assertEqual(response.status_code, 400)
+
+        # waiting polls don't hold a transaction open
+        self.assertIn('default', resolve(poll_url).func._non_atomic_requests)
+        self.assertIn('default', resolve(reverse('msgs.message_changes')).func._non_atomic_requests)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_changes(self):
+        changes_url = reverse('msgs.message_changes')
+        start = format_iso8601(timezone.now())
+
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact5, "Msg 2", self.room3)
+        msg3 = Message.objects.create(org=self.unicef, user=self.user1, text="Msg 3", room=self.room1,
+                                      time=timezone.now(), status=STATUS_PENDING)
+
+        # log in as user who only has access to room #1
+        self.login(self.user1)
+
+        # new messages in our rooms are returned in order of modification
+        response = self.url_get('unicef', changes_url, {'since': start})
+        content = json.loads(response.content)
+        self.assertEqual([r['id'] for r in content['results']], [msg1.pk, msg3.pk])
+        self.assertEqual(content['since'], format_iso8601(Message.objects.get(pk=msg3.pk).modified_on))
+        self.assertEqual(content['since_id'], msg3.pk)
+        self.assertFalse(content['has_more'])
+
+        cursor = {'since': content['since'], 'since_id': content['since_id']}
+
+        # nothing changed since, so poll times out and returns the same cursor, with only the changes in the safety
+        # window behind it, which the client has already seen, and not the cursor's own message
+        with patch.object(MessageCRUDL.Changes, 'poll_timeout', 0):
+            response = self.url_get('unicef', changes_url, cursor)
+            content = json.loads(response.content)
+            self.assertEqual([r['id'] for r in content['results']], [msg1.pk])
+            self.assertEqual((content['since'], content['since_id']), (cursor['since'], cursor['since_id']))
+            self.assertFalse(content['has_more'])
+
+        # message is sent whilst we're waiting, so its status change is returned
+        def message_sent(secs):
+            msg3.status = STATUS_SENT
+            msg3.save(update_fields=('status', 'modified_on'))
+            msg3.announce(is_new=False)
+
+        with patch('chatpro.msgs.views.time.sleep') as mock_sleep:
+            mock_sleep.side_effect = message_sent
+
+            response = self.url_get('unicef', changes_url, cursor)
+            content = json.loads(response.content)
+            self.assertEqual([(r['id'], r['status']) for r in content['results']],
+                             [(msg1.pk, STATUS_SENT), (msg3.pk, STATUS_SENT)])
+            self.assertEqual(content['since_id'], msg3.pk)
+            self.assertEqual(mock_sleep.call_count, 1)
+
+        # cursor continues from messages modified at exactly the same time
+        Message.objects.filter(pk__in=[msg1.pk, msg2.pk, msg3.pk]).update(modified_on=parse_iso8601(start))
+        response = self.url_get('unicef', changes_url, {'since': start, 'since_id': msg1.pk})
+        content = json.loads(response.content)
+        self.assertEqual([r['id'] for r in content['results']], [msg3.pk])
+        self.assertEqual(content['since_id'], msg3.pk)
+
+        # a message which was committed after the cursor passed its modification time is still returned, as long as
+        # it's within the safety window
+        cursor = {'since': content['since'], 'since_id': content['since_id']}
+        msg4 = Message.create_for_contact(self.unicef, self.contact1, "Msg 4", self.room1)
+        Message.objects.filter(pk=msg4.pk).update(modified_on=parse_iso8601(start) - timedelta(seconds=5))
+        Message.objects.filter(pk=msg1.pk).update(modified_on=parse_iso8601(start) - timedelta(seconds=20))
+
+        with patch.object(MessageCRUDL.Changes, 'poll_timeout', 0):
+            response = self.url_get('unicef', changes_url, cursor)
+            self.assertEqual([r['id'] for r in json.loads(response.content)['results']], [msg4.pk])
+
+            # but not once the cursor is older than the window
+            with patch.object(MessageCRUDL.Changes, 'safety_window', timedelta(seconds=0)):
+                response = self.url_get('unicef', changes_url, cursor)
+                self.assertEqual(json.loads(response.content)['results'], [])
+
+        # with nothing announced after an older cursor, polls don't query messages at all
+        cursor = {'since': format_iso8601(timezone.now()), 'since_id': 0}
+        with patch.object(MessageCRUDL.Changes, 'poll_timeout', 0):
+            with patch.object(MessageCRUDL.Changes, 'safety_window', timedelta(seconds=0)):
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.url_get('unicef', changes_url, cursor)
+                    self.assertFalse([q for q in captured.captured_queries if 'msgs_message' in q['sql']])
+
+        self.assertEqual(json.loads(response.content)['results'], [])
+
+        # malformed cursors are rejected
+        response = self.url_get('unicef', changes_url, {'since': "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        response = self.url_get('unicef', changes_url, {'since': start, 'since_id': "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unread(self):
+        unread_url = reverse('msgs.message_unread')
+        mark_read_url = reverse('msgs.message_mark_read')
+
+        Message.create_for_contact(self.unicef, self.contact1, "Msg 1", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact2, "Msg 2", self.room1)
+        msg3 = Message.create_for_contact(self.unicef, self.contact3, "Msg 3", self.room2)
+        Message.create_for_contact(self.unicef, self.contact5, "Msg 4", self.room3)
+
+        # log in as user who has access to rooms #1 and #2, and hasn't read anything yet
+        self.login(self.user1)
+
+        response = self.url_get('unicef', unread_url)
+        content = json.loads(response.content)
+        self.assertEqual(sorted((r['room_id'], r['unread'], r['last_message_id']) for r in content['results']),
+                         [(self.room1.pk, 2, msg2.pk), (self.room2.pk, 1, msg3.pk)])
+        self.assertEqual(content['total'], 3)
+
+        # mark room #1 as read, and try to mark room #3 which we don't have access to
+        response = self.url_post('unicef', mark_read_url, {'rooms': '%d,%d' % (self.room1.pk, self.room3.pk)})
+        content = json.loads(response.content)
+        self.assertEqual([(r['room_id'], r['unread']) for r in content['results']], [(self.room1.pk, 0)])
+
+        # new message in room #1 is unread
+        msg5 = Message.create_for_contact(self.unicef, self.contact1, "Msg 5", self.room1)
+
+        # our own messages are never unread
+        with patch('chatpro.msgs.models.send_message'):
+            Message.create_for_user(self.unicef, self.user1, "Msg 6", self.room1)
+
+        # unread counts don't need messages to be counted
+        with CaptureQueriesContext(connection) as captured:
+            response = self.url_get('unicef', unread_url)
+            self.assertFalse([q for q in captured.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+        content = json.loads(response.content)
+        self.assertEqual(sorted((r['room_id'], r['unread']) for r in content['results']),
+                         [(self.room1.pk, 1), (self.room2.pk, 1)])
+
+        # a message which arrives after the client last received messages isn't marked as read
+        Message.create_for_contact(self.unicef, self.contact2, "Msg 7", self.room1)
+        response = self.url_post('unicef', mark_read_url, {'rooms': self.room1.pk, 'last_read_id': msg5.pk})
+        content = json.loads(response.content)
+        self.assertEqual([(r['room_id'], r['unread']) for r in content['results']], [(self.room1.pk, 1)])
+
+        # and markers never move backwards
+        self.url_post('unicef', mark_read_url, {'rooms': self.room1.pk, 'last_read_id': msg2.pk})
+        response = self.url_get('unicef', unread_url)
+        self.assertEqual(sorted((r['room_id'], r['unread']) for r in json.loads(response.content)['results']),
+                         [(self.room1.pk, 1), (self.room2.pk, 1)])
+
+        # malformed parameters are rejected
+        response = self.url_post('unicef', mark_read_url, {'rooms': "x"})
+        self.assertEqual(response.status_code, 400)
+        response = self.url_post('unicef', mark_read_url, {'last_read_id': "x"})
+        self.assertEqual(response.status_code, 400)
+
+        # mark all our rooms as read
+        self.url_post('unicef', mark_read_url)
+        response = self.url_get('unicef', unread_url)
+        self.assertEqual(json.loads(response.content)['total'], 0)
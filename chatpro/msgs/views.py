@@ -1,18 +1,64 @@
 from __future__ import unicode_literals
 
+import time
+
 from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import get_roster_versions
+from chatpro.utils.views import ConditionalJsonMixin, ParamsMixin
 from dash.orgs.views import OrgPermsMixin
+from datetime import timedelta
 from django.core.exceptions import PermissionDenied
+from django.db import connection, transaction
+from django.db.models import Q
 from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from smartmin.users.views import SmartCRUDL, SmartListView
 from smartmin.users.views import SmartCreateView
-from temba.utils import parse_iso8601
-from .models import Message
+from temba.utils import format_iso8601
+from .models import Message, ReadMarker
+from .recent import get_recent_messages, prime_room_buffer
+
+
+class LongPollMixin(object):
+    """
+    Mixin for views which hold requests open until something they're waiting for is announced. It must come first in a
+    view's bases so that its dispatch is the one which opts the view out of atomic requests, as a waiting request
+    shouldn't hold a transaction open. These views are served by their own worker pool (see config/poll.conf).
+    """
+    poll_timeout = 25  # seconds
+    poll_interval = 1  # seconds
+
+    @classmethod
+    def derive_url_pattern(cls, path, action):
+        return r'^%s/%s/$' % (path, action)
+
+    @transaction.non_atomic_requests
+    def dispatch(self, request, *args, **kwargs):
+        return super(LongPollMixin, self).dispatch(request, *args, **kwargs)
+
+    def wait_until(self, is_ready):
+        """
+        Blocks until is_ready returns true, or until the poll times out, and returns whether it became ready. Waiting
+        only touches the cache, so the database connection is given up first, and is reopened by whatever query comes
+        next.
+        """
+        if not connection.in_atomic_block:
+            connection.close()
+
+        give_up_at = time.time() + self.poll_timeout
+        while time.time() < give_up_at:
+            if is_ready():
+                return True
+
+            time.sleep(self.poll_interval)
+
+        return False
 
 
 class MessageCRUDL(SmartCRUDL):
     model = Message
-    actions = ('list', 'send')
+    actions = ('list', 'poll', 'changes', 'send', 'unread', 'mark_read')
 
     class Send(OrgPermsMixin, SmartCreateView):
         def post(self, request, *args, **kwargs):
@@ -26,60 +72,258 @@ class MessageCRUDL(SmartCRUDL):
             msg = Message.create_for_user(org, self.request.user, text, room)
             return JsonResponse(msg.as_json())
 
-    class List(OrgPermsMixin, SmartListView):
+    class List(ParamsMixin, ConditionalJsonMixin, OrgPermsMixin, SmartListView):
         paginate_by = None  # switch off Django pagination
         max_results = 10
         default_order = ('-id',)
 
+        def get_validator(self):
+            """
+            Messages only change when their rooms' announced markers change, and their senders only when their rooms'
+            rosters change, so together those validate any page of messages. Both are only updated once changes have
+            been committed, so a validator never describes a state which can't yet be read.
+            """
+            room_ids = self.request.user.get_room_ids(self.derive_org())
+
+            room_id = self.get_int_param('room')
+            if room_id:
+                if room_id not in room_ids:
+                    return None
+                room_ids = [room_id]
+
+            roster_versions = get_roster_versions(room_ids)
+            if roster_versions is None:
+                return None
+
+            last_ids = Message.get_last_ids(room_ids)
+            last_changes = Message.get_last_changes(room_ids)
+
+            markers = ['%d:%s:%s:%d' % (r, last_ids.get(r, ''), last_changes.get(r, ''), roster_versions[r])
+                       for r in sorted(room_ids)]
+
+            return '%s?%s|%s' % (self.request.path, self.request.META.get('QUERY_STRING', ''), ','.join(markers))
+
         def get_queryset(self, **kwargs):
             org = self.derive_org()
-            qs = Message.objects.filter(org=org)
+            qs = Message.objects.filter(org=org).select_related('user__profile', 'contact')
 
-            room_id = self.request.REQUEST.get('room', None)
-            ids = self.request.REQUEST.get('ids')
-            before_id = self.request.REQUEST.get('before_id', None)
-            after_id = self.request.REQUEST.get('after_id', None)
-            before_time = self.request.REQUEST.get('before_time', None)
-            after_time = self.request.REQUEST.get('after_time', None)
+            room_id = self.get_int_param('room')
+            ids = self.get_int_list_param('ids')
+            before_id = self.get_int_param('before_id')
+            after_id = self.get_int_param('after_id')
+            before_time = self.get_datetime_param('before_time')
+            after_time = self.get_datetime_param('after_time')
 
             if room_id:
-                room = Room.objects.get(pk=room_id)
+                room = get_object_or_404(Room, org=org, pk=room_id)
                 if not self.request.user.has_room_access(room):
                     raise PermissionDenied()
-                qs = qs.filter(room_id=room.id)
+                self.room_ids = [room.pk]
             else:
-                qs = qs.filter(room__in=self.request.user.get_rooms(org))
+                self.room_ids = self.request.user.get_room_ids(org)
+
+            qs = qs.filter(room_id__in=self.room_ids)
 
             if ids:
-                qs = qs.filter(pk__in=ids.split(','))
+                qs = qs.filter(pk__in=ids)
             if before_id:
-                qs = qs.filter(pk__lt=int(before_id))
+                qs = qs.filter(pk__lt=before_id)
             if after_id:
-                qs = qs.filter(pk__gt=int(after_id))
+                qs = qs.filter(pk__gt=after_id)
             if before_time:
-                qs = qs.filter(time__lt=parse_iso8601(before_time))
+                qs = qs.filter(time__lt=before_time)
             if after_time:
-                qs = qs.filter(time__gt=parse_iso8601(after_time))
+                qs = qs.filter(time__gt=after_time)
 
             return self.order_queryset(qs)
 
+        def get_recent_messages(self):
+            """
+            Tries to answer this request from the rooms' recent message buffers, which is possible for first page and
+            after_id requests. Returns a tuple of (messages, has_older) or None if the database must be queried.
+            """
+            params = self.request.REQUEST
+            if any(params.get(p, None) for p in ('ids', 'before_id', 'before_time', 'after_time')):
+                return None
+
+            after_id = self.get_int_param('after_id')
+
+            recent = get_recent_messages(self.room_ids, after_id, self.max_results)
+
+            # first page of a single room that wasn't buffered, so prime that room's buffer
+            if recent is None and params.get('room', None) and not after_id and self.room_ids:
+                prime_room_buffer(self.room_ids[0])
+                recent = get_recent_messages(self.room_ids, after_id, self.max_results)
+
+            return recent
+
         def render_to_response(self, context, **response_kwargs):
-            total = context['object_list'].count()
-            messages = list(context['object_list'][:self.max_results])
+            recent = self.get_recent_messages()
 
-            if messages:
-                max_id = messages[0].pk
-                min_id = messages[-1].pk
-                has_older = len(messages) < total
+            if recent is not None:
+                results, has_older = recent
+            else:
+                # fetch one more than we need to find out if there are older messages, rather than counting them all
+                messages = list(context['object_list'][:self.max_results + 1])
+                has_older = len(messages) > self.max_results
+                results = [msg.as_json() for msg in messages[:self.max_results]]
+
+            if results:
+                max_id = results[0]['id']
+                min_id = results[-1]['id']
             else:
                 max_id = None
                 min_id = None
-                has_older = False
-
-            results = [msg.as_json() for msg in messages]
 
             return JsonResponse({'count': len(results),
                                  'max_id': max_id,
                                  'min_id': min_id,
                                  'has_older': has_older,
                                  'results': results})
+
+    class Poll(LongPollMixin, List):
+        """
+        Long-poll variant of the list view. Requests with an after_id wait, without touching the database, until a
+        newer message is announced in one of the user's rooms, and then respond like the list view.
+        """
+        permission = 'msgs.message_list'
+
+        def get(self, request, *args, **kwargs):
+            after_id = self.get_int_param('after_id')
+
+            # nothing newer was announced, so there's nothing to fetch
+            if after_id and not self.wait_for_messages(after_id):
+                return JsonResponse({'count': 0, 'max_id': None, 'min_id': None, 'has_older': False, 'results': []})
+
+            return super(MessageCRUDL.Poll, self).get(request, *args, **kwargs)
+
+        def wait_for_messages(self, after_id):
+            """
+            Blocks until a message newer than after_id is announced, or until the poll times out, and returns whether
+            one was announced
+            """
+            room_ids = self.request.user.get_room_ids(self.derive_org())
+
+            room_id = self.get_int_param('room')
+            if room_id:
+                room_ids = [room_id] if room_id in room_ids else []
+
+            if not room_ids:
+                return False
+
+            has_newer = lambda: any(last_id > after_id for last_id in Message.get_last_ids(room_ids).values())
+            return self.wait_until(has_newer)
+
+    class Changes(LongPollMixin, ParamsMixin, OrgPermsMixin, SmartListView):
+        """
+        Feed of messages created or changed in the user's rooms since a cursor, i.e. a since time and optional
+        since_id for messages modified at exactly that time. Requests with nothing to return wait, without touching
+        the database, until a change is announced in one of the user's rooms.
+
+        Modification times are set before messages are committed, so a message can become visible after the cursor
+        has already passed it. Responses to cursors younger than a short safety window therefore also include the
+        changes from that window behind the cursor, and clients ignore any which they have already seen.
+        """
+        permission = 'msgs.message_list'
+        paginate_by = None  # switch off Django pagination
+        max_results = 100
+        safety_window = timedelta(seconds=10)
+
+        def get(self, request, *args, **kwargs):
+            since = self.get_datetime_param('since')
+            since_id = self.get_int_param('since_id', 0)
+
+            org = self.derive_org()
+            room_ids = request.user.get_room_ids(org)
+
+            if not since or not room_ids:
+                return JsonResponse({'count': 0, 'results': [], 'has_more': False,
+                                     'since': format_iso8601(since or timezone.now()), 'since_id': since_id})
+
+            # changes are announced once committed, so unless the cursor is young enough for late commits to still be
+            # arriving, the rooms' markers tell us whether there is anything to fetch
+            cursor_marker = Message.get_change_marker(since, since_id)
+            has_changes = lambda: any(c > cursor_marker for c in Message.get_last_changes(room_ids).values())
+
+            messages = []
+            if since > timezone.now() - self.safety_window or has_changes():
+                messages = self.get_changes(org, room_ids, since, since_id)
+
+            if not messages and self.wait_until(has_changes):
+                messages = self.get_changes(org, room_ids, since, since_id)
+
+            has_more = len(messages) > self.max_results
+            messages = messages[:self.max_results]
+
+            # late commits are only expected behind a young cursor
+            if since > timezone.now() - self.safety_window:
+                late_messages = self.get_late_changes(org, room_ids, since, since_id)
+            else:
+                late_messages = []
+
+            if messages:
+                since, since_id = messages[-1].modified_on, messages[-1].pk
+
+            messages = late_messages + messages
+
+            return JsonResponse({'count': len(messages),
+                                 'results': [msg.as_json() for msg in messages],
+                                 'has_more': has_more,
+                                 'since': format_iso8601(since),
+                                 'since_id': since_id})
+
+        def get_changes(self, org, room_ids, since, since_id):
+            """
+            Fetches one more than a page of changes after the given cursor, to find out if there are more
+            """
+            qs = Message.objects.filter(org=org, room_id__in=room_ids)
+            qs = qs.filter(Q(modified_on__gt=since) | Q(modified_on=since, pk__gt=since_id))
+            qs = qs.select_related('user__profile', 'contact').order_by('modified_on', 'pk')
+            return list(qs[:self.max_results + 1])
+
+        def get_late_changes(self, org, room_ids, since, since_id):
+            """
+            Fetches up to a page of changes in the safety window behind the given cursor, excluding the cursor's own
+            message
+            """
+            qs = Message.objects.filter(org=org, room_id__in=room_ids, modified_on__gte=since - self.safety_window)
+            qs = qs.filter(Q(modified_on__lt=since) | Q(modified_on=since, pk__lt=since_id))
+            qs = qs.select_related('user__profile', 'contact').order_by('-modified_on', '-pk')
+            return list(reversed(qs[:self.max_results]))
+
+    class Unread(OrgPermsMixin, SmartListView):
+        """
+        Summary of the number of unread messages in each of the user's rooms
+        """
+        @classmethod
+        def derive_url_pattern(cls, path, action):
+            return r'^%s/%s/$' % (path, action)
+
+        def get(self, request, *args, **kwargs):
+            rooms = list(request.user.get_rooms(self.derive_org()))
+            return JsonResponse(unread_summary(request.user, rooms))
+
+    class MarkRead(ParamsMixin, OrgPermsMixin, SmartCreateView):
+        """
+        Marks messages as read in the given rooms, or in all of the user's rooms, up to the last message id which the
+        client has seen, or all current messages if that isn't given
+        """
+        def post(self, request, *args, **kwargs):
+            room_ids = self.request.user.get_room_ids(self.derive_org())
+
+            requested = self.get_int_list_param('rooms')
+            if requested:
+                room_ids = set(room_ids).intersection(requested)
+
+            rooms = list(Room.objects.filter(pk__in=room_ids))
+            ReadMarker.mark_read(request.user, rooms, self.get_int_param('last_read_id'))
+
+            return JsonResponse(unread_summary(request.user, rooms))
+
+
+def unread_summary(user, rooms):
+    unread_counts = ReadMarker.get_unread_counts(user, rooms)
+    results = [{'room_id': room.pk, 'unread': unread_counts[room.pk], 'last_message_id': room.last_message_id}
+               for room in rooms]
+
+    return {'count': len(results), 'results': results, 'total': sum(unread_counts.values())}
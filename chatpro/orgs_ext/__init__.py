@@ -1,21 +1,35 @@
 from __future__ import absolute_import, unicode_literals
 
 import json
+import time
 
 from dash.orgs.models import Org
 from dash.utils import random_string
+from django.conf import settings
 from django.core.cache import cache
 from enum import Enum
+from .clients import client_registry
 
 
 class TaskType(Enum):
     sync_contacts = 1
     fetch_runs = 2
+    ingest_events = 3
+
+
+class MetadataType(Enum):
+    groups = 1
+    fields = 2
 
 
 LAST_TASK_CACHE_KEY = 'org:%d:task_result:%s'
 LAST_TASK_CACHE_TTL = 60 * 60 * 24 * 7  # 1 week
 
+METADATA_CACHE_KEY = 'org:%d:metadata:%s'
+METADATA_CACHE_TTL = 60 * 60 * 24 * 7  # 1 week
+METADATA_REFRESH_SCHEDULED_KEY = 'org:%d:metadata:%s:refresh_scheduled'
+METADATA_REFRESH_SCHEDULED_TTL = 60  # 1 minute
+
 
 ######################### Monkey patching for the Org class #########################
 
@@ -31,6 +45,54 @@ def _org_get_chat_name_field(org):
     return org.get_config(ORG_CONFIG_CHAT_NAME_FIELD)
 
 
+def _org_get_temba_client(org):
+    """
+    Gets a client for this org's RapidPro account from the process-wide registry, so that connections are re-used
+    across calls, requests and tasks
+    """
+    return client_registry.get_client(settings.SITE_API_HOST, org.api_token, org.pk,
+                                      user_agent=settings.SITE_API_USER_AGENT)
+
+
+def _org_get_temba_groups(org):
+    return _org_get_temba_metadata(org, MetadataType.groups)
+
+
+def _org_get_temba_fields(org):
+    return _org_get_temba_metadata(org, MetadataType.fields)
+
+
+def _org_get_temba_metadata(org, metadata_type):
+    """
+    Gets this org's RapidPro metadata of the given type from the cache, only fetching it if it isn't cached. Metadata
+    older than ORG_METADATA_MAX_AGE is still returned, but is refreshed in the background.
+    """
+    cached = cache.get(METADATA_CACHE_KEY % (org.pk, metadata_type.name))
+    if cached is None:
+        return org.refresh_temba_metadata(metadata_type)
+
+    fetched_on, items = cached
+
+    if time.time() - fetched_on > settings.ORG_METADATA_MAX_AGE:
+        if cache.add(METADATA_REFRESH_SCHEDULED_KEY % (org.pk, metadata_type.name), True,
+                     METADATA_REFRESH_SCHEDULED_TTL):
+            from .tasks import refresh_org_metadata
+            refresh_org_metadata.delay(org.pk, metadata_type.name)
+
+    return items
+
+
+def _org_refresh_temba_metadata(org, metadata_type):
+    """
+    Fetches this org's RapidPro metadata of the given type and caches it
+    """
+    client = org.get_temba_client()
+    items = client.get_groups() if metadata_type == MetadataType.groups else client.get_fields()
+
+    cache.set(METADATA_CACHE_KEY % (org.pk, metadata_type.name), (time.time(), items), METADATA_CACHE_TTL)
+    return items
+
+
 def _org_clean(org):
     super(Org, org).clean()
 
@@ -51,6 +113,10 @@ def _org_set_task_result(org, task_type, result):
 
 Org.get_secret_token = _org_get_secret_token
 Org.get_chat_name_field = _org_get_chat_name_field
+Org.get_temba_client = _org_get_temba_client
+Org.get_temba_groups = _org_get_temba_groups
+Org.get_temba_fields = _org_get_temba_fields
+Org.refresh_temba_metadata = _org_refresh_temba_metadata
 Org.clean = _org_clean
 Org.get_task_result = _org_get_task_result
 Org.set_task_result = _org_set_task_result
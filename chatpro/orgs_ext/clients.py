@@ -0,0 +1,149 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from temba import TembaClient, __version__ as temba_version
+from temba.base import TembaAPIError, TembaConnectionError
+from urlparse import urlparse
+
+
+class PooledTembaClient(TembaClient):
+    """
+    Temba client which makes its API calls through a pool of keep-alive connections, rather than opening a new
+    connection for every call
+    """
+    def __init__(self, host, token, user_agent=None, debug=False, session=None, on_request=None):
+        super(PooledTembaClient, self).__init__(host, token, user_agent, debug)
+
+        self.session = session or requests.Session()
+        self.on_request = on_request
+
+    def _request(self, method, url, body=None, params=None):
+        """
+        Makes a request the same way as the base client, but through this client's session. The base client has no
+        public way to supply a session, so this mirrors its request handling, including its debug output.
+        """
+        if self.user_agent:
+            user_agent_header = '%s rapidpro-python/%s' % (self.user_agent, temba_version)
+        else:
+            user_agent_header = 'rapidpro-python/%s' % temba_version
+
+        headers = {'Content-type': 'application/json',
+                   'Accept': 'application/json',
+                   'Authorization': 'Token %s' % self.token,
+                   'User-Agent': user_agent_header}
+
+        if self.debug:  # pragma: no cover
+            print("%s %s %s" % (method.upper(), url, json.dumps(params if params else body)))
+
+        kwargs = {'headers': headers}
+        if body:
+            kwargs['data'] = json.dumps(body)
+        if params:
+            kwargs['params'] = params
+
+        start, failed = time.time(), True
+        try:
+            response = self.session.request(method, url, **kwargs)
+
+            if self.debug:  # pragma: no cover
+                print(" -> %s" % response.content)
+
+            response.raise_for_status()
+
+            failed = False
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            raise TembaAPIError(ex)
+        except requests.exceptions.ConnectionError:
+            raise TembaConnectionError()
+        finally:
+            if self.on_request:
+                self.on_request(url, time.time() - start, failed)
+
+
+class ClientRegistry(object):
+    """
+    Process-wide registry of Temba clients keyed by org and API token. Clients for the same host share a session, and
+    so a pool of keep-alive connections. Everything is discarded if the process has been forked since, e.g. into a
+    Celery prefork worker, so that connections are never shared between processes.
+    """
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def get_client(self, host, token, org_id, user_agent=None):
+        """
+        Gets the client for the given org and API token, creating it if necessary
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+            client = self._clients.get((org_id, token))
+            if not client:
+                # discard any client for the org's previous API token
+                for key in [k for k in self._clients.keys() if k[0] == org_id]:
+                    del self._clients[key]
+
+                session = self._get_session(urlparse(host).netloc or host)
+                client = PooledTembaClient(host, token, user_agent=user_agent, session=session,
+                                           on_request=self._record_request)
+                self._clients[(org_id, token)] = client
+
+            return client
+
+    def get_stats(self):
+        """
+        Gets the number of requests, failed requests, opened connections and average latency in milliseconds of calls
+        to each host made by this process
+        """
+        with self._lock:
+            stats = {}
+            for host, (requests_made, failed, total_time) in self._stats.items():
+                session = self._sessions.get(host)
+                connections = self._count_connections(session) if session else 0
+                stats[host] = dict(requests=requests_made, failed=failed, connections=connections,
+                                   average_latency=int(total_time * 1000 / requests_made) if requests_made else 0)
+            return stats
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._clients = {}
+        self._sessions = {}
+        self._stats = {}
+
+    def _get_session(self, host):
+        session = self._sessions.get(host)
+        if not session:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._sessions[host] = session
+        return session
+
+    def _record_request(self, url, duration, failed):
+        host = urlparse(url).netloc
+
+        with self._lock:
+            requests_made, failed_requests, total_time = self._stats.get(host, (0, 0, 0.0))
+            self._stats[host] = (requests_made + 1, failed_requests + (1 if failed else 0), total_time + duration)
+
+    @staticmethod
+    def _count_connections(session):
+        connections = 0
+        for adapter in set(session.adapters.values()):
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(pool_key)
+                connections += pool.num_connections if pool else 0
+        return connections
+
+
+client_registry = ClientRegistry()
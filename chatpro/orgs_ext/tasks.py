@@ -0,0 +1,25 @@
+from __future__ import absolute_import, unicode_literals
+
+from celery.utils.log import get_task_logger
+from dash.orgs.models import Org
+from django.core.cache import cache
+from djcelery_transactions import task
+from . import MetadataType, METADATA_REFRESH_SCHEDULED_KEY
+
+logger = get_task_logger(__name__)
+
+
+@task
+def refresh_org_metadata(org_id, metadata_type_name):
+    """
+    Refreshes an org's cached RapidPro metadata of the given type
+    """
+    metadata_type = MetadataType[metadata_type_name]
+
+    try:
+        org = Org.objects.get(pk=org_id)
+        org.refresh_temba_metadata(metadata_type)
+
+        logger.info("Refreshed %s metadata for org #%d" % (metadata_type.name, org_id))
+    finally:
+        cache.delete(METADATA_REFRESH_SCHEDULED_KEY % (org_id, metadata_type.name))
@@ -1,9 +1,85 @@
 from __future__ import absolute_import, unicode_literals
 
+from chatpro.orgs_ext import MetadataType, METADATA_CACHE_KEY
+from chatpro.orgs_ext.clients import PooledTembaClient, client_registry
+from dash.orgs.models import Org
 from chatpro.test import ChatProTest
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from mock import patch
-from temba.types import Field as TembaField
+from django.test.utils import override_settings
+from mock import patch, MagicMock
+from temba.types import Field as TembaField, Group as TembaGroup
+from urlparse import urlparse
+
+
+class OrgPatchTest(ChatProTest):
+    def test_get_temba_client(self):
+        client = self.unicef.get_temba_client()
+        self.assertIsInstance(client, PooledTembaClient)
+        self.assertEqual(client.token, self.unicef.api_token)
+
+        # client is re-used for subsequent calls, including for other instances of the same org
+        self.assertIs(self.unicef.get_temba_client(), client)
+        self.assertIs(Org.objects.get(pk=self.unicef.pk).get_temba_client(), client)
+
+        # but not for other orgs, though they share connections to the same host
+        other_client = self.nyaruka.get_temba_client()
+        self.assertIsNot(other_client, client)
+        self.assertIs(other_client.session, client.session)
+
+        # or if the org's API token changes
+        self.unicef.api_token = 'ABCDEF'
+        new_client = self.unicef.get_temba_client()
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.token, 'ABCDEF')
+
+    @patch('requests.Session.request')
+    def test_temba_client_stats(self, mock_request):
+        mock_request.return_value = MagicMock(status_code=200, content='')
+
+        client = self.unicef.get_temba_client()
+        host = urlparse(client.root_url).netloc
+        before = client_registry.get_stats().get(host, dict(requests=0, failed=0))
+
+        client.delete_contact('C-001')
+        client.delete_contact('C-002')
+
+        after = client_registry.get_stats()[host]
+        self.assertEqual(after['requests'] - before['requests'], 2)
+        self.assertEqual(after['failed'], before['failed'])
+
+        # registry is reset in a forked process
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(self.unicef.get_temba_client(), client)
+            self.assertEqual(client_registry.get_stats(), {})
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('dash.orgs.models.TembaClient.get_fields')
+    @patch('dash.orgs.models.TembaClient.get_groups')
+    def test_get_temba_metadata(self, mock_get_groups, mock_get_fields):
+        cache.delete(METADATA_CACHE_KEY % (self.unicef.pk, MetadataType.groups.name))
+        cache.delete(METADATA_CACHE_KEY % (self.unicef.pk, MetadataType.fields.name))
+
+        mock_get_groups.return_value = [TembaGroup.create(uuid='G-001', name="Cars", size=2)]
+        mock_get_fields.return_value = [TembaField.create(key='chat_name', label="Chat name", value_type='T')]
+
+        # first call fetches from RapidPro, subsequent calls use the cache
+        self.assertEqual([g.uuid for g in self.unicef.get_temba_groups()], ['G-001'])
+        self.assertEqual([g.uuid for g in self.unicef.get_temba_groups()], ['G-001'])
+        self.assertEqual([f.key for f in self.unicef.get_temba_fields()], ['chat_name'])
+        self.assertEqual(mock_get_groups.call_count, 1)
+        self.assertEqual(mock_get_fields.call_count, 1)
+
+        # once cached groups are stale they're still returned, but are refreshed in the background
+        mock_get_groups.return_value = [TembaGroup.create(uuid='G-002', name="Bees", size=2)]
+
+        with override_settings(ORG_METADATA_MAX_AGE=-1):
+            self.assertEqual([g.uuid for g in self.unicef.get_temba_groups()], ['G-001'])
+            self.assertEqual(mock_get_groups.call_count, 2)
+
+        self.assertEqual([g.uuid for g in self.unicef.get_temba_groups()], ['G-002'])
+        self.assertEqual(mock_get_groups.call_count, 2)
 
 
 class OrgExtCRUDLTest(ChatProTest):
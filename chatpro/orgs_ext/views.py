@@ -1,9 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
+from chatpro.api.queue import get_queue_status
 from chatpro.orgs_ext import TaskType
 from dash.orgs.models import Org
 from dash.orgs.views import OrgCRUDL, InferOrgMixin, OrgPermsMixin, SmartUpdateView
 from dash.utils import ms_to_datetime
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django import forms
 from django.utils.translation import ugettext_lazy as _
@@ -31,7 +33,7 @@ class OrgExtCRUDL(SmartCRUDL):
         pass
 
     class Home(OrgCRUDL.Home):
-        fields = ('name', 'api_token', 'chat_name_field', 'last_contact_sync', 'new_message_webhook', 'new_contact_webhook', 'delete_contact_webhook')
+        fields = ('name', 'api_token', 'chat_name_field', 'last_contact_sync', 'webhook_queue', 'new_message_webhook', 'new_contact_webhook', 'delete_contact_webhook')
         field_config = {'api_token': {'label': _("RapidPro API Token")}}
         permission = 'orgs.org_home'
 
@@ -44,14 +46,41 @@ class OrgExtCRUDL(SmartCRUDL):
         def get_last_contact_sync(self, obj):
             result = obj.get_task_result(TaskType.sync_contacts)
             if result:
-                return "%s (%d created, %d updated, %d deleted, %d failed)" % (format_datetime(ms_to_datetime(result['time'])),
-                                                                               result['counts']['created'],
-                                                                               result['counts']['updated'],
-                                                                               result['counts']['deleted'],
-                                                                               result['counts']['failed'])
+                counts = result['counts']
+                status = "%s (%s, %d fetched, %d created, %d updated, %d deleted, %d failed, %d skipped)" % (
+                    format_datetime(ms_to_datetime(result['time'])),
+                    _("full") if result.get('full') else _("incremental"),
+                    counts.get('fetched', 0),
+                    counts['created'],
+                    counts['updated'],
+                    counts['deleted'],
+                    counts['failed'],
+                    counts.get('skipped', 0))
+
+                if result.get('merged_runs') or result.get('skipped_runs'):
+                    status += ", %d requests merged into this sync, %d deferred to a rerun" % (
+                        result.get('merged_runs', 0), result.get('skipped_runs', 0))
+                return status
             else:
                 return None
 
+        def get_webhook_queue(self, obj):
+            if not settings.WEBHOOK_QUEUE_EVENTS:
+                return None
+
+            depth, lag = get_queue_status(obj)
+            status = "%d queued (oldest %d seconds ago)" % (depth, lag / 1000)
+
+            result = obj.get_task_result(TaskType.ingest_events)
+            if result:
+                status += ", last drained %s (%d processed, %d failed, max lag %d seconds)" % (
+                    format_datetime(ms_to_datetime(result['time'])),
+                    result['counts']['processed'],
+                    result['counts']['failed'],
+                    result['max_lag'] / 1000)
+
+            return status
+
         def get_new_message_webhook(self, obj):
             return build_webhook(obj, self.request, 'message', 'new', 'contact=@contact.uuid&text=@step.value&group=[GROUP_UUID]')
 
@@ -74,7 +103,7 @@ class OrgExtCRUDL(SmartCRUDL):
                 super(OrgExtCRUDL.Edit.OrgForm, self).__init__(*args, **kwargs)
 
                 field_choices = []
-                for field in org.get_temba_client().get_fields():
+                for field in org.get_temba_fields():
                     field_choices.append((field.key, "%s (%s)" % (field.label, field.key)))
 
                 self.fields['secret_token'].initial = org.get_secret_token()
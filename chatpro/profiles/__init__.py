@@ -1,10 +1,12 @@
 from __future__ import absolute_import, unicode_literals
 
 from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import record_roster_changes, user_key
 from dash.utils import get_obj_cacheable
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
+from .access import get_user_access, invalidate_user_access
 from .models import Profile
 
 
@@ -55,21 +57,33 @@ def _user_get_full_name(user):
     return user.profile.full_name if user.has_profile() else " ".join([user.first_name, user.last_name]).strip()
 
 
+def _user_get_access(user, org_id):
+    """
+    Gets this user's access to the given org's rooms, which is cached for this user instance and between requests
+    """
+    return get_obj_cacheable(user, '_access_%d' % org_id, lambda: get_user_access(user, org_id))
+
+
 def _user_get_rooms(user, org):
-    def calculate():
-        # org admins have implicit access to all rooms
-        if user.is_admin_for(org):
-            return Room.get_all(org)
-        else:
-            return user.rooms.filter(is_active=True)
+    """
+    Gets the given org's active rooms which this user can chat in, i.e. all of them for org admins
+    """
+    return Room.objects.filter(pk__in=user.get_room_ids(org))
 
-    return get_obj_cacheable(user, '_rooms', calculate)
+
+def _user_get_room_ids(user, org):
+    """
+    Gets the ids of the given org's active rooms which this user can chat in, without querying the database
+    """
+    return _user_get_access(user, org.pk)['room_ids']
 
 
 def _user_update_rooms(user, rooms, manage_rooms):
     """
     Updates a user's rooms
     """
+    old_room_ids = list(user.rooms.values_list('pk', flat=True))
+
     user.rooms.clear()
     user.rooms.add(*rooms)
     user.rooms.add(*manage_rooms)
@@ -77,24 +91,34 @@ def _user_update_rooms(user, rooms, manage_rooms):
     user.manage_rooms.clear()
     user.manage_rooms.add(*manage_rooms)
 
+    new_room_ids = [r.pk for r in rooms] + [r.pk for r in manage_rooms]
+    record_roster_changes(set(old_room_ids) | set(new_room_ids), [user_key(user.pk)])
+
+    invalidate_user_access(user.pk)
+    for attr in [a for a in user.__dict__.keys() if a.startswith('_access_')]:
+        delattr(user, attr)
+
 
 def _user_has_room_access(user, room, manage=False):
     """
-    Whether the given user has access to the given room
+    Whether the given user has access to the given room. Org admins can access every room of their org, and other
+    users the rooms they are members or managers of, whether or not those rooms are active.
     """
-    if user.is_superuser or user.is_admin_for(room.org):
+    if user.is_superuser:
         return True
-    elif manage:
-        return user.manage_rooms.filter(pk=room.pk).exists()
-    else:
-        return user.rooms.filter(pk=room.pk).exists()
+
+    access = _user_get_access(user, room.org_id)
+    if access['is_admin']:
+        return True
+
+    return room.pk in (access['manage_room_ids'] if manage else access['member_room_ids'])
 
 
 def _user_is_admin_for(user, org):
     """
     Whether this user is an administrator for the given org
     """
-    return org.administrators.filter(pk=user.pk).exists()
+    return _user_get_access(user, org.pk)['is_admin']
 
 
 def _user_unicode(user):
@@ -114,6 +138,7 @@ User.clean = _user_clean
 User.has_profile = _user_has_profile
 User.get_full_name = _user_get_full_name
 User.get_rooms = _user_get_rooms
+User.get_room_ids = _user_get_room_ids
 User.update_rooms = _user_update_rooms
 User.has_room_access = _user_has_room_access
 User.is_admin_for = _user_is_admin_for
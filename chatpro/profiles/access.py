@@ -0,0 +1,82 @@
+"""
+Cached descriptors of each user's access to the rooms of each org, so that permission checks don't need any queries.
+Descriptors are keyed by a version of the org's rooms and a version of the user's rooms, so changing either version
+invalidates all of the affected descriptors at once.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from chatpro.utils import on_commit
+from dash.orgs.models import Org
+from django.core.cache import cache
+from uuid import uuid4
+
+USER_ACCESS_CACHE_KEY = 'user:%d:org:%d:access:%s:%s'
+USER_ACCESS_CACHE_TTL = 60 * 60 * 24  # 1 day
+ORG_ACCESS_VERSION_KEY = 'org:%d:access_version'
+USER_ACCESS_VERSION_KEY = 'user:%d:access_version'
+ACCESS_VERSION_TTL = 60 * 60 * 24 * 7  # 1 week
+
+
+def get_user_access(user, org_id):
+    """
+    Gets a dict describing the given user's access to the given org's rooms, i.e. whether they are an org
+    administrator, the ids of the active rooms they can chat in, and the ids of all rooms they are a member or manager
+    of, active or not
+    """
+    org_version_key, user_version_key = ORG_ACCESS_VERSION_KEY % org_id, USER_ACCESS_VERSION_KEY % user.pk
+    versions = cache.get_many([org_version_key, user_version_key])
+    org_version = versions.get(org_version_key) or _init_version(org_version_key)
+    user_version = versions.get(user_version_key) or _init_version(user_version_key)
+
+    key = USER_ACCESS_CACHE_KEY % (user.pk, org_id, org_version, user_version)
+    access = cache.get(key)
+    if access is None:
+        access = _calculate_access(user, org_id)
+        cache.set(key, access, USER_ACCESS_CACHE_TTL)
+
+    return access
+
+
+def invalidate_org_access(org_id):
+    """
+    Invalidates the access descriptors of all users of the given org, e.g. because its rooms or admins have changed.
+    The version is only changed once the current transaction commits, so that a descriptor calculated from the old
+    state can't be cached under the new version.
+    """
+    on_commit(lambda: cache.set(ORG_ACCESS_VERSION_KEY % org_id, _new_version(), ACCESS_VERSION_TTL))
+
+
+def invalidate_user_access(user_id):
+    """
+    Invalidates the access descriptors of the given user, e.g. because their rooms have changed. As above, this takes
+    effect once the current transaction commits.
+    """
+    on_commit(lambda: cache.set(USER_ACCESS_VERSION_KEY % user_id, _new_version(), ACCESS_VERSION_TTL))
+
+
+def _calculate_access(user, org_id):
+    from chatpro.rooms.models import Room
+
+    is_admin = Org.objects.filter(pk=org_id, administrators=user).exists()
+    rooms = Room.objects.filter(org_id=org_id)
+
+    if is_admin:
+        # admins can access all of the org's rooms, so don't need their memberships
+        room_ids = list(rooms.filter(is_active=True).values_list('pk', flat=True))
+        member_room_ids, manage_room_ids = [], []
+    else:
+        memberships = list(rooms.filter(users=user).values_list('pk', 'is_active'))
+        room_ids = [room_id for room_id, is_active in memberships if is_active]
+        member_room_ids = [room_id for room_id, is_active in memberships]
+        manage_room_ids = list(rooms.filter(managers=user).values_list('pk', flat=True))
+
+    return dict(is_admin=is_admin, room_ids=room_ids, member_room_ids=member_room_ids, manage_room_ids=manage_room_ids)
+
+
+def _init_version(key):
+    cache.add(key, _new_version(), ACCESS_VERSION_TTL)
+    return cache.get(key) or _new_version()  # cache may not persist anything, e.g. during testing
+
+
+def _new_version():
+    return uuid4().hex[:8]
@@ -1,15 +1,23 @@
 from __future__ import absolute_import, unicode_literals
 
 from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import record_roster_changes, contact_key, user_key
+from chatpro.utils.lookups import ModelLookupCache
+from collections import OrderedDict
 from dash.orgs.models import Org
 from dash.utils import intersection
 from dash.utils.sync import ChangeType
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_init, post_save, m2m_changed
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from temba.types import Contact as TembaContact
 from uuid import uuid4
-from .tasks import push_contact_change
+from .access import invalidate_org_access, invalidate_user_access
+from .pushes import queue_contact_change
+from .tasks import push_contact_change, schedule_contact_push
 
 
 class AbstractParticipant(models.Model):
@@ -69,10 +77,30 @@ class Contact(AbstractParticipant):
         return contact
 
     @classmethod
-    def kwargs_from_temba(cls, org, temba_contact):
-        org_room_uuids = [r.uuid for r in Room.get_all(org)]
-        room_uuids = intersection(org_room_uuids, temba_contact.groups)
-        room = Room.objects.get(org=org, uuid=room_uuids[0]) if room_uuids else None
+    def get_or_create_from_temba(cls, org, temba_contact):
+        """
+        Creates a contact from a Temba contact, or gets the existing contact if another process has just created it
+        """
+        kwargs = cls.kwargs_from_temba(org, temba_contact)
+        try:
+            with transaction.atomic():
+                return cls.objects.create(**kwargs)
+        except IntegrityError:
+            return cls.objects.get(uuid=kwargs['uuid'])
+
+    @classmethod
+    def kwargs_from_temba(cls, org, temba_contact, rooms=None):
+        """
+        Generates kwargs for a contact from a Temba contact. The org's active rooms can be provided, otherwise they are
+        taken from the org's room index, which doesn't need fetching for each contact either.
+        """
+        if rooms is None:
+            room_index = Room.get_index(org)
+        else:
+            room_index = OrderedDict([(r.uuid, r) for r in rooms])
+
+        room_uuids = intersection(room_index.keys(), temba_contact.groups)
+        room = room_index[room_uuids[0]] if room_uuids else None
 
         if not room:
             raise ValueError("No room with uuid in %s" % ", ".join(temba_contact.groups))
@@ -94,7 +122,10 @@ class Contact(AbstractParticipant):
         return temba_contact
 
     def push(self, change_type):
-        push_contact_change.delay(self.id, change_type)
+        if settings.CONTACT_PUSH_BATCH_WINDOW and queue_contact_change(self, change_type):
+            schedule_contact_push(self.org_id)
+        else:
+            push_contact_change.delay(self.id, change_type)
 
     def get_urn(self):
         return tuple(self.urn.split(':', 1))
@@ -116,6 +147,37 @@ class Contact(AbstractParticipant):
             return self.get_urn()[1]
 
 
+contact_lookups = ModelLookupCache(Contact, fields=('id', 'uuid', 'room_id', 'full_name', 'chat_name', 'urn',
+                                                   'is_active'))
+
+
+@receiver(post_save, sender=Contact)
+def invalidate_contact_lookup(sender, instance, **kwargs):
+    contact_lookups.invalidate(instance.org_id, [instance.uuid])
+
+
+@receiver(post_init, sender=Contact)
+def remember_saved_room(sender, instance, **kwargs):
+    instance._saved_room = (instance.room_id, instance.is_active)
+
+
+@receiver(post_save, sender=Contact)
+def record_contact_room_change(sender, instance, created, **kwargs):
+    """
+    Updates the contact counters and rosters of the rooms which this contact has left or joined, or changed in
+    """
+    old_room_id, old_is_active = (None, False) if created else instance._saved_room
+
+    record_roster_changes({old_room_id, instance.room_id}, [contact_key(instance.pk)])
+
+    old_counted_id = old_room_id if old_is_active else None
+    new_counted_id = instance.room_id if instance.is_active else None
+    if old_counted_id != new_counted_id:
+        Room.record_contact_change(old_counted_id, new_counted_id)
+
+    instance._saved_room = (instance.room_id, instance.is_active)
+
+
 class Profile(AbstractParticipant):
     """
     Extension for the user class
@@ -126,3 +188,22 @@ class Profile(AbstractParticipant):
 
     def as_participant_json(self):
         return dict(id=self.user_id, type='U', full_name=self.full_name, chat_name=self.chat_name)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Profile)
+def record_user_roster_change(sender, instance, update_fields=None, **kwargs):
+    user = instance if sender == User else instance.user
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+
+    record_roster_changes(user.rooms.values_list('pk', flat=True), [user_key(user.pk)])
+
+
+@receiver(m2m_changed, sender=Org.administrators.through)
+def invalidate_admin_access(sender, instance, action, reverse, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:  # instance is a user
+            invalidate_user_access(instance.pk)
+        else:
+            invalidate_org_access(instance.pk)
@@ -0,0 +1,84 @@
+"""
+Per-org queues of local contact changes waiting to be pushed to RapidPro, kept in Redis as lists. Changes made within
+the same push window are coalesced so that only the latest state of each contact is pushed.
+
+Queued changes are moved onto a processing list when they're popped, and only cleared from it once they've been
+pushed, so that changes from a push which is interrupted are pushed by the next one.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+from chatpro.utils import get_redis_connection
+from dash.utils.sync import ChangeType
+
+CONTACT_PUSH_QUEUE_KEY = 'org:%d:contact_pushes'
+CONTACT_PUSH_PROCESSING_KEY = 'org:%d:contact_pushes:processing'
+
+# appends everything on the queue to the processing list in chunks (to stay within Lua's stack limit), and returns
+# the whole processing list, including anything left on it by an interrupted push
+MOVE_TO_PROCESSING_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = 1, #items, 1000 do
+    redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('DEL', KEYS[1])
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+
+def queue_contact_change(contact, change_type):
+    """
+    Appends a contact change to its org's queue. Returns false if there is no queue, e.g. during testing, in which case
+    the change should be pushed immediately.
+    """
+    r = get_redis_connection()
+    if not r:
+        return False
+
+    r.rpush(CONTACT_PUSH_QUEUE_KEY % contact.org_id, '%d:%s' % (contact.pk, change_type.name))
+    return True
+
+
+def pop_contact_changes(org_id):
+    """
+    Moves all queued changes for the given org onto its processing list, returning an ordered map of contact ids to
+    the change to push for each contact, including any changes left on the processing list by an interrupted push
+    """
+    r = get_redis_connection()
+
+    script = r.register_script(MOVE_TO_PROCESSING_SCRIPT)
+    items = script(keys=(CONTACT_PUSH_QUEUE_KEY % org_id, CONTACT_PUSH_PROCESSING_KEY % org_id))
+
+    changes = []
+    for item in items:
+        contact_id, change_name = item.decode('utf-8').split(':', 1)
+        changes.append((int(contact_id), ChangeType[change_name]))
+
+    return coalesce_changes(changes)
+
+
+def complete_contact_changes(org_id):
+    """
+    Clears the given org's processing list once its changes have been pushed
+    """
+    get_redis_connection().delete(CONTACT_PUSH_PROCESSING_KEY % org_id)
+
+
+def coalesce_changes(changes):
+    """
+    Coalesces a sequence of (contact id, change type) tuples into a single change per contact. A contact created and
+    then updated is still created, and a contact created and then deleted doesn't need to be pushed at all.
+    """
+    coalesced = OrderedDict()
+    for contact_id, change_type in changes:
+        previous = coalesced.get(contact_id)
+
+        if previous == ChangeType.created:
+            if change_type == ChangeType.deleted:
+                del coalesced[contact_id]
+            continue
+
+        coalesced[contact_id] = change_type
+
+    return coalesced
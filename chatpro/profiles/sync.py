@@ -0,0 +1,219 @@
+"""
+Pulling of contacts from RapidPro. A full sync fetches every contact in the org's rooms and releases local contacts
+which weren't fetched. An incremental sync fetches only contacts modified after a given time, which includes contacts
+who have left the org's rooms but not contacts who have been deleted in RapidPro.
+
+Contacts are fetched a page at a time and each page is diffed against a map of the local contacts' values, so only
+new contacts are inserted (in bulk) and only changed contacts are updated.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import record_roster_changes
+from django.db import connection, transaction, IntegrityError
+from django.utils import timezone
+
+# a local contact's values are compared by a hash of these fields, with room compared separately
+HASHED_FIELDS = ('full_name', 'chat_name', 'urn')
+
+RELEASE_BATCH_SIZE = 500
+UPDATE_BATCH_SIZE = 100  # keeps each update's parameters within SQLite's limit
+
+
+class LocalContact(object):
+    """
+    The minimal state of a local contact needed to detect changes
+    """
+    __slots__ = ('pk', 'hash', 'room_id', 'is_active', 'seen')
+
+    def __init__(self, pk, hash, room_id, is_active):
+        self.pk = pk
+        self.hash = hash
+        self.room_id = room_id
+        self.is_active = is_active
+        self.seen = False
+
+
+def sync_contacts(org, modified_after=None, heartbeat=None):
+    """
+    Syncs the given org's contacts with RapidPro, fetching only contacts modified after the given time if provided.
+    Returns a tuple of (created, updated, deleted, failed) lists of contact UUIDs, the counts of fetched and skipped
+    (unchanged or ignored) contacts, and the latest modified time of the fetched contacts. The heartbeat callable, if
+    provided, is called after each page.
+    """
+    from .models import Contact
+
+    room_index = Room.get_index(org)
+    client = org.get_temba_client()
+
+    if modified_after:
+        pages = _fetch_pages(client, after=modified_after)
+        local_map = None  # fetched with each page
+    else:
+        pages = _fetch_pages(client, groups=room_index.keys())
+        local_map = _get_local_map(Contact.objects.filter(org=org))
+
+    created, updated, deleted, failed = [], [], [], []
+    fetched, skipped = 0, 0
+    changed_room_ids = set()
+    last_modified = modified_after
+
+    try:
+        for page in pages:
+            fetched += len(page)
+            page_map = local_map if local_map is not None else _get_local_map(
+                Contact.objects.filter(org=org, uuid__in=[c.uuid for c in page]))
+
+            to_create, to_update, to_release = [], [], []
+
+            for temba_contact in page:
+                if not last_modified or temba_contact.modified_on > last_modified:
+                    last_modified = temba_contact.modified_on
+
+                local = page_map.get(temba_contact.uuid)
+                if local:
+                    local.seen = True
+
+                try:
+                    kwargs = Contact.kwargs_from_temba(org, temba_contact)
+                except ValueError:  # not in any of the org's rooms
+                    if local and local.is_active:
+                        to_release.append((temba_contact.uuid, local))
+                    else:
+                        skipped += 1
+                    continue
+                except Exception:
+                    failed.append(temba_contact.uuid)
+                    continue
+
+                if not local:
+                    to_create.append(kwargs)
+                elif local.is_active and local.hash == _hash_values(kwargs) and local.room_id == kwargs['room'].pk:
+                    skipped += 1
+                else:
+                    to_update.append((local, kwargs))
+
+            changed_room_ids.update(kwargs['room'].pk for kwargs in to_create)
+            for local, kwargs in to_update:
+                changed_room_ids.update((local.room_id, kwargs['room'].pk))
+            changed_room_ids.update(local.room_id for uuid, local in to_release)
+
+            with transaction.atomic():
+                page_created = _create_contacts(Contact, to_create)
+                updated += _update_contacts(Contact, to_update)
+                deleted += _release_contacts(Contact, to_release)
+
+            created += page_created
+            skipped += len(to_create) - len(page_created)
+
+            if heartbeat:
+                heartbeat()
+
+        # a full sync releases active local contacts that weren't fetched
+        if local_map is not None:
+            unseen = [(uuid, c) for uuid, c in local_map.items() if c.is_active and not c.seen]
+            changed_room_ids.update(local.room_id for uuid, local in unseen)
+
+            for b in range(0, len(unseen), RELEASE_BATCH_SIZE):
+                deleted += _release_contacts(Contact, unseen[b:b + RELEASE_BATCH_SIZE])
+    finally:
+        # pages are committed as they are synced, so even if a later page fails, recalculate the contact counts of the
+        # rooms affected so far, and have clients refetch their rosters
+        Room.update_contact_counts(changed_room_ids)
+        record_roster_changes(changed_room_ids)
+
+    return created, updated, deleted, failed, fetched, skipped, last_modified
+
+
+def _fetch_pages(client, **params):
+    """
+    Generator which fetches contacts from RapidPro a page at a time
+    """
+    pager = client.pager()
+    while True:
+        yield client.get_contacts(pager=pager, **params)
+
+        if not pager.has_more():
+            return
+
+
+def _get_local_map(contacts):
+    """
+    Builds a map of UUIDs to the minimal state of the given local contacts
+    """
+    local_map = {}
+    for values in contacts.values('id', 'uuid', 'room_id', 'is_active', *HASHED_FIELDS):
+        local_map[values['uuid']] = LocalContact(values['id'], _hash_values(values), values['room_id'],
+                                                 values['is_active'])
+    return local_map
+
+
+def _hash_values(values):
+    return hash(tuple(values[f] for f in HASHED_FIELDS))
+
+
+def _create_contacts(model, to_create):
+    """
+    Inserts new contacts in bulk, falling back to individual inserts if any were created concurrently
+    """
+    if not to_create:
+        return []
+
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([model(**kwargs) for kwargs in to_create])
+        return [kwargs['uuid'] for kwargs in to_create]
+    except IntegrityError:
+        created = []
+        for kwargs in to_create:
+            try:
+                with transaction.atomic():
+                    model.objects.create(**kwargs)
+                created.append(kwargs['uuid'])
+            except IntegrityError:  # created by someone else since we fetched the local contacts
+                pass
+        return created
+
+
+def _update_contacts(model, to_update):
+    """
+    Updates changed contacts, re-activating them as needed, with one update per batch. Django can't set different
+    values for each row in a single update, so each field is set by a CASE on the contact id.
+    """
+    fields = [model._meta.get_field(f) for f in HASHED_FIELDS + ('room',)]
+    quote = connection.ops.quote_name
+    pk_column = quote(model._meta.pk.column)
+    now = timezone.now()
+
+    with connection.cursor() as cursor:
+        for b in range(0, len(to_update), UPDATE_BATCH_SIZE):
+            batch = to_update[b:b + UPDATE_BATCH_SIZE]
+            cases, params = [], []
+
+            for field in fields:
+                cases.append('%s = CASE %s %s END' % (quote(field.column), pk_column,
+                                                      ' '.join(['WHEN %s THEN %s'] * len(batch))))
+                for local, kwargs in batch:
+                    value = kwargs[field.name].pk if field.name == 'room' else kwargs[field.name]
+                    params += [local.pk, field.get_db_prep_save(value, connection)]
+
+            cases += ['%s = %%s' % quote('is_active'), '%s = %%s' % quote('modified_on')]
+            params += [True, model._meta.get_field('modified_on').get_db_prep_save(now, connection)]
+            params += [local.pk for local, kwargs in batch]
+
+            cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (quote(model._meta.db_table), ', '.join(cases),
+                                                                  pk_column, ', '.join(['%s'] * len(batch))),
+                           params)
+
+    return [kwargs['uuid'] for local, kwargs in to_update]
+
+
+def _release_contacts(model, to_release):
+    """
+    Releases contacts with a single update
+    """
+    if to_release:
+        contact_ids = [local.pk for uuid, local in to_release]
+        model.objects.filter(pk__in=contact_ids).update(is_active=False, modified_on=timezone.now())
+
+    return [uuid for uuid, local in to_release]
@@ -1,14 +1,38 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+import time
+
+from celery import chord
 from celery.utils.log import get_task_logger
 from dash.orgs.models import Org
-from dash.utils import datetime_to_ms
-from dash.utils.sync import sync_pull_contacts, sync_push_contact
+from dash.utils import datetime_to_ms, ms_to_datetime
+from dash.utils.sync import sync_push_contact
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from djcelery_transactions import task
+from uuid import uuid4
 
 logger = get_task_logger(__name__)
 
+CONTACT_PUSH_SCHEDULED_CACHE_KEY = 'org:%d:contact_push_scheduled'
+CONTACT_PUSH_LOCK_KEY = 'org:%d:contact_push_lock'
+CONTACT_PUSH_LOCK_TTL = 60 * 5  # 5 minutes
+
+CONTACT_SYNC_LOCK_KEY = 'org:%d:contact_sync_lock'
+CONTACT_SYNC_LOCK_TTL = 60 * 60  # 1 hour
+CONTACT_SYNC_RERUN_KEY = 'org:%d:contact_sync_rerun'
+CONTACT_SYNC_RERUN_FULL_KEY = 'org:%d:contact_sync_rerun_full'
+
+CONTACT_SYNC_SLOT_KEY = 'contact_sync:slot:%d'
+CONTACT_SYNC_SLOT_TTL = 60 * 60  # 1 hour
+CONTACT_SYNC_SLOT_RETRY = 10  # seconds
+
+CONTACT_SYNC_SUMMARY_CACHE_KEY = 'contact_sync:summary'
+CONTACT_SYNC_SUMMARY_CACHE_TTL = 60 * 60 * 24 * 7  # 1 week
+
 
 @task
 def push_contact_change(contact_id, change_type):
@@ -27,41 +51,271 @@ def push_contact_change(contact_id, change_type):
     sync_push_contact(org, contact, change_type, [chat_group_uuids])
 
 
+def schedule_contact_push(org_id):
+    """
+    Schedules pushing of an org's queued contact changes at the end of the current push window, unless that has
+    already been scheduled
+    """
+    push_window = settings.CONTACT_PUSH_BATCH_WINDOW
+
+    if cache.add(CONTACT_PUSH_SCHEDULED_CACHE_KEY % org_id, True, push_window):
+        push_org_contact_changes.apply_async(args=(org_id,), countdown=push_window)
+
+
 @task
-def sync_org_contacts(org_id):
+def push_org_contact_changes(org_id):
     """
-    Syncs all contacts for the given org
+    Pushes the latest state of each contact with queued changes in an org, using the same RapidPro client for all
     """
-    from chatpro.orgs_ext import TaskType
     from chatpro.rooms.models import Room
     from .models import Contact
+    from .pushes import pop_contact_changes, complete_contact_changes
 
-    org = Org.objects.get(pk=org_id)
+    # close this push window so that new changes schedule the next push
+    cache.delete(CONTACT_PUSH_SCHEDULED_CACHE_KEY % org_id)
 
-    logger.info('Starting contact sync task for org #%d' % org.id)
+    # if a previous push for this org is still running, try again later
+    if not cache.add(CONTACT_PUSH_LOCK_KEY % org_id, True, CONTACT_PUSH_LOCK_TTL):
+        schedule_contact_push(org_id)
+        return
 
-    sync_fields = [org.get_chat_name_field()]
-    sync_groups = [r.uuid for r in Room.get_all(org)]
+    try:
+        changes = pop_contact_changes(org_id)
+        if not changes:
+            complete_contact_changes(org_id)  # changes may have coalesced to nothing
+            return
 
-    created, updated, deleted, failed = sync_pull_contacts(org, Contact, fields=sync_fields, groups=sync_groups)
+        org = Org.objects.get(pk=org_id)
+        chat_group_uuids = set(Room.get_index(org).keys())
+        failed = 0
+
+        for contact in Contact.objects.filter(org=org, pk__in=changes.keys()).select_related('room'):
+            contact.org = org  # so every push uses the org's client
+
+            try:
+                sync_push_contact(org, contact, changes[contact.pk], [chat_group_uuids])
+            except Exception:
+                failed += 1
+                logger.error("Pushing %s change to contact %s failed"
+                             % (changes[contact.pk].name.upper(), contact.uuid), exc_info=1)
+
+        # failures have been logged, and aren't retried
+        complete_contact_changes(org_id)
+
+        logger.info("Pushed %d contact changes (%d failed) for org #%d" % (len(changes), failed, org_id))
+    finally:
+        cache.delete(CONTACT_PUSH_LOCK_KEY % org_id)
+
+
+@task
+def sync_org_contacts(org_id, full=False, merged_runs=0):
+    """
+    Syncs contacts for the given org. Only contacts modified since the last sync are fetched, unless a full sync is
+    requested or the last full sync is older than CONTACT_SYNC_FULL_INTERVAL. Only one sync runs at a time for each
+    org, and requests made while a sync is running are merged into a single rerun after it finishes.
+    """
+    from chatpro.orgs_ext import TaskType, MetadataType
+    from .models import contact_lookups
+    from .sync import sync_contacts
+
+    lock_key = CONTACT_SYNC_LOCK_KEY % org_id
+    lock_token = uuid4().hex
+
+    if not cache.add(lock_key, lock_token, CONTACT_SYNC_LOCK_TTL):
+        _request_sync_rerun(org_id, full)
+
+        logger.info("Contact sync for org #%d is already running so will rerun once it finishes" % org_id)
+        return
+
+    # absorb any rerun requested too late to be picked up by the previous sync
+    rerun = _pop_sync_rerun(org_id)
+    if rerun:
+        full = full or rerun['full']
+        merged_runs += rerun['requests']
+
+    try:
+        org = Org.objects.get(pk=org_id)
+        now = timezone.now()
+
+        last_result = org.get_task_result(TaskType.sync_contacts) or {}
+        last_full = last_result.get('last_full')
+        high_water_mark = last_result.get('high_water_mark')
+
+        if not (last_full and high_water_mark):
+            full = True
+        elif now - ms_to_datetime(last_full) > timedelta(seconds=settings.CONTACT_SYNC_FULL_INTERVAL):
+            full = True
+
+        logger.info('Starting %s contact sync task for org #%d' % ('full' if full else 'incremental', org.id))
+
+        modified_after = None if full else ms_to_datetime(high_water_mark)
+
+        # the lock is renewed after each page, so that it doesn't expire during a long sync
+        renew_lock = lambda: _renew_sync_lock(org_id, lock_token)
+
+        created, updated, deleted, failed, fetched, skipped, last_modified = sync_contacts(org, modified_after,
+                                                                                           heartbeat=renew_lock)
+
+        contact_lookups.invalidate(org.pk, created + updated + deleted)
+
+        # a sync which fetched nothing keeps the previous high water mark, or if it was full, uses the time it started,
+        # so that the next sync can still be incremental
+        if last_modified:
+            high_water_mark = datetime_to_ms(last_modified)
+        elif full:
+            high_water_mark = datetime_to_ms(now)
+
+        # warm the org's cached RapidPro metadata so that admin pages don't have to wait for it
+        for metadata_type in MetadataType:
+            try:
+                org.refresh_temba_metadata(metadata_type)
+            except Exception:
+                logger.error("Refreshing %s metadata for org #%d failed" % (metadata_type.name, org.id), exc_info=1)
+
+        # requests made while we were running are merged into a single rerun, and are taken before the lock is
+        # released so that a sync which starts straight after doesn't also take them
+        rerun = _pop_sync_rerun(org_id)
+    finally:
+        if cache.get(lock_key) == lock_token:
+            cache.delete(lock_key)
+
+    # as well as any made between taking those and releasing the lock
+    rerun = _merge_sync_reruns(rerun, _pop_sync_rerun(org_id))
 
     task_result = dict(time=datetime_to_ms(timezone.now()),
+                       full=full,
                        counts=dict(created=len(created),
                                    updated=len(updated),
                                    deleted=len(deleted),
-                                   failed=len(failed)))
+                                   failed=len(failed),
+                                   fetched=fetched,
+                                   skipped=skipped),
+                       merged_runs=merged_runs,
+                       skipped_runs=rerun['requests'] if rerun else 0,
+                       last_full=datetime_to_ms(now) if full else last_full,
+                       high_water_mark=high_water_mark)
     org.set_task_result(TaskType.sync_contacts, task_result)
 
-    logger.info("Finished contact sync for org #%d (%d created, %d updated, %d deleted, %d failed)"
-                % (org.id, len(created), len(updated), len(deleted), len(failed)))
+    logger.info("Finished contact sync for org #%d (%d fetched, %d created, %d updated, %d deleted, %d failed, "
+                "%d skipped)" % (org.id, fetched, len(created), len(updated), len(deleted), len(failed), skipped))
+
+    if rerun:
+        sync_org_contacts.delay(org_id, full=rerun['full'], merged_runs=rerun['requests'])
+
+
+@task(bind=True, max_retries=None)
+def sync_org_contacts_in_slot(self, org_id):
+    """
+    Syncs contacts for the given org as part of a sync of all orgs. Waits for one of CONTACT_SYNC_CONCURRENCY slots to
+    be free, and returns a summary of the sync rather than raising an exception if it fails.
+    """
+    slot_key = _acquire_sync_slot(org_id)
+    if not slot_key:
+        raise self.retry(countdown=CONTACT_SYNC_SLOT_RETRY)
+
+    start = time.time()
+    try:
+        sync_org_contacts(org_id)
+        error = None
+    except Exception as e:
+        logger.error("Contact sync for org #%d failed" % org_id, exc_info=1)
+        error = unicode(e)
+    finally:
+        cache.delete(slot_key)
+
+    return dict(org_id=org_id, duration=int((time.time() - start) * 1000), error=error)
+
+
+@task
+def summarize_contact_syncs(results, started_on):
+    """
+    Summarizes the results of syncing contacts for all orgs
+    """
+    failed = [r for r in results if r['error']]
+    slowest = sorted(results, key=lambda r: r['duration'], reverse=True)[:5]
+
+    summary = dict(time=datetime_to_ms(timezone.now()),
+                   duration=datetime_to_ms(timezone.now()) - started_on,
+                   orgs=len(results),
+                   failed=failed,
+                   slowest=slowest)
+    cache.set(CONTACT_SYNC_SUMMARY_CACHE_KEY, json.dumps(summary), CONTACT_SYNC_SUMMARY_CACHE_TTL)
+
+    logger.info("Finished contact sync for %d orgs in %d ms (%d failed, slowest org #%d took %d ms)"
+                % (len(results), summary['duration'], len(failed), slowest[0]['org_id'], slowest[0]['duration']))
 
 
 @task
 def sync_all_contacts():
     """
-    Syncs all contacts for all orgs
+    Syncs all contacts for all orgs, running a sync task for each org in parallel
+    """
+    org_ids = list(Org.objects.filter(is_active=True).values_list('pk', flat=True))
+    if not org_ids:
+        return
+
+    logger.info("Starting contact sync for %d orgs..." % len(org_ids))
+
+    header = [sync_org_contacts_in_slot.s(org_id) for org_id in org_ids]
+    chord(header)(summarize_contact_syncs.s(datetime_to_ms(timezone.now())))
+
+
+def _request_sync_rerun(org_id, full):
+    """
+    Flags that the given org's contacts should be synced again once the running sync finishes. Requests are counted
+    with atomic increments so that concurrent requests are never lost.
+    """
+    # full flag is counted first, so that a rerun which sees this request also sees whether it was full
+    keys = ([CONTACT_SYNC_RERUN_FULL_KEY % org_id] if full else []) + [CONTACT_SYNC_RERUN_KEY % org_id]
+    for key in keys:
+        cache.add(key, 0, CONTACT_SYNC_LOCK_TTL)
+        cache.incr(key)
+
+
+def _pop_sync_rerun(org_id):
+    """
+    Takes the given org's pending rerun, if there is one. Counts are decremented by what was read rather than deleted,
+    so that requests made concurrently are left for the next rerun.
+    """
+    requests = _take_count(CONTACT_SYNC_RERUN_KEY % org_id)
+    if not requests:
+        return None
+
+    return dict(full=bool(_take_count(CONTACT_SYNC_RERUN_FULL_KEY % org_id)), requests=requests)
+
+
+def _merge_sync_reruns(rerun1, rerun2):
+    if not (rerun1 and rerun2):
+        return rerun1 or rerun2
+
+    return dict(full=rerun1['full'] or rerun2['full'], requests=rerun1['requests'] + rerun2['requests'])
+
+
+def _take_count(key):
+    count = cache.get(key) or 0
+    if count:
+        cache.decr(key, count)
+    return count
+
+
+def _renew_sync_lock(org_id, lock_token):
+    """
+    Renews the given org's sync lock if it's still held with the given token
+    """
+    lock_key = CONTACT_SYNC_LOCK_KEY % org_id
+    if cache.get(lock_key) == lock_token:
+        cache.set(lock_key, lock_token, CONTACT_SYNC_LOCK_TTL)
+    else:
+        logger.warning("Contact sync lock for org #%d was lost" % org_id)
+
+
+def _acquire_sync_slot(org_id):
+    """
+    Tries to acquire one of the contact sync slots, returning its key if successful
     """
-    logger.info("Starting contact sync for all orgs...")
+    for slot in range(settings.CONTACT_SYNC_CONCURRENCY):
+        slot_key = CONTACT_SYNC_SLOT_KEY % slot
+        if cache.add(slot_key, org_id, CONTACT_SYNC_SLOT_TTL):
+            return slot_key
 
-    for org in Org.objects.filter(is_active=True):
-        sync_org_contacts(org.id)
+    return None
@@ -1,13 +1,30 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+
+from chatpro.orgs_ext import TaskType
+from chatpro.rooms.models import Room
 from chatpro.test import ChatProTest
+from datetime import timedelta
+from dash.orgs.models import Org
+from dash.utils import datetime_to_ms
+from dash.utils.sync import ChangeType
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 from django.utils import timezone
-from mock import patch
+from mock import patch, ANY
 from temba.types import Contact as TembaContact
+from .access import USER_ACCESS_VERSION_KEY
 from .models import Contact
+from .pushes import coalesce_changes, CONTACT_PUSH_QUEUE_KEY, CONTACT_PUSH_PROCESSING_KEY
+from .tasks import sync_org_contacts, sync_org_contacts_in_slot, sync_all_contacts, push_org_contact_changes
+from .tasks import CONTACT_PUSH_SCHEDULED_CACHE_KEY
+from .tasks import CONTACT_SYNC_SLOT_KEY, CONTACT_SYNC_SLOT_RETRY, CONTACT_SYNC_SUMMARY_CACHE_KEY
+from .tasks import CONTACT_SYNC_LOCK_KEY, CONTACT_SYNC_LOCK_TTL
 
 
 class UserPatchTest(ChatProTest):
@@ -52,6 +69,49 @@ class UserPatchTest(ChatProTest):
         self.assertFalse(self.admin.is_admin_for(self.nyaruka))
         self.assertFalse(self.user1.is_admin_for(self.unicef))
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_room_access_cached(self):
+        self.assertTrue(User.objects.get(pk=self.user1.pk).has_room_access(self.room1))
+
+        # other instances of the same user don't need any queries to check access
+        user1 = User.objects.get(pk=self.user1.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user1.has_room_access(self.room1))
+            self.assertFalse(user1.has_room_access(self.room1, manage=True))
+            self.assertTrue(user1.has_room_access(self.room2, manage=True))
+            self.assertFalse(user1.is_admin_for(self.unicef))
+            self.assertEqual(set(user1.get_room_ids(self.unicef)), {self.room1.pk, self.room2.pk})
+
+        # changing the user's rooms invalidates their access
+        user1.update_rooms([self.room3], [])
+        user1 = User.objects.get(pk=self.user1.pk)
+        self.assertFalse(user1.has_room_access(self.room1))
+        self.assertTrue(user1.has_room_access(self.room3))
+
+        # as does changing the org's rooms, though members can still access rooms which become inactive
+        self.room3.is_active = False
+        self.room3.save()
+        user1 = User.objects.get(pk=self.user1.pk)
+        self.assertEqual(user1.get_room_ids(self.unicef), [])
+        self.assertTrue(user1.has_room_access(self.room3))
+
+        # or the org's admins, who can access all rooms including inactive ones
+        self.unicef.administrators.add(self.user1)
+        user1 = User.objects.get(pk=self.user1.pk)
+        self.assertTrue(user1.is_admin_for(self.unicef))
+        self.assertTrue(user1.has_room_access(self.room1, manage=True))
+        self.assertTrue(user1.has_room_access(self.room3, manage=True))
+
+        # versions are only changed once changes are committed
+        version_key = USER_ACCESS_VERSION_KEY % self.user1.pk
+        version = cache.get(version_key)
+
+        with transaction.atomic():
+            user1.update_rooms([self.room1], [])
+            self.assertEqual(cache.get(version_key), version)
+
+        self.assertNotEqual(cache.get(version_key), version)
+
     def test_unicode(self):
         self.assertEqual(unicode(self.superuser), "root")
 
@@ -98,6 +158,38 @@ class ContactTest(ChatProTest):
         self.assertEqual(kwargs, dict(org=self.unicef, full_name="Jan", chat_name="jxn", room=self.room1,
                                       urn='tel:123', uuid='C-007'))
 
+        # rooms can also be provided
+        with self.assertNumQueries(0):
+            kwargs = Contact.kwargs_from_temba(self.unicef, temba_contact, rooms=[self.room2, self.room1])
+        self.assertEqual(kwargs['room'], self.room1)
+
+        self.assertRaises(ValueError, Contact.kwargs_from_temba, self.unicef, temba_contact, rooms=[self.room2])
+
+    def test_kwargs_from_temba_query_count(self):
+        temba_contacts = [TembaContact.create(uuid='C-%05d' % n, name="Contact %d" % n, urns=['tel:%d' % n],
+                                              groups=['G-00%d' % (n % 3 + 1)], fields=dict(chat_name="c%d" % n),
+                                              language='eng', modified_on=timezone.now())
+                          for n in range(6)]
+
+        # converting many contacts needs only the query to build the room index (rather than queries per contact)
+        with self.assertNumQueries(1):
+            kwargs = [Contact.kwargs_from_temba(self.unicef, temba_contact) for temba_contact in temba_contacts]
+
+        self.assertEqual([k['room'] for k in kwargs[:4]], [self.room1, self.room2, self.room3, self.room1])
+
+        # a new org instance uses the cached index, which is invalidated when a room changes
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            Room.get_index(Org.objects.get(pk=self.unicef.pk))
+            org = Org.objects.get(pk=self.unicef.pk)
+
+            with self.assertNumQueries(0):
+                self.assertEqual(Room.get_index(org).keys(), ['G-001', 'G-002', 'G-003'])
+
+            self.room2.is_active = False
+            self.room2.save()
+
+            self.assertEqual(Room.get_index(Org.objects.get(pk=self.unicef.pk)).keys(), ['G-001', 'G-003'])
+
     def test_as_temba(self):
         temba_contact = self.contact1.as_temba()
         self.assertEqual(temba_contact.name, "Ann")
@@ -124,6 +216,305 @@ class ContactTest(ChatProTest):
         self.assertEqual(unicode(self.contact1), "1234")
 
 
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   CONTACT_PUSH_BATCH_WINDOW=5)
+class ContactPushTest(ChatProTest):
+    def setUp(self):
+        super(ContactPushTest, self).setUp()
+
+        self.redis = self.use_redis('chatpro.profiles.pushes', CONTACT_PUSH_QUEUE_KEY % self.unicef.pk,
+                                    CONTACT_PUSH_PROCESSING_KEY % self.unicef.pk)
+
+        self.addCleanup(cache.delete, CONTACT_PUSH_SCHEDULED_CACHE_KEY % self.unicef.pk)
+
+    def test_coalesce_changes(self):
+        changes = coalesce_changes([(1, ChangeType.updated), (2, ChangeType.created), (1, ChangeType.updated),
+                                    (3, ChangeType.created), (2, ChangeType.updated), (1, ChangeType.deleted),
+                                    (3, ChangeType.deleted)])
+        self.assertEqual(changes.items(), [(1, ChangeType.deleted), (2, ChangeType.created)])
+
+    @patch('dash.orgs.models.TembaClient.delete_contact')
+    @patch('dash.orgs.models.TembaClient.create_contact')
+    @patch('chatpro.profiles.tasks.push_org_contact_changes.apply_async')
+    def test_push_debounced(self, mock_apply_async, mock_create_contact, mock_delete_contact):
+        mock_create_contact.return_value = TembaContact.create(uuid='C-007', name="Mo Chats", urns=['tel:078123'],
+                                                               groups=['G-001'], fields=dict(chat_name="momo"),
+                                                               language='eng', modified_on=timezone.now())
+
+        # create a contact and edit it, edit an existing contact and then release it, and create and release another
+        contact = Contact.create(self.unicef, self.user1, "Mo", "mo", 'tel:078123', self.room1)
+        contact.full_name = "Mo Chats"
+        contact.save()
+        contact.push(ChangeType.updated)
+
+        self.contact1.push(ChangeType.updated)
+        self.contact1.release()
+
+        Contact.create(self.unicef, self.user1, "Nic", "nic", 'tel:078456', self.room1).release()
+
+        # only one push is scheduled for the whole window
+        mock_apply_async.assert_called_once_with(args=(self.unicef.pk,), countdown=5)
+        self.assertEqual(self.redis.llen(CONTACT_PUSH_QUEUE_KEY % self.unicef.pk), 7)
+
+        push_org_contact_changes(self.unicef.pk)
+
+        # the new contact is created once, and the contact created and released in the same window is ignored
+        self.assertEqual(mock_create_contact.call_count, 1)
+        self.assertEqual(Contact.objects.get(pk=contact.pk).uuid, 'C-007')
+
+        mock_delete_contact.assert_called_once_with('C-001')
+
+        self.assertEqual(self.redis.llen(CONTACT_PUSH_QUEUE_KEY % self.unicef.pk), 0)
+
+        # nothing left to push
+        mock_create_contact.reset_mock()
+        push_org_contact_changes(self.unicef.pk)
+        self.assertFalse(mock_create_contact.called)
+
+        # changes from a push which is interrupted are kept, and pushed by the next one
+        self.contact2.release()
+
+        with patch('chatpro.profiles.tasks.Org.objects.get') as mock_org_get:
+            mock_org_get.side_effect = ValueError("Boom")
+            self.assertRaises(ValueError, push_org_contact_changes, self.unicef.pk)
+
+        self.assertEqual(self.redis.llen(CONTACT_PUSH_PROCESSING_KEY % self.unicef.pk), 1)
+
+        push_org_contact_changes(self.unicef.pk)
+
+        mock_delete_contact.assert_called_with('C-002')
+        self.assertEqual(self.redis.llen(CONTACT_PUSH_PROCESSING_KEY % self.unicef.pk), 0)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ContactSyncTest(ChatProTest):
+    def setUp(self):
+        super(ContactSyncTest, self).setUp()
+
+        patcher = patch('dash.orgs.models.Org.refresh_temba_metadata')
+        self.mock_refresh_temba_metadata = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_sync_org_contacts(self, mock_get_contacts):
+        def temba_contact(uuid, name, urn, groups, modified_on):
+            return TembaContact.create(uuid=uuid, name=name, urns=[urn], groups=groups,
+                                       fields=dict(chat_name=name.lower()), language='eng', modified_on=modified_on)
+
+        now = timezone.now().replace(microsecond=0)
+        t1, t2 = now - timedelta(hours=2), now - timedelta(hours=1)
+
+        # first sync is full, fetching contacts in our rooms and releasing local contacts not fetched
+        mock_get_contacts.return_value = [temba_contact('C-001', "Ann", 'tel:1234', ['G-001'], t1),
+                                          temba_contact('C-002', "Bobby", 'tel:2345', ['G-001'], t2),
+                                          temba_contact('C-007', "Jim", 'tel:7890', ['G-002'], t1)]
+        sync_org_contacts(self.unicef.pk)
+
+        mock_get_contacts.assert_called_once_with(groups=['G-001', 'G-002', 'G-003'], pager=ANY)
+        self.assertEqual(Contact.objects.get(uuid='C-002').full_name, "Bobby")
+        self.assertEqual(Contact.objects.get(uuid='C-007').room, self.room2)
+        self.assertFalse(Contact.objects.get(uuid='C-003').is_active)
+
+        result = self.unicef.get_task_result(TaskType.sync_contacts)
+        self.assertTrue(result['full'])
+        self.assertEqual(result['counts'], dict(created=1, updated=1, deleted=3, failed=0, fetched=3, skipped=1))
+        self.assertEqual(result['high_water_mark'], datetime_to_ms(t2))
+
+        # org's cached groups and fields are refreshed too
+        self.assertEqual(self.mock_refresh_temba_metadata.call_count, 2)
+
+        # next sync is incremental, only fetching contacts modified since the high water mark
+        mock_get_contacts.reset_mock()
+        mock_get_contacts.return_value = [temba_contact('C-002', "Bobby", 'tel:2345', ['G-001'], t2),
+                                          temba_contact('C-001', "Ann", 'tel:1234', ['G-999'], t2)]
+        sync_org_contacts(self.unicef.pk)
+
+        mock_get_contacts.assert_called_once_with(after=t2, pager=ANY)
+        self.assertFalse(Contact.objects.get(uuid='C-001').is_active)  # left our rooms
+        self.assertTrue(Contact.objects.get(uuid='C-002').is_active)
+
+        result = self.unicef.get_task_result(TaskType.sync_contacts)
+        self.assertFalse(result['full'])
+        self.assertEqual(result['counts'], dict(created=0, updated=0, deleted=1, failed=0, fetched=2, skipped=1))
+
+        # once the last full sync is old enough, sync is full again
+        with override_settings(CONTACT_SYNC_FULL_INTERVAL=0):
+            mock_get_contacts.reset_mock()
+            sync_org_contacts(self.unicef.pk)
+
+            mock_get_contacts.assert_called_once_with(groups=['G-001', 'G-002', 'G-003'], pager=ANY)
+            self.assertTrue(self.unicef.get_task_result(TaskType.sync_contacts)['full'])
+
+        # a full sync which fetches nothing uses its start time as the high water mark, so the next is incremental
+        mock_get_contacts.reset_mock()
+        mock_get_contacts.return_value = []
+
+        with patch('chatpro.profiles.tasks.timezone.now', return_value=now):
+            with override_settings(CONTACT_SYNC_FULL_INTERVAL=0):
+                sync_org_contacts(self.unicef.pk)
+
+        self.assertEqual(self.unicef.get_task_result(TaskType.sync_contacts)['high_water_mark'], datetime_to_ms(now))
+
+        # and an incremental sync which fetches nothing keeps it
+        mock_get_contacts.reset_mock()
+        sync_org_contacts(self.unicef.pk)
+
+        mock_get_contacts.assert_called_once_with(after=now, pager=ANY)
+        self.assertEqual(self.unicef.get_task_result(TaskType.sync_contacts)['high_water_mark'], datetime_to_ms(now))
+
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_sync_contacts_paged(self, mock_get_contacts):
+        def temba_contact(num, name, groups):
+            return TembaContact.create(uuid='C-%03d' % num, name=name, urns=['tel:%d' % num], groups=groups,
+                                       fields=dict(chat_name=name.lower()), language='eng', modified_on=timezone.now())
+
+        # existing contacts unchanged, and 10 new contacts, split over two pages
+        page1 = [temba_contact(1, "Ann", ['G-001']), temba_contact(2, "Bob", ['G-001'])]
+        page1 += [temba_contact(100 + n, "New %d" % n, ['G-002']) for n in range(5)]
+        page2 = [temba_contact(200 + n, "New %d" % n, ['G-003']) for n in range(5)]
+
+        Contact.objects.filter(uuid='C-001').update(urn='tel:1')
+        Contact.objects.filter(uuid='C-002').update(urn='tel:2')
+
+        def get_contacts(pager, **kwargs):
+            if pager.next_url:
+                pager.next_url = None
+                return page2
+            else:
+                pager.next_url = 'http://example.com/api/v1/contacts.json?page=2'
+                return page1
+
+        mock_get_contacts.side_effect = get_contacts
+
+        with CaptureQueriesContext(connection) as captured:
+            sync_org_contacts(self.unicef.pk, full=True)
+
+        self.assertEqual(mock_get_contacts.call_count, 2)
+        self.assertEqual(Contact.objects.filter(org=self.unicef, is_active=True).count(), 12)
+
+        # one insert per page, no updates for unchanged contacts, one update to release unfetched contacts
+        statements = [' '.join(q['sql'].split(' ')[:3]) for q in captured.captured_queries]
+        self.assertEqual(statements.count('INSERT INTO "profiles_contact"'), 2)
+        self.assertEqual(statements.count('UPDATE "profiles_contact" SET'), 1)
+
+        # and contact counts of the affected rooms are recalculated
+        self.assertEqual([r.contact_count for r in Room.objects.filter(org=self.unicef).order_by('pk')], [2, 5, 5])
+
+        result = self.unicef.get_task_result(TaskType.sync_contacts)
+        self.assertEqual(result['counts'], dict(created=10, updated=0, deleted=3, failed=0, fetched=12, skipped=2))
+
+    @patch('dash.orgs.models.TembaClient.get_contacts')
+    def test_sync_contacts_changed(self, mock_get_contacts):
+        def temba_contact(num, name, groups):
+            return TembaContact.create(uuid='C-%03d' % num, name=name, urns=['tel:%d' % num], groups=groups,
+                                       fields=dict(chat_name=name.lower()), language='eng', modified_on=timezone.now())
+
+        # three existing contacts changed in different ways
+        mock_get_contacts.return_value = [temba_contact(1, "Annie", ['G-001']),
+                                          temba_contact(2, "Bob", ['G-002']),
+                                          temba_contact(3, "Cat", ['G-001'])]
+
+        with CaptureQueriesContext(connection) as captured:
+            sync_org_contacts(self.unicef.pk, full=True)
+
+        # changed contacts are updated with a single statement
+        statements = [' '.join(q['sql'].split(' ')[:3]) for q in captured.captured_queries]
+        self.assertEqual(statements.count('UPDATE "profiles_contact" SET'), 2)  # one to update, one to release
+
+        contacts = Contact.objects.filter(uuid__in=['C-001', 'C-002', 'C-003']).order_by('uuid')
+        self.assertEqual([(c.full_name, c.chat_name, c.urn, c.room_id, c.is_active) for c in contacts],
+                         [("Annie", "annie", 'tel:1', self.room1.pk, True),
+                          ("Bob", "bob", 'tel:2', self.room2.pk, True),
+                          ("Cat", "cat", 'tel:3', self.room1.pk, True)])
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('chatpro.profiles.sync.sync_contacts')
+    def test_sync_org_contacts_overlapping(self, mock_sync_contacts):
+        mock_sync_contacts.return_value = [], [], [], [], 0, 0, timezone.now()
+        sync_org_contacts(self.unicef.pk, full=True)  # so that the next sync can be incremental
+
+        def sync_contacts(org, modified_after, heartbeat=None):
+            # while the first sync is running, more syncs are requested for the same org
+            if mock_sync_contacts.call_count == 1:
+                sync_org_contacts(self.unicef.pk)
+                sync_org_contacts(self.unicef.pk, full=True)
+                sync_org_contacts(self.nyaruka.pk)  # other orgs aren't blocked
+            return [], [], [], [], 0, 0, timezone.now()
+
+        mock_sync_contacts.reset_mock()
+        mock_sync_contacts.side_effect = sync_contacts
+
+        sync_org_contacts(self.unicef.pk)
+
+        # the two requests for the same org are merged into one full rerun, after the first sync finishes
+        orgs = [call[0][0] for call in mock_sync_contacts.call_args_list]
+        self.assertEqual(orgs, [self.unicef, self.nyaruka, self.unicef])
+        self.assertIsNotNone(mock_sync_contacts.call_args_list[0][0][1])
+        self.assertIsNone(mock_sync_contacts.call_args_list[2][0][1])
+
+        result = self.unicef.get_task_result(TaskType.sync_contacts)
+        self.assertTrue(result['full'])
+        self.assertEqual(result['merged_runs'], 2)
+        self.assertEqual(result['skipped_runs'], 0)
+
+    @patch('chatpro.profiles.sync.sync_contacts')
+    def test_sync_org_contacts_lock_renewed(self, mock_sync_contacts):
+        lock_key = CONTACT_SYNC_LOCK_KEY % self.unicef.pk
+
+        def sync_contacts(org, modified_after, heartbeat=None):
+            token = cache.get(lock_key)
+
+            # heartbeat renews the lock while it's still ours
+            with patch('chatpro.profiles.tasks.cache.set') as mock_cache_set:
+                heartbeat()
+                mock_cache_set.assert_called_once_with(lock_key, token, CONTACT_SYNC_LOCK_TTL)
+
+            # but not once it has expired and been taken by another sync
+            cache.set(lock_key, 'other', CONTACT_SYNC_LOCK_TTL)
+            heartbeat()
+            self.assertEqual(cache.get(lock_key), 'other')
+
+            return [], [], [], [], 0, 0, timezone.now()
+
+        mock_sync_contacts.side_effect = sync_contacts
+        sync_org_contacts(self.unicef.pk)
+
+        # which isn't released by this one
+        self.assertEqual(cache.get(lock_key), 'other')
+        cache.delete(lock_key)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('chatpro.profiles.sync.sync_contacts')
+    def test_sync_all_contacts(self, mock_sync_contacts):
+        def sync_contacts(org, modified_after, heartbeat=None):
+            if org == self.nyaruka:
+                raise ValueError("API is down")
+            return [], [], [], [], 0, 0, None
+
+        mock_sync_contacts.side_effect = sync_contacts
+
+        sync_all_contacts()
+
+        self.assertEqual(set(call[0][0] for call in mock_sync_contacts.call_args_list), {self.unicef, self.nyaruka})
+        self.assertIsNotNone(self.unicef.get_task_result(TaskType.sync_contacts))
+
+        # failure for one org is reported in the summary
+        summary = json.loads(cache.get(CONTACT_SYNC_SUMMARY_CACHE_KEY))
+        self.assertEqual(summary['orgs'], 2)
+        self.assertEqual([(f['org_id'], f['error']) for f in summary['failed']], [(self.nyaruka.pk, "API is down")])
+
+        # syncs have to wait if all slots are taken
+        with override_settings(CONTACT_SYNC_CONCURRENCY=1):
+            cache.add(CONTACT_SYNC_SLOT_KEY % 0, self.nyaruka.pk)
+
+            with patch('chatpro.profiles.tasks.sync_org_contacts_in_slot.retry') as mock_retry:
+                mock_retry.return_value = Exception("Retrying")
+                self.assertRaises(Exception, sync_org_contacts_in_slot, self.unicef.pk)
+                mock_retry.assert_called_once_with(countdown=CONTACT_SYNC_SLOT_RETRY)
+
+            cache.delete(CONTACT_SYNC_SLOT_KEY % 0)
+
+
 class ContactCRUDLTest(ChatProTest):
     def test_create(self):
         url = reverse('profiles.contact_create')
@@ -0,0 +1,22 @@
+from __future__ import absolute_import, unicode_literals
+
+from chatpro.rooms.models import Room
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    args = "[org_id org_id ...]"
+    help = "Recalculates the contact and message counters of all rooms, or of the rooms of the given orgs"
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.all().order_by('pk')
+        if args:
+            rooms = rooms.filter(org_id__in=[int(a) for a in args])
+
+        rooms = list(rooms)
+        fixed = Room.reconcile_counters(rooms)
+
+        for room in fixed:
+            self.stdout.write("Fixed counters for room #%d (%s)" % (room.pk, room.name))
+
+        self.stdout.write("Reconciled %d rooms (%d had drifted)" % (len(rooms), len(fixed)))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def populate_counters(apps, schema_editor):
+    Room = apps.get_model("rooms", "Room")
+    Contact = apps.get_model("profiles", "Contact")
+    Message = apps.get_model("msgs", "Message")
+
+    contact_counts = dict(Contact.objects.filter(is_active=True).values_list('room_id').annotate(models.Count('pk')))
+    message_stats = Message.objects.values('room_id').annotate(count=models.Count('pk'), last_id=models.Max('pk'))
+    message_stats = {s['room_id']: s for s in message_stats}
+    last_times = dict(Message.objects.filter(pk__in=[s['last_id'] for s in message_stats.values()])
+                                     .values_list('pk', 'time'))
+
+    for room in Room.objects.all():
+        stats = message_stats.get(room.pk, {})
+        Room.objects.filter(pk=room.pk).update(contact_count=contact_counts.get(room.pk, 0),
+                                               message_count=stats.get('count', 0),
+                                               last_message_id=stats.get('last_id'),
+                                               last_message_time=last_times.get(stats.get('last_id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0002_auto_20150112_1354'),
+        ('profiles', '0005_profile_change_password'),
+        ('msgs', '0006_message_modified_on'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='contact_count',
+            field=models.IntegerField(default=0, help_text='Number of active contacts in this room'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_id',
+            field=models.IntegerField(help_text='Id of the last message in this room', null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_time',
+            field=models.DateTimeField(help_text='Time of the last message in this room', null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.IntegerField(default=0, help_text='Number of messages in this room'),
+            preserve_default=True,
+        ),
+        migrations.RunPython(populate_counters),
+    ]
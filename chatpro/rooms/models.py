@@ -1,11 +1,25 @@
 from __future__ import absolute_import, unicode_literals
 
+from chatpro.orgs_ext import MetadataType
+from chatpro.profiles.access import invalidate_org_access
 from chatpro.profiles.tasks import sync_org_contacts
+from chatpro.utils.lookups import ModelLookupCache
+from collections import OrderedDict
 from dash.orgs.models import Org
+from dash.utils import get_obj_cacheable
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, Max, F
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
+ROOM_INDEX_CACHE_KEY = 'org:%d:room_index'
+ROOM_INDEX_CACHE_TTL = 60 * 60 * 24  # 1 day
+
+COUNTER_FIELDS = ('contact_count', 'message_count', 'last_message_id', 'last_message_time')
+
 
 class Room(models.Model):
     """
@@ -26,36 +40,209 @@ class Room(models.Model):
 
     is_active = models.BooleanField(default=True, help_text="Whether this room is active")
 
+    contact_count = models.IntegerField(default=0, help_text="Number of active contacts in this room")
+
+    message_count = models.IntegerField(default=0, help_text="Number of messages in this room")
+
+    last_message_id = models.IntegerField(null=True, help_text="Id of the last message in this room")
+
+    last_message_time = models.DateTimeField(null=True, help_text="Time of the last message in this room")
+
+    def save(self, *args, **kwargs):
+        # counters are only updated in the database, so an existing room shouldn't overwrite them with its own values
+        if self.pk and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in COUNTER_FIELDS]
+
+        super(Room, self).save(*args, **kwargs)
+
     @classmethod
     def create(cls, org, name, uuid):
-        return cls.objects.create(org=org, name=name, uuid=uuid)
+        room = cls.objects.create(org=org, name=name, uuid=uuid)
+        cls.invalidate_index(org)
+        return room
+
+    @classmethod
+    def get_or_create(cls, org, name, uuid):
+        """
+        Creates a room, or gets the existing room if another process has just created it
+        """
+        try:
+            with transaction.atomic():
+                return cls.create(org, name, uuid)
+        except IntegrityError:
+            return cls.objects.get(uuid=uuid)
 
     @classmethod
     def get_all(cls, org):
         return cls.objects.filter(org=org, is_active=True)
 
+    @classmethod
+    def get_index(cls, org):
+        """
+        Gets an ordered map of group UUIDs to the org's active rooms. This is built once per org instance, and cached
+        between instances, so that looking up rooms by group UUID doesn't need any queries.
+        """
+        def calculate():
+            index = cache.get(ROOM_INDEX_CACHE_KEY % org.pk)
+            if index is None:
+                index = OrderedDict([(r.uuid, r) for r in cls.get_all(org).order_by('pk')])
+                cache.set(ROOM_INDEX_CACHE_KEY % org.pk, index, ROOM_INDEX_CACHE_TTL)
+            return index
+
+        return get_obj_cacheable(org, '_room_index', calculate)
+
+    @classmethod
+    def invalidate_index(cls, org):
+        """
+        Invalidates the room index of the given org, which is only possible for this org instance and the cache, and
+        the cached room access of the org's users
+        """
+        cache.delete(ROOM_INDEX_CACHE_KEY % org.pk)
+        if hasattr(org, '_room_index'):
+            delattr(org, '_room_index')
+
+        invalidate_org_access(org.pk)
+
     @classmethod
     def update_room_groups(cls, org, group_uuids):
         """
-        Updates an org's chat rooms based on the selected groups UUIDs
+        Updates an org's chat rooms based on the selected groups UUIDs. Existing rooms are fetched with one query, new
+        rooms are inserted in bulk, and deactivated, reactivated and renamed rooms are each updated with one statement.
         """
-        # de-activate rooms not included
-        org.rooms.exclude(uuid__in=group_uuids).update(is_active=False)
+        selected = set(group_uuids)
 
-        # fetch group details
-        groups = org.get_temba_client().get_groups()
+        # fetch group details, which also refreshes the org's cached groups
+        groups = org.refresh_temba_metadata(MetadataType.groups)
         group_names = {group.uuid: group.name for group in groups}
 
-        for group_uuid in group_uuids:
-            existing = org.rooms.filter(uuid=group_uuid).first()
-            if existing:
-                existing.name = group_names[group_uuid]
-                existing.is_active = True
-                existing.save()
-            else:
-                cls.create(org, group_names[group_uuid], group_uuid)
+        existing = {r.uuid: r for r in org.rooms.all()}
+
+        to_deactivate = [r for r in existing.values() if r.uuid not in selected and r.is_active]
+        to_activate = [r for r in existing.values() if r.uuid in selected and not r.is_active]
+        to_rename = [r for r in existing.values() if r.uuid in selected and r.name != group_names[r.uuid]]
+        to_create = [cls(org=org, name=group_names[uuid], uuid=uuid) for uuid in group_uuids if uuid not in existing]
+
+        with transaction.atomic():
+            # de-activate rooms not included
+            if to_deactivate:
+                cls.objects.filter(pk__in=[r.pk for r in to_deactivate]).update(is_active=False)
+
+            if to_activate:
+                cls.objects.filter(pk__in=[r.pk for r in to_activate]).update(is_active=True)
+
+            if to_rename:
+                cls._rename_rooms([(room, group_names[room.uuid]) for room in to_rename])
+
+            if to_create:
+                cls.objects.bulk_create(to_create)
+
+        # updates and bulk inserts don't trigger the post_save receiver
+        room_lookups.invalidate(org.pk, [r.uuid for r in to_deactivate + to_activate + to_rename])
+        cls.invalidate_index(org)
+
+        sync_org_contacts.delay(org.id, full=True)
+
+    @classmethod
+    def _rename_rooms(cls, renames):
+        """
+        Renames rooms from a list of (room, name) tuples with a single update. Django can't set different values for
+        each row in a single update, so the name is set by a CASE on the room id.
+        """
+        quote = connection.ops.quote_name
+        pk_column = quote(cls._meta.pk.column)
+        params = []
+        for room, name in renames:
+            params += [room.pk, name]
+        params += [room.pk for room, name in renames]
+
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                quote(cls._meta.db_table), quote('name'), pk_column, ' '.join(['WHEN %s THEN %s'] * len(renames)),
+                pk_column, ', '.join(['%s'] * len(renames))), params)
+
+    @classmethod
+    def record_messages(cls, room_id, count, last_message):
+        """
+        Updates a room's message counters for the given number of new messages, in a single update of the room's row
+        """
+        quote = connection.ops.quote_name
+        count_column, id_column, time_column = (quote(cls._meta.get_field(f).column)
+                                                for f in ('message_count', 'last_message', 'last_message_time'))
+
+        # messages may be recorded out of order, so only newer messages replace the room's last message. The time is
+        # assigned before the id, as some databases evaluate later assignments against already updated columns.
+        newer = '%s IS NULL OR %s < %%s' % (id_column, id_column)
+        sql = 'UPDATE %s SET %s = %s + %%s, %s = CASE WHEN %s THEN %%s ELSE %s END, %s = CASE WHEN %s THEN %%s ' \
+              'ELSE %s END WHERE %s = %%s' % (quote(cls._meta.db_table), count_column, count_column,
+                                             time_column, newer, time_column, id_column, newer, id_column,
+                                             quote(cls._meta.pk.column))
+
+        last_time = cls._meta.get_field('last_message_time').get_db_prep_save(last_message.time, connection)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [count, last_message.pk, last_time, last_message.pk, last_message.pk, room_id])
+
+    @classmethod
+    def record_contact_change(cls, old_room_id, new_room_id):
+        """
+        Updates room contact counters for a contact which has been moved between rooms, activated (old_room_id is
+        None) or deactivated (new_room_id is None)
+        """
+        if old_room_id:
+            cls.objects.filter(pk=old_room_id).update(contact_count=F('contact_count') - 1)
+        if new_room_id:
+            cls.objects.filter(pk=new_room_id).update(contact_count=F('contact_count') + 1)
+
+    @classmethod
+    def update_contact_counts(cls, room_ids):
+        """
+        Recalculates the contact counters of the given rooms, e.g. after contacts have been updated in bulk. Counts are
+        calculated by the update itself, so that increments made concurrently aren't overwritten by stale counts.
+        """
+        from chatpro.profiles.models import Contact
+
+        room_ids = list(room_ids)
+        if not room_ids:
+            return
+
+        quote = connection.ops.quote_name
+        room_table, contact_table = quote(cls._meta.db_table), quote(Contact._meta.db_table)
+
+        count_sql = 'SELECT COUNT(*) FROM %s c WHERE c.%s = %s.%s AND c.%s = %%s' % (
+            contact_table, quote(Contact._meta.get_field('room').column), room_table, quote(cls._meta.pk.column),
+            quote(Contact._meta.get_field('is_active').column))
+
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE %s SET %s = (%s) WHERE %s IN (%s)' % (
+                room_table, quote('contact_count'), count_sql, quote(cls._meta.pk.column),
+                ', '.join(['%s'] * len(room_ids))), [True] + room_ids)
+
+    @classmethod
+    def reconcile_counters(cls, rooms):
+        """
+        Recalculates all counters of the given rooms, returning those whose counters had drifted
+        """
+        from chatpro.msgs.models import Message
+
+        room_ids = [r.pk for r in rooms]
+        cls.update_contact_counts(room_ids)
+
+        message_stats = Message.objects.filter(room_id__in=room_ids).values('room_id')
+        message_stats = {s['room_id']: s for s in message_stats.annotate(count=Count('pk'), last_id=Max('pk'))}
+        last_times = dict(Message.objects.filter(pk__in=[s['last_id'] for s in message_stats.values()])
+                                         .values_list('pk', 'time'))
+
+        for room_id in room_ids:
+            stats = message_stats.get(room_id, {})
+            last_id = stats.get('last_id')
+            cls.objects.filter(pk=room_id).update(message_count=stats.get('count', 0),
+                                                  last_message_id=last_id,
+                                                  last_message_time=last_times.get(last_id))
 
-        sync_org_contacts.delay(org.id)
+        fixed = cls.objects.filter(pk__in=room_ids).values_list('pk', *COUNTER_FIELDS)
+        fixed = {values[0]: values[1:] for values in fixed}
+        return [r for r in rooms if tuple(getattr(r, f) for f in COUNTER_FIELDS) != fixed[r.pk]]
 
     def get_contacts(self):
         return self.contacts.filter(is_active=True)
@@ -68,3 +255,13 @@ class Room(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+room_lookups = ModelLookupCache(Room, fields=('id', 'uuid', 'name', 'is_active'))
+
+
+@receiver(post_save, sender=Room)
+def invalidate_room_lookup(sender, instance, **kwargs):
+    room_lookups.invalidate(instance.org_id, [instance.uuid])
+    cache.delete(ROOM_INDEX_CACHE_KEY % instance.org_id)
+    invalidate_org_access(instance.org_id)
@@ -0,0 +1,152 @@
+"""
+Versioned participant rosters for rooms. Each room has a roster version in Redis which is incremented whenever its
+contacts or users change, and a bounded log of which participants changed in which version, so that clients can fetch
+only the participants which changed since the version they have. Serialized full rosters are cached by version.
+
+The version and log are updated together by a script so that the log never lags behind the version, and only once the
+changes have been committed. Bulk changes whose participants aren't known reset the log, after which clients must fetch
+the full roster again.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from chatpro.utils import get_redis_connection, on_commit
+from django.core.cache import cache
+
+ROSTER_VERSION_KEY = 'room:%d:roster_version'
+ROSTER_CHANGES_KEY = 'room:%d:roster_changes'
+ROSTER_FLOOR_KEY = 'room:%d:roster_floor'
+ROSTER_CHANGES_SIZE = 1000
+
+ROSTER_CACHE_KEY = 'room:%d:roster:%d'
+ROSTER_CACHE_TTL = 60 * 60 * 24  # 1 day
+
+ROSTER_RESET = '*'
+
+# increments the version, and records each changed participant under that version. Only the latest version in which
+# each participant changed is kept, and the floor is the newest version whose changes are no longer all in the log.
+RECORD_CHANGES_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+if ARGV[1] == '%(reset)s' then
+    redis.call('DEL', KEYS[2])
+    redis.call('SET', KEYS[3], version)
+    return version
+end
+for i, participant in ipairs(ARGV) do
+    redis.call('ZADD', KEYS[2], version, participant)
+end
+local excess = redis.call('ZCARD', KEYS[2]) - %(size)d
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[2], excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('SET', KEYS[3], dropped[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+end
+return version
+""" % dict(reset=ROSTER_RESET, size=ROSTER_CHANGES_SIZE)
+
+
+def contact_key(contact_id):
+    return 'C:%d' % contact_id
+
+
+def user_key(user_id):
+    return 'U:%d' % user_id
+
+
+def record_roster_changes(room_ids, participants=None):
+    """
+    Records that the given participants (as contact or user keys) have changed in each of the given rooms, or if no
+    participants are given, that the rooms have changed in unknown ways. The changes are only recorded once the current
+    transaction commits, so that a roster built from the old state can't be cached under the new version.
+    """
+    room_ids = [room_id for room_id in set(room_ids) if room_id]
+    args = list(participants) if participants is not None else [ROSTER_RESET]
+    if not room_ids or not args:
+        return
+
+    def record():
+        r = get_redis_connection()
+        if not r:
+            return
+
+        script = r.register_script(RECORD_CHANGES_SCRIPT)
+
+        with r.pipeline(transaction=False) as pipe:
+            for room_id in room_ids:
+                keys = (ROSTER_VERSION_KEY % room_id, ROSTER_CHANGES_KEY % room_id, ROSTER_FLOOR_KEY % room_id)
+                script(keys=keys, args=args, client=pipe)
+            pipe.execute()
+
+    on_commit(record)
+
+
+def get_roster_versions(room_ids):
+    """
+    Gets the current roster versions of the given rooms as a map of room ids to versions, or None if there is no Redis
+    """
+    r = get_redis_connection()
+    if not r:
+        return None
+    if not room_ids:
+        return {}
+
+    versions = r.mget([ROSTER_VERSION_KEY % room_id for room_id in room_ids])
+    return {room_id: int(version or 0) for room_id, version in zip(room_ids, versions)}
+
+
+def get_roster(room, version):
+    """
+    Gets the serialized full roster of the given room at the given version
+    """
+    key = ROSTER_CACHE_KEY % (room.pk, version)
+    roster = cache.get(key)
+    if roster is None:
+        results = build_roster(room)
+        roster = json.dumps(dict(count=len(results), version=version, results=results))
+        cache.set(key, roster, ROSTER_CACHE_TTL)
+
+    return roster
+
+
+def get_roster_changes(room, since):
+    """
+    Gets the participants of the given room which have changed since the given version, as a tuple of the current
+    version, the changed participants and the keys of removed participants. Returns None if the log can't answer that,
+    e.g. because it has been trimmed past that version, in which case the full roster should be fetched.
+    """
+    r = get_redis_connection()
+    if not r:
+        return None
+
+    with r.pipeline() as pipe:
+        pipe.get(ROSTER_VERSION_KEY % room.pk)
+        pipe.get(ROSTER_FLOOR_KEY % room.pk)
+        pipe.zrangebyscore(ROSTER_CHANGES_KEY % room.pk, since + 1, '+inf')
+        version, floor, changed = pipe.execute()
+
+    version, floor = int(version or 0), int(floor or 0)
+    if since > version or since < floor:
+        return None
+
+    contact_ids, user_ids = set(), set()
+    for key in changed:
+        participant_type, participant_id = key.decode('utf-8').split(':')
+        (contact_ids if participant_type == 'C' else user_ids).add(int(participant_id))
+
+    updated = [c.as_participant_json() for c in room.get_contacts().filter(pk__in=contact_ids)]
+    updated += [u.profile.as_participant_json() for u in room.get_users().filter(pk__in=user_ids)]
+
+    removed = [contact_key(c_id) for c_id in contact_ids - {p['id'] for p in updated if p['type'] == 'C'}]
+    removed += [user_key(u_id) for u_id in user_ids - {p['id'] for p in updated if p['type'] == 'U'}]
+
+    return version, updated, removed
+
+
+def build_roster(room):
+    """
+    Builds the full list of participants in the given room
+    """
+    results = [c.as_participant_json() for c in room.get_contacts().order_by('full_name')]
+    results += [u.profile.as_participant_json() for u in room.get_users().order_by('profile__full_name')]
+    return results
@@ -2,14 +2,20 @@ from __future__ import absolute_import, unicode_literals
 
 import json
 
+from chatpro.msgs.models import Message
 from chatpro.rooms.models import Room
+from chatpro.rooms.rosters import ROSTER_VERSION_KEY, ROSTER_CHANGES_KEY, ROSTER_FLOOR_KEY, record_roster_changes
 from chatpro.profiles.models import Contact
 from chatpro.test import ChatProTest
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 from django.utils import timezone
 from mock import patch
+from StringIO import StringIO
 from temba.types import Contact as TembaContact, Group as TembaGroup
 
 
@@ -32,9 +38,11 @@ class RoomTest(ChatProTest):
         self.assertEqual(len(Room.get_all(self.nyaruka)), 1)
 
     @override_settings(CELERY_ALWAYS_EAGER=True, CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, BROKER_BACKEND='memory')
+    @patch('dash.orgs.models.TembaClient.get_fields')
     @patch('dash.orgs.models.TembaClient.get_groups')
     @patch('dash.orgs.models.TembaClient.get_contacts')
-    def test_update_room_groups(self, mock_get_contacts, mock_get_groups):
+    def test_update_room_groups(self, mock_get_contacts, mock_get_groups, mock_get_fields):
+        mock_get_fields.return_value = []
         mock_get_groups.return_value = [TembaGroup.create(uuid='G-007', name="New group", size=2)]
         mock_get_contacts.return_value = [
             TembaContact.create(uuid='C-007', name="Jan", urns=['tel:123'], groups=['G-007'],
@@ -77,6 +85,85 @@ class RoomTest(ChatProTest):
         self.assertEqual(self.unicef.contacts.filter(is_active=True).count(), 2)
         Contact.objects.get(full_name="Jan", is_active=True)
 
+    @patch('dash.orgs.models.TembaClient.get_groups')
+    @patch('chatpro.rooms.models.sync_org_contacts.delay')
+    def test_update_room_groups_query_count(self, mock_sync_org_contacts, mock_get_groups):
+        groups = [TembaGroup.create(uuid='G-001', name="Cars", size=2),
+                  TembaGroup.create(uuid='G-002', name="Canines", size=2)]
+        groups += [TembaGroup.create(uuid='G-1%02d' % n, name="Group %d" % n, size=0) for n in range(100)]
+        mock_get_groups.return_value = groups
+
+        # keep one room, rename another, de-activate the third and create 100 more
+        with CaptureQueriesContext(connection) as captured:
+            Room.update_room_groups(self.unicef, [g.uuid for g in groups])
+
+        self.assertLessEqual(len(captured.captured_queries), 6)
+
+        self.assertEqual(self.unicef.rooms.filter(is_active=True).count(), 102)
+        self.assertEqual(Room.objects.get(uuid='G-002').name, "Canines")
+        self.assertFalse(Room.objects.get(uuid='G-003').is_active)
+        self.assertEqual(Room.objects.get(uuid='G-150').name, "Group 50")
+        self.assertEqual(list(Room.get_index(self.unicef).keys())[:3], ['G-001', 'G-002', 'G-100'])
+
+        mock_sync_org_contacts.assert_called_once_with(self.unicef.pk, full=True)
+
+        # rename every room and re-activate the third, which takes no more queries
+        groups = [TembaGroup.create(uuid=g.uuid, name="%s!" % g.name, size=g.size) for g in groups]
+        groups.append(TembaGroup.create(uuid='G-003', name="Bags", size=0))
+        mock_get_groups.return_value = groups
+
+        with CaptureQueriesContext(connection) as captured:
+            Room.update_room_groups(self.unicef, [g.uuid for g in groups])
+
+        self.assertLessEqual(len(captured.captured_queries), 6)
+
+        self.assertEqual(self.unicef.rooms.filter(is_active=True).count(), 103)
+        self.assertEqual(Room.objects.get(uuid='G-001').name, "Cars!")
+        self.assertEqual(Room.objects.get(uuid='G-150').name, "Group 50!")
+        self.assertEqual(Room.objects.get(uuid='G-003').name, "Bags")
+
+    def test_counters(self):
+        def counters(room):
+            room = Room.objects.get(pk=room.pk)
+            return room.contact_count, room.message_count, room.last_message_id
+
+        self.assertEqual(counters(self.room1), (2, 0, None))
+        self.assertEqual(counters(self.room2), (2, 0, None))
+
+        # new messages are counted
+        msg1 = Message.create_for_contact(self.unicef, self.contact1, "Hello", self.room1)
+        msg2 = Message.create_for_contact(self.unicef, self.contact2, "Hi", self.room1)
+        self.assertEqual(counters(self.room1), (2, 2, msg2.pk))
+        self.assertEqual(Room.objects.get(pk=self.room1.pk).last_message_time, msg2.time)
+
+        # an older message doesn't replace the last message, and counting is a single update
+        with self.assertNumQueries(1):
+            Room.record_messages(self.room1.pk, 1, msg1)
+        self.assertEqual(counters(self.room1), (2, 3, msg2.pk))
+
+        # contacts moving rooms and being released are counted
+        self.contact1.room = self.room2
+        self.contact1.save()
+        self.contact3.is_active = False
+        self.contact3.save()
+        self.contact3.save()  # saving again doesn't change counts
+        self.assertEqual(counters(self.room1), (1, 3, msg2.pk))
+        self.assertEqual(counters(self.room2), (2, 0, None))
+
+        # saving a stale room instance doesn't overwrite its counters
+        self.room1.name = "Autos"
+        self.room1.save()
+        self.assertEqual(counters(self.room1), (1, 3, msg2.pk))
+
+        # drift is repaired by reconciliation
+        Room.objects.filter(pk=self.room2.pk).update(contact_count=7, message_count=3)
+        out = StringIO()
+        call_command('reconcile_room_counters', str(self.unicef.pk), stdout=out)
+
+        self.assertIn("Reconciled 3 rooms (2 had drifted)", out.getvalue())
+        self.assertEqual(counters(self.room1), (1, 2, msg2.pk))
+        self.assertEqual(counters(self.room2), (2, 0, None))
+
 
 class RoomCRUDLTest(ChatProTest):
     def test_list(self):
@@ -124,3 +211,84 @@ class RoomCRUDLTest(ChatProTest):
         # try to view room we don't have access to
         response = self.url_get('unicef', reverse('rooms.room_participants', args=[self.room3.pk]))
         self.assertEqual(response.status_code, 404)
+
+
+class RoomRosterTest(ChatProTest):
+    def setUp(self):
+        super(RoomRosterTest, self).setUp()
+
+        self.redis = self.use_redis('chatpro.rooms.rosters', *[key % self.room1.pk for key in (ROSTER_VERSION_KEY,
+                                                                                                 ROSTER_CHANGES_KEY,
+                                                                                                 ROSTER_FLOOR_KEY)])
+
+    def get_participants(self, since=None, etag=None):
+        url = reverse('rooms.room_participants', args=[self.room1.pk])
+        params = dict(since=since) if since is not None else {}
+        extra = dict(HTTP_IF_NONE_MATCH=etag) if etag else {}
+        return self.client.get(url, params, HTTP_HOST='unicef.localhost', **extra)
+
+    def test_participants(self):
+        self.login(self.user1)
+
+        response = self.get_participants()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content), dict(count=3, version=0, results=[
+            dict(id=self.contact1.pk, chat_name="ann", full_name="Ann", type="C"),
+            dict(id=self.contact2.pk, chat_name="bob", full_name="Bob", type="C"),
+            dict(id=self.user1.pk, chat_name="sammy", full_name="Sam Sims", type="U")
+        ]))
+
+        # revalidating an unchanged roster
+        response = self.get_participants(etag=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # change a contact, which bumps the version
+        self.contact2.full_name = "Bobby"
+        self.contact2.save()
+
+        response = self.get_participants(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['results'][1]['full_name'], "Bobby")
+
+        response = self.get_participants(since=0)
+        self.assertEqual(json.loads(response.content), dict(count=1, version=1, since=0, removed=[], results=[
+            dict(id=self.contact2.pk, chat_name="bob", full_name="Bobby", type="C")
+        ]))
+
+        # release a contact and add a user to the room
+        self.contact1.is_active = False
+        self.contact1.save()
+        self.user2.update_rooms([self.room1, self.room2, self.room3], [])
+
+        response = self.get_participants(since=1)
+        self.assertEqual(json.loads(response.content), dict(count=1, version=3, since=1,
+                                                            removed=['C:%d' % self.contact1.pk], results=[
+            dict(id=self.user2.pk, chat_name="sue80", full_name="Sue", type="U")
+        ]))
+
+        # nothing changed since the current version
+        response = self.get_participants(since=3)
+        self.assertEqual(json.loads(response.content), dict(count=0, version=3, since=3, removed=[], results=[]))
+
+        # changes in unknown ways require the full roster
+        record_roster_changes([self.room1.pk])
+
+        response = self.get_participants(since=3)
+        self.assertEqual(json.loads(response.content)['version'], 4)
+        self.assertEqual(json.loads(response.content)['count'], 3)
+        self.assertNotIn('removed', json.loads(response.content))
+
+        # changes are only recorded once they've been committed
+        with transaction.atomic():
+            self.contact2.full_name = "Robert"
+            self.contact2.save()
+            self.assertEqual(int(self.redis.get(ROSTER_VERSION_KEY % self.room1.pk)), 4)
+
+        self.assertEqual(int(self.redis.get(ROSTER_VERSION_KEY % self.room1.pk)), 5)
+
+        # malformed versions are rejected
+        response = self.get_participants(since="x")
+        self.assertEqual(response.status_code, 400)
@@ -1,12 +1,14 @@
 from __future__ import absolute_import, unicode_literals
 
+from chatpro.utils.views import ConditionalJsonMixin, ParamsMixin
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from django import forms
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.utils.translation import ugettext_lazy as _
 from smartmin.users.views import SmartCRUDL, SmartReadView, SmartListView
 from smartmin.users.views import SmartFormView
 from .models import Room
+from .rosters import build_roster, get_roster, get_roster_changes, get_roster_versions
 
 
 class RoomCRUDL(SmartCRUDL):
@@ -25,14 +27,13 @@ class RoomCRUDL(SmartCRUDL):
             return context
 
         def get_contacts(self, obj):
-            return obj.get_contacts().count()
+            return obj.contact_count
 
         def get_messages(self, obj):
-            return obj.messages.count()
+            return obj.message_count
 
         def get_last_active(self, obj):
-            last_msg = obj.messages.order_by('-time').first()
-            return last_msg.time if last_msg else _("Never")
+            return obj.last_message_time or _("Never")
 
         def get_managers(self, obj):
             return ",".join([unicode(m) for m in obj.get_managers()])
@@ -45,7 +46,7 @@ class RoomCRUDL(SmartCRUDL):
             return Room.get_all(self.request.user.get_org())
 
         def get_contacts(self, obj):
-            return obj.get_contacts().count()
+            return obj.contact_count
 
     class Select(OrgPermsMixin, SmartFormView):
         class GroupsForm(forms.Form):
@@ -58,7 +59,7 @@ class RoomCRUDL(SmartCRUDL):
                 super(RoomCRUDL.Select.GroupsForm, self).__init__(*args, **kwargs)
 
                 choices = []
-                for group in org.get_temba_client().get_groups():
+                for group in org.get_temba_groups():
                     choices.append((group.uuid, "%s (%d)" % (group.name, group.size)))
 
                 self.fields['groups'].choices = choices
@@ -79,19 +80,41 @@ class RoomCRUDL(SmartCRUDL):
             Room.update_room_groups(self.request.user.get_org(), form.cleaned_data['groups'])
             return HttpResponseRedirect(self.get_success_url())
 
-    class Participants(OrgPermsMixin, SmartReadView):
+    class Participants(ParamsMixin, ConditionalJsonMixin, OrgPermsMixin, SmartReadView):
+        """
+        Contacts and users in a room. Full rosters are cached by the room's roster version, which is also their
+        validator, and requests with a since version get only the participants which have changed since that version.
+        """
         def get_queryset(self):
             return self.request.user.get_rooms(self.request.org)
 
-        def get_context_data(self, **kwargs):
-            context = super(RoomCRUDL.Participants, self).get_context_data(**kwargs)
+        def get_validator(self):
+            room_id = int(self.kwargs['pk'])
+            since = self.get_int_param('since')
+            if room_id not in self.request.user.get_room_ids(self.request.org):
+                return None
 
-            context['contacts'] = self.object.get_contacts().order_by('full_name')
-            context['users'] = self.object.get_users().order_by('profile__full_name')
-            return context
+            versions = get_roster_versions([room_id])
+            if versions is None:  # rosters aren't versioned without Redis
+                return None
 
-        def render_to_response(self, context, **response_kwargs):
-            results = [c.as_participant_json() for c in context['contacts']]
-            results += [u.profile.as_participant_json() for u in context['users']]
+            self.roster_version = versions[room_id]
+            return 'roster:%d:%d:%s' % (room_id, self.roster_version, since if since is not None else '')
 
-            return JsonResponse({'count': len(results), 'results': results})
+        def render_to_response(self, context, **response_kwargs):
+            room = self.object
+            version = getattr(self, 'roster_version', None)
+
+            if version is None:
+                results = build_roster(room)
+                return JsonResponse({'count': len(results), 'results': results})
+
+            since = self.get_int_param('since')
+            if since is not None:
+                changes = get_roster_changes(room, since)
+                if changes is not None:
+                    version, updated, removed = changes
+                    return JsonResponse({'count': len(updated), 'version': version, 'since': since,
+                                         'results': updated, 'removed': removed})
+
+            return HttpResponse(get_roster(room, version), content_type='application/json')
@@ -300,7 +300,7 @@ PERMISSIONS = {
 
     'orgs.org': ('create', 'update', 'list', 'edit', 'home'),
 
-    'msgs.message': ('send', 'list'),
+    'msgs.message': ('send', 'list', 'unread', 'mark_read'),
 
     'rooms.room': ('read', 'list', 'select', 'participants'),
 
@@ -324,6 +324,8 @@ GROUP_PERMISSIONS = {
     "Editors": (
         'msgs.message_list',
         'msgs.message_send',
+        'msgs.message_unread',
+        'msgs.message_mark_read',
         'rooms.room_read',
         'rooms.room_participants',
         'profiles.contact.*',
@@ -381,3 +383,32 @@ CELERYBEAT_SCHEDULE = {
 }
 
 CELERY_TIMEZONE = 'UTC'
+
+# seconds between full contact syncs, with syncs in between only fetching contacts modified since the last sync
+CONTACT_SYNC_FULL_INTERVAL = 60 * 60 * 24  # 1 day
+
+# maximum number of orgs whose contacts are synced at the same time
+CONTACT_SYNC_CONCURRENCY = 4
+
+# seconds to collect local contact changes in each org before pushing them to RapidPro, 0 pushes each immediately
+CONTACT_PUSH_BATCH_WINDOW = 0
+
+# seconds after which an org's cached RapidPro groups and fields are refreshed in the background
+ORG_METADATA_MAX_AGE = 60 * 5  # 5 minutes
+
+#-----------------------------------------------------------------------------------
+# Message sending
+#-----------------------------------------------------------------------------------
+
+# seconds to collect outgoing messages in each room before sending them as a batch, 0 sends each immediately
+MESSAGE_SEND_BATCH_WINDOW = 0
+
+#-----------------------------------------------------------------------------------
+# Webhooks
+#-----------------------------------------------------------------------------------
+
+# whether webhook events are queued and processed in batches by a Celery task, rather than processed immediately
+WEBHOOK_QUEUE_EVENTS = False
+
+# maximum number of queued webhook events to process at once
+WEBHOOK_QUEUE_BATCH_SIZE = 500
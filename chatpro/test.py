@@ -1,10 +1,14 @@
 from __future__ import unicode_literals
 
-from chatpro.rooms.models import Room
-from chatpro.profiles.models import Contact
+from chatpro.rooms.models import Room, room_lookups
+from chatpro.profiles.models import Contact, contact_lookups
+from chatpro.utils import commit_hooks, get_atomic_depth
 from dash.orgs.models import Org
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
+from mock import patch
+from redis import StrictRedis
 from uuid import uuid4
 
 
@@ -13,6 +17,15 @@ class ChatProTest(TestCase):
     Base class for all test cases in ChatPro
     """
     def setUp(self):
+        # in-process lookup caches aren't rolled back with each test's database changes
+        room_lookups.local.clear()
+        contact_lookups.local.clear()
+
+        # each test runs in a transaction which is never committed, so commit hooks run when the code being tested
+        # leaves its own outermost atomic block
+        commit_hooks.base_depth = get_atomic_depth()
+        self.addCleanup(setattr, commit_hooks, 'base_depth', 0)
+
         self.superuser = User.objects.create_superuser(username="root", email="super@user.com", password="root")
 
         self.unicef = self.create_org("UNICEF", timezone="Asia/Kabul", subdomain="unicef")
@@ -66,6 +79,20 @@ class ChatProTest(TestCase):
         user = org.administrators.first()
         return Contact.create(org, user, full_name, chat_name, urn, room, uuid)
 
+    def use_redis(self, module, *keys):
+        """
+        Patches the given module to use the Redis server at the broker URL, after deleting the given keys, and returns
+        the connection
+        """
+        redis = StrictRedis.from_url(settings.BROKER_URL)
+        if keys:
+            redis.delete(*keys)
+
+        patcher = patch('%s.get_redis_connection' % module, return_value=redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return redis
+
     def login(self, user):
         result = self.client.login(username=user.username, password=user.username)
         self.assertTrue(result, "Couldn't login as %(user)s / %(user)s" % dict(user=user.username))
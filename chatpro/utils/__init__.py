@@ -0,0 +1,101 @@
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from djcelery_transactions import transaction_signals
+from redis_cache import get_redis_connection as get_cache_redis_connection
+
+SINGLE_FLIGHT_LOCK_KEY = 'single_flight:%s'
+
+
+class CommitHooks(threading.local):
+    """
+    Per-thread callbacks waiting for the current transaction to commit. The base depth is the number of atomic blocks
+    which are never committed, e.g. the block around each test case.
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.base_depth = 0
+
+commit_hooks = CommitHooks()
+
+
+def get_redis_connection():
+    """
+    Gets a raw connection to the Redis server behind the default cache, or None if the cache isn't backed by Redis,
+    e.g. during testing
+    """
+    try:
+        return get_cache_redis_connection()
+    except NotImplementedError:
+        return None
+
+
+def single_flight(key, fetch, poll, timeout=10, interval=0.1):
+    """
+    Calls fetch unless another caller is already fetching for the given key, in which case waits for that caller by
+    calling poll until it returns something. If the other caller doesn't finish within the timeout, calls fetch anyway.
+    """
+    lock_key = SINGLE_FLIGHT_LOCK_KEY % key
+
+    if cache.add(lock_key, True, timeout):
+        try:
+            return fetch()
+        finally:
+            cache.delete(lock_key)
+
+    give_up_at = time.time() + timeout
+    while time.time() < give_up_at:
+        time.sleep(interval)
+
+        result = poll()
+        if result is not None:
+            return result
+
+    return fetch()
+
+
+def on_commit(func):
+    """
+    Calls func once the current transaction has committed, or immediately if there isn't one. Callbacks are discarded
+    if the transaction, or the savepoint they were registered in, is rolled back.
+    """
+    depth = get_atomic_depth()
+    if depth <= commit_hooks.base_depth:
+        func()
+    else:
+        commit_hooks.callbacks.append((depth, func))
+
+
+def get_atomic_depth():
+    """
+    Gets how many atomic blocks the current connection is inside
+    """
+    connection = transaction.get_connection()
+    return 1 + len(connection.savepoint_ids) if connection.in_atomic_block else 0
+
+
+def _run_commit_hooks(**kwargs):
+    depth = get_atomic_depth()
+
+    # also sent when savepoints are released, in which case their callbacks now belong to the enclosing block
+    if depth > commit_hooks.base_depth:
+        commit_hooks.callbacks = [(min(d, depth), func) for d, func in commit_hooks.callbacks]
+        return
+
+    while commit_hooks.callbacks:
+        depth, func = commit_hooks.callbacks.pop(0)
+        func()
+
+
+def _discard_commit_hooks(**kwargs):
+    depth = get_atomic_depth()
+    commit_hooks.callbacks = [(d, func) for d, func in commit_hooks.callbacks if d <= depth]
+
+
+# djcelery_transactions patches atomic blocks to send these signals, which it also uses to send tasks after commit
+transaction_signals.transaction.signals.post_commit.connect(_run_commit_hooks)
+transaction_signals.transaction.signals.post_rollback.connect(_discard_commit_hooks)
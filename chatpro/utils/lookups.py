@@ -0,0 +1,143 @@
+"""
+Two-level caches for looking up model instances by org and UUID. Each process keeps a small LRU of recent lookups for
+a few seconds, in front of the shared cache which holds the fields needed to rebuild each instance without querying
+the database.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+
+from collections import OrderedDict
+from django.core.cache import cache
+
+LOOKUP_CACHE_KEY = 'lookup:%s:%d:%s'
+LOOKUP_CACHE_TTL = 60 * 60  # 1 hour
+LOOKUP_STATS_KEY = 'lookup:%s:stats:%s'
+
+STAT_LOCAL_HITS = 'local_hits'
+STAT_SHARED_HITS = 'shared_hits'
+STAT_MISSES = 'misses'
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache whose entries expire after a fixed number of seconds
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.time():
+                return None
+
+            self._entries[key] = entry  # re-insert as most recently used
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ModelLookupCache(object):
+    """
+    Looks up active or inactive instances of a model by org and UUID, returning instances rebuilt from the cached
+    values of the given fields. Instances are invalidated when saved, but other processes may see a stale value for
+    up to local_ttl seconds.
+    """
+    STATS_FLUSH_EVERY = 100
+
+    def __init__(self, model, fields, local_size=1000, local_ttl=5):
+        self.model = model
+        self.fields = fields
+        self.name = model._meta.model_name
+        self.local = LRUCache(local_size, local_ttl)
+        self._stats = {STAT_LOCAL_HITS: 0, STAT_SHARED_HITS: 0, STAT_MISSES: 0}
+        self._stats_lock = threading.Lock()
+
+    def get(self, org, uuid):
+        """
+        Gets the instance with the given UUID in the given org, or None if there is no such instance
+        """
+        key = LOOKUP_CACHE_KEY % (self.name, org.pk, uuid)
+
+        values = self.local.get(key)
+        if values is not None:
+            self._count(STAT_LOCAL_HITS)
+        else:
+            values = cache.get(key)
+            if values is not None:
+                self._count(STAT_SHARED_HITS)
+            else:
+                self._count(STAT_MISSES)
+
+                values = self.model.objects.filter(org=org, uuid=uuid).values(*self.fields).first()
+                if values is None:
+                    return None  # don't cache missing instances as they'll be created by the caller
+
+                cache.set(key, values, LOOKUP_CACHE_TTL)
+
+            self.local.set(key, values)
+
+        instance = self.model(**values)
+        instance.org = org
+        return instance
+
+    def invalidate(self, org_id, uuids):
+        """
+        Invalidates the instances with the given UUIDs in the given org
+        """
+        keys = [LOOKUP_CACHE_KEY % (self.name, org_id, uuid) for uuid in uuids]
+        for key in keys:
+            self.local.delete(key)
+
+        if keys:
+            cache.delete_many(keys)
+
+    def get_stats(self):
+        """
+        Gets the hit and miss counts across all processes, excluding those not yet flushed
+        """
+        stats = cache.get_many([LOOKUP_STATS_KEY % (self.name, stat) for stat in self._stats.keys()])
+        return {stat: stats.get(LOOKUP_STATS_KEY % (self.name, stat), 0) for stat in self._stats.keys()}
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+            if sum(self._stats.values()) < self.STATS_FLUSH_EVERY:
+                return
+
+            pending = self._stats.copy()
+            self._stats = {s: 0 for s in pending.keys()}
+
+        # periodically add our counts to the shared counts, rather than writing to the shared cache on every lookup
+        for stat, count in pending.items():
+            if count:
+                key = LOOKUP_STATS_KEY % (self.name, stat)
+                cache.add(key, 0, None)
+                try:
+                    cache.incr(key, count)
+                except ValueError:  # e.g. cache is a dummy cache
+                    pass
@@ -2,7 +2,9 @@ from __future__ import absolute_import, unicode_literals
 
 from chatpro.profiles.models import Contact
 from chatpro.test import ChatProTest
+from chatpro.utils import on_commit
 from dash.utils.sync import sync_pull_contacts
+from django.db import transaction
 from django.utils import timezone
 from mock import patch
 from temba.types import Contact as TembaContact
@@ -69,3 +71,40 @@ class TembaTest(ChatProTest):
         # check deleted contact
         bob = Contact.objects.get(uuid='C-002')
         self.assertFalse(bob.is_active)
+
+
+class OnCommitTest(ChatProTest):
+    def test_on_commit(self):
+        called = []
+
+        # no transaction so called immediately
+        on_commit(lambda: called.append(1))
+        self.assertEqual(called, [1])
+
+        with transaction.atomic():
+            on_commit(lambda: called.append(2))
+
+            with transaction.atomic():
+                on_commit(lambda: called.append(3))
+
+            # savepoint rolled back, so its callbacks are discarded but not those of its released sibling
+            try:
+                with transaction.atomic():
+                    on_commit(lambda: called.append(4))
+                    raise ValueError("Rollback")
+            except ValueError:
+                pass
+
+            self.assertEqual(called, [1])
+
+        self.assertEqual(called, [1, 2, 3])
+
+        # transaction rolled back so never called
+        try:
+            with transaction.atomic():
+                on_commit(lambda: called.append(5))
+                raise ValueError("Rollback")
+        except ValueError:
+            pass
+
+        self.assertEqual(called, [1, 2, 3])
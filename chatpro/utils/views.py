@@ -0,0 +1,108 @@
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+
+from django.http import HttpResponseBadRequest, HttpResponseNotModified
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from django.utils.text import compress_string
+from temba.utils import parse_iso8601
+
+
+class BadParam(ValueError):
+    pass
+
+
+class ParamsMixin(object):
+    """
+    Mixin for views which parse request parameters, so that malformed parameters get a 400 rather than a 500
+    """
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ParamsMixin, self).dispatch(request, *args, **kwargs)
+        except BadParam as e:
+            return HttpResponseBadRequest(unicode(e))
+
+    def get_int_param(self, name, default=None):
+        value = self.request.REQUEST.get(name, None)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise BadParam("Parameter %s must be an integer" % name)
+
+    def get_int_list_param(self, name, default=None):
+        value = self.request.REQUEST.get(name, None)
+        if not value:
+            return default
+        try:
+            return [int(v) for v in value.split(',')]
+        except ValueError:
+            raise BadParam("Parameter %s must be a comma separated list of integers" % name)
+
+    def get_datetime_param(self, name, default=None):
+        value = self.request.REQUEST.get(name, None)
+        if not value:
+            return default
+        try:
+            return parse_iso8601(value)
+        except (ValueError, TypeError):
+            raise BadParam("Parameter %s must be an ISO8601 datetime" % name)
+
+
+class ConditionalJsonMixin(object):
+    """
+    Mixin for JSON views whose responses can be validated cheaply. Views provide a validator built from sequence
+    numbers which are maintained elsewhere, e.g. room versions or last message ids, and requests with a matching
+    If-None-Match get a 304 before the view does any other work. Those numbers must only change once the changes they
+    describe have been committed. Large responses are compressed for clients which accept that.
+    """
+    gzip_min_length = 1024  # bytes
+
+    def get_validator(self):
+        """
+        Gets a string which changes whenever this view's response would change, or None if that can't be determined
+        without doing the work of the view
+        """
+        return None
+
+    def get(self, request, *args, **kwargs):
+        validator = self.get_validator()
+        etag = hashlib.md5(validator.encode('utf-8')).hexdigest() if validator is not None else None
+
+        if etag and etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = super(ConditionalJsonMixin, self).get(request, *args, **kwargs)
+            response = self.compress_response(request, response)
+
+        if etag and response.status_code in (200, 304):
+            # weak because compressed and uncompressed responses share a validator
+            response['ETag'] = 'W/"%s"' % etag
+            patch_cache_control(response, private=True, no_cache=True)
+
+        return response
+
+    def compress_response(self, request, response):
+        """
+        Compresses the given response if it's large enough and the client accepts it
+        """
+        if response.status_code != 200 or response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if len(response.content) < self.gzip_min_length:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if not re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return response
+
+        compressed = compress_string(response.content)
+        if len(compressed) < len(response.content):
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+            response['Content-Encoding'] = 'gzip'
+
+        return response
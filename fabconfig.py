@@ -1,5 +1,6 @@
 config = dict(    
     port='8029',
+    poll_port='8030',
     app_dir='chatpro',
     friendly_name='ChatPro',
     repository='ssh://git@github.com/rapidpro/chatpro.git',
@@ -15,6 +16,6 @@ config = dict(
     prod_host='chat1',
     sqldump=False,
     celery=True,
-    processes=('celery',),
+    processes=('celery', 'poll'),
     compress=True,
 )